@@ -16,10 +16,11 @@ import surf.axi                              as axi
 
 class Application(pr.Device):
     def __init__(self,
-            sampleRate  = 0.0,
-            ampDispProc = None,
-            SSR         = 16,
-            boardType   = None,
+            sampleRate   = 0.0,
+            ampDispProc  = None,
+            eventBuilder = None,
+            SSR          = 16,
+            boardType    = None,
         **kwargs):
         super().__init__(**kwargs)
 
@@ -33,12 +34,13 @@ class Application(pr.Device):
         ))
 
         self.add(rfsoc.ReadoutCtrl(
-            offset      = 0x00_000000,
-            sampleRate  = sampleRate,
-            ampDispProc = ampDispProc,
-            SSR         = SSR,
-            boardType   = boardType,
-            expand      = True,
+            offset       = 0x00_000000,
+            sampleRate   = sampleRate,
+            ampDispProc  = ampDispProc,
+            eventBuilder = eventBuilder,
+            SSR          = SSR,
+            boardType    = boardType,
+            expand       = True,
         ))
 
         self.add(axi.AxiRingBuffer(
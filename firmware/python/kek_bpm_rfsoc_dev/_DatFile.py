@@ -0,0 +1,431 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import os
+import glob
+import collections
+import datetime
+import mmap as _mmap
+import struct
+import numpy as np
+
+import kek_bpm_rfsoc_dev as rfsoc
+
+# Random-access reader for the StreamWriter .dat files
+#
+# Every record in the file is:
+#   size    (UInt32) = payload size + 4
+#   flags   (UInt16)
+#   error   (UInt8)
+#   channel (UInt8)
+#   payload (size-4 bytes)
+# AMP fault records (channels 12 to 15) with flags == 0 start with the PrependLocalTime
+# header: 8-byte Float64 time.time() (version 0), or the 32-byte version 1 header (Root default)
+# with time.time_ns() and a sequence number (see LocalTimeHeader).
+#
+# The first open scans only the record headers and saves the result in a
+# sidecar index (<file>.idx.npz). Later opens reuse the index as long as the
+# file size and mtime are unchanged.
+
+DatFaultChannels = (12, 13, 14, 15)
+
+DatIndexVersion = 2
+
+DatIndexDtype = np.dtype([
+    ('offset',    '<u8'), # File offset of the record header
+    ('dataOffset','<u8'), # File offset of the data (past the timestamp header)
+    ('dataSize',  '<u8'), # Size of the data (bytes)
+    ('channel',   'u1'),
+    ('flags',     '<u2'),
+    ('error',     'u1'),
+    ('timestamp', '<f8'), # NaN when the record has no timestamp header
+    ('sequence',  '<i8'), # PrependLocalTime sequence number, -1 when not recorded
+])
+
+# Fault event yielded by DatFile.iterEvents() and iterFaultEvents()
+#   event     = event number in the file
+#   timestamp = time.time() of the event (NaN if not recorded)
+#   offset    = file offset of the (first) record of the event
+#   channels  = channels of the records of the event
+#   waveforms = (4, N) int16 array
+FaultEvent = collections.namedtuple('FaultEvent', ['event', 'timestamp', 'offset', 'channels', 'waveforms'])
+
+# Returns the datetime encoded in a StreamWriter AutoName() file name (data_YYYYmmdd_HHMMSS.dat)
+def datFileTime(path):
+    return datetime.datetime.strptime(os.path.basename(path)[5:20], '%Y%m%d_%H%M%S')
+
+# Returns (latest, previous) .dat files of a directory, where latest is the most
+# recently created file (usually still being written) and previous is the newest
+# file named before it. Returns (None, None) when there are no files.
+def findLatestDatFiles(directory, pattern='data_*.dat'):
+    datFiles = glob.glob(os.path.join(directory, pattern))
+    if not datFiles:
+        return None, None
+
+    latest     = max(datFiles, key=os.path.getctime)
+    latestTime = datFileTime(latest)
+    previous   = [f for f in datFiles if (f != latest) and (datFileTime(f) < latestTime)]
+    previous   = max(previous, key=datFileTime) if previous else None
+    return latest, previous
+
+# Returns the sidecar index path of a .dat file
+def datIndexPath(path):
+    return f'{path}.idx.npz'
+
+# Record header (DatIndexDtype fields) returned by readDatRecord()
+DatRecord = collections.namedtuple('DatRecord', DatIndexDtype.names)
+
+# Reads the header of the record at the current position of an open .dat file,
+# and its timestamp header for the AMP fault channels
+# Returns the DatRecord (the file position is then inside the record), or None
+# at the end of the file or for a truncated record (file still being written)
+def readDatRecord(f, fileSize, timestampChannels=DatFaultChannels):
+    pos = f.tell()
+    if pos + 8 > fileSize:
+        return None
+
+    size, flags, error, channel = struct.unpack('<IHBB', f.read(8))
+    payload = size - 4
+    if (size < 4) or (pos + 8 + payload > fileSize):
+        return None
+
+    # Check if there is a timestamp header in the frame
+    if (flags == 0) and (channel in timestampChannels) and (payload >= 8):
+        _, timestamp, sequence, hdrSize = rfsoc.parseLocalTimeHeader(f.read(min(payload, rfsoc.LocalTimeHeader.size)))
+    else:
+        timestamp = np.nan
+        sequence  = -1
+        hdrSize   = 0
+
+    return DatRecord(pos, pos+8+hdrSize, payload-hdrSize, channel, flags, error, timestamp, sequence)
+
+# Returns the (4, N) int16 waveforms of an interleaved record (samples ch0,ch1,ch2,ch3,...)
+def deinterleaveRecord(dat):
+    return np.ascontiguousarray(dat[:4*(len(dat)//4)].reshape(-1, 4).T)
+
+# Scans the record headers of a .dat file
+# A truncated record at the end of the file (file still being written) is ignored.
+# Returns the structured DatIndexDtype array
+def scanDatFile(path, timestampChannels=DatFaultChannels):
+    records = []
+    with open(path, 'rb') as f:
+        fileSize = os.fstat(f.fileno()).st_size
+        pos = 0
+        while True:
+            f.seek(pos)
+            rec = readDatRecord(f, fileSize, timestampChannels=timestampChannels)
+            if rec is None:
+                break
+            records.append(rec)
+            pos = rec.dataOffset + rec.dataSize
+
+    return np.array(records, dtype=DatIndexDtype)
+
+# Reads the fault event whose (first) record starts at a file offset, without indexing the file
+#   channels = channels of the records of the event (FaultEvent.channels), default: [15] when
+#              the record at the offset is on channel 15, else 12 to 15
+# The other records of a per-channel event are the next good records of its channels, in file order.
+# Returns the (4, N) int16 waveforms
+def readFaultEvent(path, offset, channels=None):
+    with open(path, 'rb') as f:
+        fileSize = os.fstat(f.fileno()).st_size
+        f.seek(offset)
+        rec = readDatRecord(f, fileSize)
+        if (rec is None) or (rec.error != 0) or (rec.channel not in DatFaultChannels):
+            raise IndexError( f'No fault record at offset {offset} in {path}' )
+
+        if channels is None:
+            channels = [15] if rec.channel == 15 else list(DatFaultChannels)
+        channels = [int(ch) for ch in channels]
+
+        waveforms = {}
+        while True:
+            if (rec.error == 0) and (rec.channel in channels) and (rec.channel not in waveforms):
+                f.seek(rec.dataOffset)
+                waveforms[rec.channel] = np.fromfile(f, dtype=np.int16, count=int(rec.dataSize)//2)
+                if len(waveforms) == len(channels):
+                    break
+
+            f.seek(rec.dataOffset + rec.dataSize)
+            rec = readDatRecord(f, fileSize)
+            if rec is None:
+                raise IndexError( f'Incomplete event at offset {offset} in {path}: channels {sorted(waveforms)} of {channels}' )
+
+    if channels == [15]:
+        return deinterleaveRecord(waveforms[15])
+
+    numSamples = min(len(waveforms[ch]) for ch in channels)
+    return np.stack([waveforms[ch][:numSamples] for ch in channels])
+
+# Returns the record index of a .dat file, from the sidecar when it is up to date
+#   cache = False : always scan, never touch the sidecar
+# A sidecar that cannot be written (read-only directory) is silently skipped.
+def loadDatIndex(path, cache=True, timestampChannels=DatFaultChannels):
+    st = os.stat(path)
+    idxPath = datIndexPath(path)
+
+    if cache:
+        try:
+            with np.load(idxPath) as idx:
+                if (int(idx['version']) == DatIndexVersion) and \
+                   (int(idx['fileSize']) == st.st_size) and \
+                   (int(idx['mtime']) == st.st_mtime_ns) and \
+                   (tuple(idx['timestampChannels']) == tuple(timestampChannels)):
+                    return idx['index']
+        except (OSError, KeyError, ValueError):
+            pass
+
+    index = scanDatFile(path, timestampChannels=timestampChannels)
+
+    if cache:
+        tmpPath = f'{idxPath}.{os.getpid()}.tmp'
+        try:
+            with open(tmpPath, 'wb') as f:
+                np.savez(f,
+                    version           = DatIndexVersion,
+                    fileSize          = st.st_size,
+                    mtime             = st.st_mtime_ns,
+                    timestampChannels = np.array(timestampChannels, dtype=np.uint8),
+                    index             = index)
+            os.replace(tmpPath, idxPath)
+        except OSError:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+    return index
+
+# Indexed .dat file reader
+#   layout = 'auto'        : 'perChannel' if any record is on channels 12 to 14, else 'interleaved'
+#            'interleaved' : one record per event on channel 15, samples interleaved ch0,ch1,ch2,ch3,...
+#            'perChannel'  : one record per channel (12 to 15) per event
+#   mmap   = True          : map the file and return zero-copy views from readRecord() and waveforms
+# Records with error > 0 are not part of any event.
+class DatFile(object):
+    def __init__(self, path, cache=True, layout='auto', timestampChannels=DatFaultChannels, mmap=False):
+        self._path  = path
+        self._index = loadDatIndex(path, cache=cache, timestampChannels=timestampChannels)
+        self._file  = open(path, 'rb')
+        self._map   = None
+        self._buf   = None
+
+        # An empty file cannot be mapped (and has no records to read)
+        if mmap and (len(self._index) > 0):
+            self._map = _mmap.mmap(self._file.fileno(), 0, access=_mmap.ACCESS_READ)
+            self._buf = np.frombuffer(self._map, dtype=np.uint8)
+
+        fault = self._index['error'] == 0
+        fault &= np.isin(self._index['channel'], DatFaultChannels)
+
+        if layout == 'auto':
+            layout = 'perChannel' if np.any(fault & (self._index['channel'] < 15)) else 'interleaved'
+
+        if layout == 'interleaved':
+            self._events = np.flatnonzero(fault & (self._index['channel'] == 15))[:,np.newaxis]
+        elif layout == 'perChannel':
+            # Event k is the k-th good record of every channel
+            recs = [np.flatnonzero(fault & (self._index['channel'] == ch)) for ch in DatFaultChannels]
+            numEvents = min(len(r) for r in recs)
+            self._events = np.stack([r[:numEvents] for r in recs], axis=1)
+        else:
+            raise ValueError( f'Unknown .dat layout: {layout}' )
+
+        self._layout = layout
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Method which closes the file
+    def close(self):
+        if self._map is not None:
+            self._buf = None
+            try:
+                self._map.close()
+            except BufferError:
+                # Views are still in use: the mapping is released once they are garbage collected
+                pass
+            self._map = None
+        self._file.close()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def layout(self):
+        return self._layout
+
+    @property
+    def numEvents(self):
+        return len(self._events)
+
+    @property
+    def numSamples(self):
+        size = self._index['dataSize'][self._events[:,0]] // 2
+        if self._layout == 'interleaved':
+            size //= 4
+        return int(size.min()) if len(size) else 0
+
+    # Returns the lazily indexed (events, channels, samples) int16 waveforms (see FaultWaveforms)
+    @property
+    def waveforms(self):
+        return FaultWaveforms(self)
+
+    # Method which reads the data of record i (file order) as a numpy array
+    # In mmap mode the array is a read-only view into the mapped file
+    def readRecord(self, i, dtype=np.uint8):
+        rec   = self._index[i]
+        dtype = np.dtype(dtype)
+        count = int(rec['dataSize'])//dtype.itemsize
+        if self._buf is not None:
+            return np.frombuffer(self._buf, dtype=dtype, count=count, offset=int(rec['dataOffset']))
+        self._file.seek(int(rec['dataOffset']))
+        return np.fromfile(self._file, dtype=dtype, count=count)
+
+    # Method which returns the file offset of the (first) record of event n
+    def eventOffset(self, n):
+        return int(self._index['offset'][self._events[n,0]])
+
+    # Method which returns the channels of the records of event n
+    def eventChannels(self, n):
+        return [int(ch) for ch in self._index['channel'][self._events[n]]]
+
+    # Method which returns the event whose (first) record starts at a file offset
+    def eventAtOffset(self, offset):
+        match = np.flatnonzero(self._index['offset'][self._events[:,0]] == offset)
+        if len(match) == 0:
+            raise IndexError( f'No event at offset {offset} in {self._path}' )
+        return int(match[0])
+
+    # Method which returns the timestamp (time.time()) of event n
+    def timestamp(self, n):
+        return float(self._index['timestamp'][self._events[n,0]])
+
+    # Method which returns the PrependLocalTime sequence number of event n (-1 if not recorded)
+    def sequence(self, n):
+        return int(self._index['sequence'][self._events[n,0]])
+
+    # Method which returns the timestamps of the good records of a channel
+    def channelTimestamps(self, channel):
+        good = (self._index['channel'] == channel) & (self._index['error'] == 0)
+        return self._index['timestamp'][good]
+
+    # Method which returns the (4, N) int16 waveforms of event n
+    def event(self, n):
+        if self._layout == 'interleaved':
+            return deinterleaveRecord(self.readRecord(self._events[n,0], dtype=np.int16))
+        return np.stack([self.readRecord(i, dtype=np.int16) for i in self._events[n]])
+
+    # Method which returns the int16 waveform of event n, channel ch
+    def channel(self, n, ch):
+        if self._layout == 'interleaved':
+            return self.readRecord(self._events[n,0], dtype=np.int16)[ch::4].copy()
+        return self.readRecord(self._events[n,ch], dtype=np.int16)
+
+    # Returns the number of samples per channel of event n
+    def _eventSamples(self, n):
+        size = self._index['dataSize'][self._events[n]] // 2
+        return int(size[0]//4) if self._layout == 'interleaved' else int(size.min())
+
+    # Generator which yields one assembled FaultEvent at a time
+    #   buffer = None    : every event gets a new (4, N) array
+    #            True    : a single buffer sized for the largest event is reused for every event
+    #            ndarray : caller's (4, M) int16 buffer, reused for every event
+    # With a reused buffer, waveforms is a view into it that is overwritten by the next event:
+    # copy it to keep it. Memory stays bounded by one event, whatever the file size.
+    def iterEvents(self, start=0, stop=None, buffer=None):
+        events = range(*slice(start, stop).indices(self.numEvents))
+        if len(events) == 0:
+            return
+
+        if buffer is True:
+            buffer = np.empty(shape=[4,max(self._eventSamples(n) for n in events)], dtype=np.int16)
+
+        for n in events:
+            numSamples = self._eventSamples(n)
+
+            if buffer is None:
+                out = np.empty(shape=[4,numSamples], dtype=np.int16)
+            elif (buffer.shape[0] != 4) or (buffer.shape[1] < numSamples) or (buffer.dtype != np.int16):
+                raise ValueError( f'Event {n} needs a (4, >={numSamples}) int16 buffer, got {buffer.shape} {buffer.dtype}' )
+            else:
+                out = buffer[:,:numSamples]
+
+            # De-interleave (or gather the channel records) straight into the output
+            if self._layout == 'interleaved':
+                dat = self.readRecord(self._events[n,0], dtype=np.int16)
+                np.copyto(out, dat[:4*numSamples].reshape(-1, 4).T)
+            else:
+                for ch,i in enumerate(self._events[n]):
+                    out[ch] = self.readRecord(i, dtype=np.int16)[:numSamples]
+
+            yield FaultEvent(n, self.timestamp(n), self.eventOffset(n), self.eventChannels(n), out)
+
+# Generator which opens a .dat file (memory mapped) and yields its FaultEvent one at a time
+#   buffer   = see DatFile.iterEvents()
+#   **kwargs = DatFile() parameters
+def iterFaultEvents(path, buffer=None, **kwargs):
+    kwargs.setdefault('mmap', True)
+    with DatFile(path, **kwargs) as dat:
+        yield from dat.iterEvents(buffer=buffer)
+
+# Lazily indexed (events, channels, samples) view of the fault waveforms of a DatFile
+#
+# Indexing reads only the requested events and samples. With a memory mapped
+# DatFile, a single event returns views into the map (no copy, only the pages of
+# the requested samples are touched); several events are stacked into a new array.
+# numSamples is the shortest event: longer events are truncated.
+class FaultWaveforms(object):
+    def __init__(self, datFile):
+        self._dat = datFile
+
+    @property
+    def shape(self):
+        return (self._dat.numEvents, 4, self._dat.numSamples)
+
+    def __len__(self):
+        return self._dat.numEvents
+
+    # Returns the (channels, samples) of one event, as a view when the file is mapped
+    def _event(self, n, ch, samp):
+        numSamples = self._dat.numSamples
+        if self._dat.layout == 'interleaved':
+            dat = self._dat.readRecord(self._dat._events[n,0], dtype=np.int16)
+            return dat[:4*numSamples].reshape(-1, 4)[samp, ch].T
+
+        records = self._dat._events[n]
+        if isinstance(ch, (int, np.integer)):
+            return self._dat.readRecord(records[ch], dtype=np.int16)[:numSamples][samp]
+        return np.stack([self._dat.readRecord(i, dtype=np.int16)[:numSamples][samp] for i in records[ch]])
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),)*(3-len(key))
+        ev, ch, samp = key
+
+        if isinstance(ev, (int, np.integer)):
+            if ev < 0:
+                ev += len(self)
+            if not (0 <= ev < len(self)):
+                raise IndexError( f'Event {ev} out of range ({len(self)} events)' )
+            return self._event(ev, ch, samp)
+
+        events = np.arange(len(self))[ev]
+        if len(events) == 0:
+            shape = np.broadcast_to(np.int16(0), self.shape[1:])[ch, samp].shape
+            return np.zeros(shape=(0,)+shape, dtype=np.int16)
+        return np.stack([self._event(n, ch, samp) for n in events])
@@ -0,0 +1,192 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import rogue.interfaces.stream as ris
+import pyrogue as pr
+import numpy as np
+import collections
+import threading
+import time
+
+# Coherent multi-channel event of the live display path
+#   seq       = trigger sequence (number of arm() calls) when the first channel arrived
+#   count     = event counter
+#   waveforms = (channels, N) int16 view into the builder buffer, only valid until the consumers return
+#   tFirst    = time.perf_counter() arrival of the first channel
+#   tLast     = time.perf_counter() arrival of the last channel
+LiveEvent = collections.namedtuple('LiveEvent', ['seq', 'count', 'waveforms', 'tFirst', 'tLast'])
+
+# Stream slave of one channel of the event builder
+class _EventBuilderInput(ris.Slave):
+    def __init__(self, builder, channel):
+        ris.Slave.__init__(self)
+        self._builder = builder
+        self._channel = channel
+
+    def _acceptFrame(self, frame):
+        self._builder._acceptChannel(self._channel, frame)
+
+# Event builder of the live display channels
+#
+# Every channel frame is read straight into its row of a preallocated (channels, N)
+# buffer. An event is complete when every channel delivered one frame since the
+# first one arrived: the consumers (addConsumer()) are then called once with a
+# LiveEvent, in the thread of the last channel. Two buffers are used, so the next
+# event is built while the consumers run.
+#
+# A partial event is discarded when
+#   - a channel delivers a second frame (MismatchCnt): the new frame opens the next event
+#   - it is older than MatchWindow when a frame arrives, or arm() is called (LateCnt)
+# A complete event is dropped when the consumers are still busy with the previous one (DroppedEventCnt).
+class EventBuilder(pr.Device):
+    #   numChannels = number of channels per event
+    #   maxSize     = maximum number of samples per channel (longer frames are truncated)
+    def __init__(self, numChannels=4, maxSize=2**13, **kwargs):
+        super().__init__(**kwargs)
+
+        # Not saving config/state to YAML
+        guiGroups = ['NoStream','NoState','NoConfig']
+
+        self._numChannels = numChannels
+        self._inputs      = [_EventBuilderInput(self, ch) for ch in range(numChannels)]
+        self._buffers     = [np.zeros(shape=[numChannels,maxSize], dtype=np.int16, order='C') for _ in range(2)]
+        self._build       = 0
+        self._sizes       = [0]*numChannels
+        self._mask        = 0
+        self._tFirst      = 0.0
+        self._seq         = 0
+        self._openSeq     = 0
+        self._count       = 0
+        self._consumers   = []
+        self._lock        = threading.Lock()
+        self._busy        = threading.Lock()
+
+        self.add(pr.LocalVariable(
+            name        = 'MatchWindow',
+            description = 'Maximum time between the first and the last channel of an event',
+            typeStr     = 'Float',
+            units       = 'ms',
+            value       = 100.0,
+        ))
+
+        for name,description in [
+                ('EventCnt',        'Number of complete events'),
+                ('MismatchCnt',     'Partial events discarded because a channel delivered a second frame'),
+                ('LateCnt',         'Partial events discarded because a channel did not arrive within MatchWindow'),
+                ('DroppedEventCnt', 'Complete events dropped because the consumers were busy'),
+            ]:
+            self.add(pr.LocalVariable(
+                name        = name,
+                description = description,
+                typeStr     = 'UInt32',
+                mode        = 'RO',
+                value       = 0,
+                groups      = guiGroups,
+            ))
+
+        for name,description in [
+                ('BuildLatency',    'Time between the first and the last channel of the last event'),
+                ('ConsumerLatency', 'Time spent in the consumers for the last event'),
+            ]:
+            self.add(pr.LocalVariable(
+                name        = name,
+                description = description,
+                typeStr     = 'Float',
+                mode        = 'RO',
+                units       = 'microsec',
+                disp        = '{:1.1f}',
+                value       = 0.0,
+                groups      = guiGroups,
+            ))
+
+    # Returns the stream slave of a channel
+    def getChannel(self, ch):
+        return self._inputs[ch]
+
+    # Method which registers a consumer: func(event) is called once per complete event
+    def addConsumer(self, func):
+        self._consumers.append(func)
+
+    # Method which removes a consumer
+    def removeConsumer(self, func):
+        self._consumers.remove(func)
+
+    # Method which starts a new trigger sequence (called when the trigger is fired)
+    # Returns the sequence number
+    def arm(self):
+        with self._lock:
+            late = self._mask != 0
+            self._mask = 0
+            self._seq += 1
+            seq = self._seq
+        if late:
+            self._increment(self.LateCnt)
+        return seq
+
+    # Method which increments a counter variable
+    def _increment(self, var):
+        with var.lock:
+            var.set(var.value()+1)
+
+    # Method which is called when a channel frame is received
+    def _acceptChannel(self, ch, frame):
+        now   = time.perf_counter()
+        full  = (1 << self._numChannels) - 1
+        event = None
+        counters = []
+
+        with frame.lock():
+            if frame.getError() != 0:
+                return
+
+            with self._lock:
+                # Discard the partial event if it is too old or if this channel is already there
+                if self._mask != 0:
+                    if (now-self._tFirst)*1.0E+3 > self.MatchWindow.value():
+                        counters.append(self.LateCnt)
+                        self._mask = 0
+                    elif self._mask & (1 << ch):
+                        counters.append(self.MismatchCnt)
+                        self._mask = 0
+
+                # Open a new event
+                if self._mask == 0:
+                    self._tFirst  = now
+                    self._openSeq = self._seq
+
+                # Read the payload into the channel row
+                buff = self._buffers[self._build]
+                size = min(frame.getPayload() // 2, buff.shape[1])
+                frame.read(buff[ch,:size].view(np.uint8), 0)
+                self._sizes[ch] = size
+                self._mask |= (1 << ch)
+
+                # Hand a complete event to the consumers, unless they are still busy
+                if self._mask == full:
+                    self._mask = 0
+                    if self._busy.acquire(blocking=False):
+                        self._count += 1
+                        event = LiveEvent(self._openSeq, self._count, buff[:,:min(self._sizes)], self._tFirst, now)
+                        self._build ^= 1
+                    else:
+                        counters.append(self.DroppedEventCnt)
+
+        for var in counters:
+            self._increment(var)
+
+        if event is not None:
+            try:
+                self.EventCnt.set(event.count)
+                self.BuildLatency.set((event.tLast-event.tFirst)*1.0E+6)
+                for func in self._consumers:
+                    func(event)
+                self.ConsumerLatency.set((time.perf_counter()-now)*1.0E+6)
+            finally:
+                self._busy.release()
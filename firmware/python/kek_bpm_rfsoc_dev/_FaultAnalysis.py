@@ -0,0 +1,141 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import numpy as np
+
+# Bunch-by-bunch, turn-by-turn extraction of fault captures
+#
+# Waveform sample index of (turn, bunch):
+#   start + step*(bunch + harmonic*turn)
+# where step is the number of samples per RF bucket (1 for the down-sampled
+# fault buffer, 8 for the raw ADC captures of the old firmware).
+
+# Returns the first sample after the abort gap: the first i < searchSize where
+# max(waveform[i:i+width]) < threshold, plus width. Returns None if not found.
+def findGapStart(waveform, threshold=500, width=50, searchSize=2560):
+    w = np.asarray(waveform)[:searchSize-1+width]
+    if len(w) < width:
+        return None
+
+    # Number of samples >= threshold in every window of `width` samples
+    above = np.concatenate(([0], np.cumsum(w >= threshold)))
+    count = above[width:] - above[:-width]
+
+    index = np.flatnonzero(count[:searchSize] == 0)
+    return None if len(index) == 0 else int(index[0]) + width
+
+# Returns the first local maximum above threshold in waveform[start+1:start+searchSize].
+# Returns None if not found.
+def findFirstBunch(waveform, start, threshold, searchSize=8*5120):
+    w = np.asarray(waveform)[start:start+searchSize+1]
+    c = w[1:-1]
+    hit = (w[:-2] < c) & (c > w[2:]) & (c > threshold)
+
+    index = np.flatnonzero(hit)
+    return None if len(index) == 0 else start + 1 + int(index[0])
+
+# Returns the filled-bucket mask (length harmonic) of the turn starting at `start`
+def bunchMask(waveform, start, threshold, harmonic=5120, step=1):
+    return np.asarray(waveform)[start:start+harmonic*step:step] > threshold
+
+# Returns (firstBunch, bunchIndex) of a raw capture (step samples per RF bucket):
+# the first local maximum above threshold after searchStart, and the bucket number
+# of every filled bucket in the turn starting there. Returns (None, None) if not found.
+def rawBunchIndex(waveform, threshold, searchStart=12800, searchSize=8*5120, harmonic=5120, step=8):
+    first = findFirstBunch(waveform, searchStart, threshold, searchSize=searchSize)
+    if first is None:
+        return None, None
+    return first, np.flatnonzero(bunchMask(waveform, first, threshold, harmonic=harmonic, step=step))
+
+# Returns (start, bunchIndex) of a down-sampled capture (one sample per RF bucket):
+# the first sample after the abort gap, and the bucket number of every filled
+# bucket in the turn starting there. Returns (None, None) if no gap is found.
+def gapBunchIndex(waveform, threshold=500, gapThreshold=500, gapWidth=50, harmonic=5120):
+    start = findGapStart(waveform, threshold=gapThreshold, width=gapWidth, searchSize=harmonic//2)
+    if start is None:
+        return None, None
+    return start, np.flatnonzero(bunchMask(waveform, start, threshold, harmonic=harmonic))
+
+# Returns the number of complete turns available for every bunch in bunchIndex
+def availableTurns(numSamples, start, bunchIndex, harmonic=5120, step=1):
+    if len(bunchIndex) == 0:
+        return 0
+    last = start + step*int(np.max(bunchIndex))
+    return max(0, (numSamples-1-last) // (step*harmonic) + 1)
+
+# Gathers the (turn, bunch) matrix of every channel with a single fancy index
+#   waveforms  = (numCh, N) array (or (N,) for a single waveform)
+#   bunchIndex = bucket number of every bunch to gather
+# Returns a (numCh, numTurns, nBunch) array (or (numTurns, nBunch))
+def gatherTurns(waveforms, start, bunchIndex, numTurns, harmonic=5120, step=1):
+    turns = np.arange(numTurns, dtype=np.int64)
+    index = start + step*(np.asarray(bunchIndex, dtype=np.int64)[np.newaxis,:] + harmonic*turns[:,np.newaxis])
+    return np.asarray(waveforms)[..., index]
+
+# Returns delta/sum*scale + offset, with NaN where sum is zero
+def deltaOverSum(delta, sum, scale=-16.58/5, offset=0.0):
+    delta = np.asarray(delta, dtype=np.float64)
+    sum   = np.asarray(sum, dtype=np.float64)
+    ratio = np.divide(delta, sum, out=np.full_like(delta, np.nan), where=(sum!=0))
+    ratio *= scale
+    ratio += offset
+    return ratio
+
+# Subtracts the per-bunch mean of the first `turns` turns from a (numTurns, nBunch) matrix
+# (use axis=1 for a (nBunch, numTurns) matrix)
+def subtractBaseline(x, turns=10, axis=0):
+    base = np.mean(np.moveaxis(x, axis, 0)[:turns], axis=0)
+    return x - np.expand_dims(base, axis)
+
+# Divides a (numTurns, nBunch) matrix by the per-bunch mean of the first `turns` turns
+# (use axis=1 for a (nBunch, numTurns) matrix)
+def normalizeBaseline(x, turns=10, axis=0):
+    x = np.asarray(x, dtype=np.float64)
+    base = np.mean(np.moveaxis(x, axis, 0)[:turns], axis=0)
+    return x / np.expand_dims(base, axis)
+
+# Returns the turn-to-turn difference of a (numTurns, nBunch) matrix, shape (numTurns-1, nBunch)
+# (use axis=1 for a (nBunch, numTurns) matrix)
+def turnDifference(x, axis=0):
+    return np.diff(x, axis=axis)
+
+# Runs the full extraction on a (4, N) down-sampled fault capture:
+#   1) the first turn starts after the abort gap found on channel 0
+#   2) filled buckets are those above threshold on channel 0 in that turn
+#   3) (turn, bunch) matrices are gathered for every channel
+#   4) DV = ch1/ch0 and UV = ch3/ch2 positions (mm), baseline subtracted,
+#      chargeD = ch0 and chargeU = ch2, normalized to the baseline
+# Returns None when no gap or fewer than minBunches filled buckets are found,
+# else a dictionary with 'start', 'bunchIndex' and (numTurns, nBunch) matrices
+# 'dv', 'uv', 'chargeD' and 'chargeU'
+def extractBunches(waveforms, threshold=500, gapThreshold=500, gapWidth=50, numTurns=0,
+                   baselineTurns=10, minBunches=300, harmonic=5120, scale=-16.58/5):
+    waveforms = np.asarray(waveforms)
+
+    start, bunchIndex = gapBunchIndex(waveforms[0], threshold=threshold, gapThreshold=gapThreshold,
+                                      gapWidth=gapWidth, harmonic=harmonic)
+    if (start is None) or (len(bunchIndex) == 0) or (len(bunchIndex) < minBunches):
+        return None
+
+    maxTurns = availableTurns(waveforms.shape[1], start, bunchIndex, harmonic=harmonic)
+    numTurns = maxTurns if (numTurns <= 0) else min(numTurns, maxTurns)
+    if numTurns == 0:
+        return None
+
+    tbt = gatherTurns(waveforms, start, bunchIndex, numTurns, harmonic=harmonic)
+
+    return {
+        'start'      : start,
+        'bunchIndex' : bunchIndex,
+        'dv'         : subtractBaseline(deltaOverSum(tbt[1], tbt[0], scale=scale), baselineTurns),
+        'uv'         : subtractBaseline(deltaOverSum(tbt[3], tbt[2], scale=scale), baselineTurns),
+        'chargeD'    : normalizeBaseline(tbt[0], baselineTurns),
+        'chargeU'    : normalizeBaseline(tbt[2], baselineTurns),
+    }
@@ -0,0 +1,210 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import os
+import json
+import zipfile
+import numpy as np
+
+import kek_bpm_rfsoc_dev as rfsoc
+
+# Chunked, compressed archive of fault captures (.fca)
+#
+# The archive is a zip file:
+#   meta.json         = format version, chunking, filters, archive metadata and
+#                       the metadata (numSamples, timestamp, ...) of every event
+#   <event>/<ch>/<k>  = chunk k of channel ch of an event: int16 samples
+#                       [k*chunkSize, (k+1)*chunkSize) with chunkSize = chunkTurns*samplesPerTurn,
+#                       filtered then deflate compressed
+# Chunks are aligned to turn boundaries from the start of the capture, so reading
+# a range of turns of one channel only decompresses the chunks holding them.
+#
+# Filters (applied in order when writing, in reverse order when reading):
+#   'delta'   = first difference of the int16 samples (wrapping, lossless)
+#   'shuffle' = byte shuffle: all low bytes, then all high bytes
+
+FaultArchiveVersion = 1
+
+FaultArchiveFilters = ('delta', 'shuffle')
+
+# Returns the filtered bytes of an int16 chunk
+def _encodeChunk(data, filters):
+    data = np.ascontiguousarray(data, dtype='<i2')
+    for f in filters:
+        if f == 'delta':
+            delta = np.empty_like(data)
+            delta[:1] = data[:1]
+            np.subtract(data[1:], data[:-1], out=delta[1:])
+            data = delta
+        elif f == 'shuffle':
+            data = np.ascontiguousarray(data.view(np.uint8).reshape(-1,2).T).view('<i2')
+    return data.tobytes()
+
+# Returns the int16 chunk of filtered bytes
+def _decodeChunk(raw, filters):
+    data = np.frombuffer(raw, dtype='<i2')
+    for f in reversed(filters):
+        if f == 'delta':
+            data = np.cumsum(data, dtype='<i2')
+        elif f == 'shuffle':
+            data = np.ascontiguousarray(data.view(np.uint8).reshape(2,-1).T).view('<i2').ravel()
+    return data
+
+# Writer of a .fca archive
+#   chunkTurns     = number of turns per chunk
+#   samplesPerTurn = samples per turn (5120 for the down-sampled fault buffer, 8*5120 for raw ADC captures)
+#   filters        = subset of FaultArchiveFilters
+#   level          = deflate level (1 = fastest)
+#   metadata       = archive metadata (JSON serializable: firmware image, MuxSelect, thresholds, ...)
+# The archive is written to a temporary file and renamed on close().
+class FaultArchiveWriter(object):
+    def __init__(self, path, chunkTurns=8, samplesPerTurn=5120, filters=('shuffle',), level=1, metadata=None):
+        for f in filters:
+            if f not in FaultArchiveFilters:
+                raise ValueError( f'Unknown fault archive filter: {f}' )
+
+        self._path     = path
+        self._tmpPath  = f'{path}.{os.getpid()}.tmp'
+        self._zip      = zipfile.ZipFile(self._tmpPath, 'w')
+        self._level    = level
+        self._events   = []
+        self._meta     = {
+            'version'        : FaultArchiveVersion,
+            'chunkTurns'     : chunkTurns,
+            'samplesPerTurn' : samplesPerTurn,
+            'filters'        : list(filters),
+            'metadata'       : dict(metadata) if metadata is not None else {},
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, *args):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def numEvents(self):
+        return len(self._events)
+
+    # Method which appends a (channels, N) int16 capture with its event metadata
+    def append(self, waveforms, **metadata):
+        waveforms = np.asarray(waveforms)
+        n = len(self._events)
+        chunkSize = self._meta['chunkTurns']*self._meta['samplesPerTurn']
+
+        for ch in range(waveforms.shape[0]):
+            for k,offset in enumerate(range(0, waveforms.shape[1], chunkSize)):
+                self._zip.writestr(f'{n}/{ch}/{k}',
+                                   _encodeChunk(waveforms[ch,offset:offset+chunkSize], self._meta['filters']),
+                                   compress_type=zipfile.ZIP_DEFLATED, compresslevel=self._level)
+
+        self._events.append(dict(metadata, numChannels=waveforms.shape[0], numSamples=waveforms.shape[1]))
+
+    # Method which writes the metadata and renames the archive
+    def close(self):
+        self._zip.writestr('meta.json', json.dumps(dict(self._meta, events=self._events), indent=1))
+        self._zip.close()
+        os.replace(self._tmpPath, self._path)
+
+    # Method which discards the archive
+    def abort(self):
+        self._zip.close()
+        os.remove(self._tmpPath)
+
+# Reader of a .fca archive
+class FaultArchive(object):
+    def __init__(self, path):
+        self._path = path
+        self._zip  = zipfile.ZipFile(path, 'r')
+        self._meta = json.loads(self._zip.read('meta.json'))
+
+        if self._meta['version'] != FaultArchiveVersion:
+            self._zip.close()
+            raise ValueError( f'Unsupported fault archive version {self._meta["version"]}: {path}' )
+
+        self._chunkSize = self._meta['chunkTurns']*self._meta['samplesPerTurn']
+        self._filters   = tuple(self._meta['filters'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Method which closes the archive
+    def close(self):
+        self._zip.close()
+
+    @property
+    def path(self):
+        return self._path
+
+    # Archive metadata (firmware image, MuxSelect, thresholds, ...)
+    @property
+    def metadata(self):
+        return self._meta['metadata']
+
+    @property
+    def numEvents(self):
+        return len(self._meta['events'])
+
+    @property
+    def samplesPerTurn(self):
+        return self._meta['samplesPerTurn']
+
+    @property
+    def chunkSize(self):
+        return self._chunkSize
+
+    # Method which returns the metadata of event n (numChannels, numSamples, timestamp, ...)
+    def eventMetadata(self, n):
+        return self._meta['events'][n]
+
+    # Method which returns the int16 samples [start, stop) of event n, channel ch
+    # Only the chunks overlapping the range are decompressed.
+    def read(self, n, ch, start=0, stop=None):
+        numSamples = self._meta['events'][n]['numSamples']
+        start, stop, _ = slice(start, stop).indices(numSamples)
+        if stop <= start:
+            return np.zeros(shape=0, dtype=np.int16)
+
+        first = start // self._chunkSize
+        last  = (stop-1) // self._chunkSize
+        data  = np.concatenate([_decodeChunk(self._zip.read(f'{n}/{ch}/{k}'), self._filters) for k in range(first, last+1)])
+        offset = first*self._chunkSize
+        return data[start-offset:stop-offset]
+
+    # Method which returns turns [first, last) of event n, channel ch
+    def readTurns(self, n, ch, first, last):
+        return self.read(n, ch, first*self.samplesPerTurn, last*self.samplesPerTurn)
+
+    # Method which returns the (channels, N) int16 waveforms of event n
+    def event(self, n):
+        return np.stack([self.read(n, ch) for ch in range(self._meta['events'][n]['numChannels'])])
+
+# Converts the fault events of a .dat file into a .fca archive
+#   metadata = archive metadata (firmware image, MuxSelect, thresholds, ...)
+#   **kwargs = FaultArchiveWriter() parameters
+# Returns the archive path
+def convertDatFile(datPath, archivePath=None, metadata=None, **kwargs):
+    if archivePath is None:
+        archivePath = os.path.splitext(datPath)[0] + '.fca'
+
+    metadata = dict(metadata) if metadata is not None else {}
+    metadata.setdefault('source', os.path.basename(datPath))
+    with FaultArchiveWriter(archivePath, metadata=metadata, **kwargs) as writer:
+        for ev in rfsoc.iterFaultEvents(datPath, buffer=True):
+            writer.append(ev.waveforms, event=ev.event, channels=ev.channels,
+                          timestamp=None if np.isnan(ev.timestamp) else ev.timestamp)
+
+    return archivePath
@@ -0,0 +1,178 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import os
+import glob
+import time
+import hashlib
+import concurrent.futures
+import numpy as np
+
+import kek_bpm_rfsoc_dev as rfsoc
+
+# Batch analysis of .dat fault files: one summary row per fault event
+#
+# Every file is analyzed by a worker process, and its rows are saved in a
+# per-file cache (keyed by file size, mtime and analysis parameters) as soon
+# as the worker returns. An interrupted batch therefore resumes where it
+# stopped, and unchanged files are never analyzed twice.
+
+FaultSummaryDtype = np.dtype([
+    ('file',       'U64'),
+    ('event',      '<i4'),
+    ('offset',     '<u8'), # File offset of the (first) record of the event
+    ('channels',   'U16'), # Channels of the records of the event (e.g. '15' or '12,13,14,15')
+    ('timestamp',  '<f8'), # time.time() of the event, NaN if not recorded
+    ('valid',      '?'),   # False when no abort gap or too few bunches were found
+    ('start',      '<i4'), # Sample index of the first bucket after the abort gap
+    ('firstBunch', '<i4'), # Sample index of the first filled bucket
+    ('numBunches', '<i4'),
+    ('numTurns',   '<i4'),
+    ('lossTurnD',  '<i4'), # First turn where the mean downstream charge drops below lossLevel (-1 = never)
+    ('lossTurnU',  '<i4'), # Same for the upstream charge
+    ('chargeD',    '<f8'), # Mean downstream charge of the last turn (normalized to the baseline)
+    ('chargeU',    '<f8'), # Same for the upstream charge
+    ('dvRms',      '<f8'), # RMS over the bunches of the last turn DV position (mm)
+    ('uvRms',      '<f8'), # Same for the UV position
+    ('dvMaxAbs',   '<f8'), # Maximum |DV| over all turns and bunches (mm)
+    ('uvMaxAbs',   '<f8'), # Same for UV
+])
+
+# Returns the summary rows of every fault event of a .dat file
+#   lossLevel = normalized charge below which the beam is considered lost
+#   **kwargs  = extractBunches() parameters
+def summarizeFaultFile(path, lossLevel=0.9, **kwargs):
+    rows = []
+    for ev in rfsoc.iterFaultEvents(path, buffer=True, cache=False):
+        row = np.zeros(shape=1, dtype=FaultSummaryDtype)
+        row['file']      = os.path.basename(path)
+        row['event']     = ev.event
+        row['offset']    = ev.offset
+        row['channels']  = ','.join(str(ch) for ch in ev.channels)
+        row['timestamp'] = ev.timestamp
+        row['lossTurnD'] = -1
+        row['lossTurnU'] = -1
+        rows.append(row)
+
+        res = rfsoc.extractBunches(ev.waveforms, **kwargs)
+        if res is None:
+            continue
+
+        row['valid']      = True
+        row['start']      = res['start']
+        row['firstBunch'] = res['start'] + res['bunchIndex'][0]
+        row['numBunches'] = len(res['bunchIndex'])
+        row['numTurns']   = res['dv'].shape[0]
+
+        for plane,key in [('D','chargeD'),('U','chargeU')]:
+            charge = np.nanmean(res[key], axis=1)
+            lost   = np.flatnonzero(charge < lossLevel)
+            row[f'lossTurn{plane}'] = lost[0] if len(lost) else -1
+            row[f'charge{plane}']   = charge[-1]
+
+        for key in ['dv','uv']:
+            row[f'{key}Rms']    = np.sqrt(np.nanmean(res[key][-1]**2))
+            row[f'{key}MaxAbs'] = np.nanmax(np.abs(res[key]))
+
+    rows = np.concatenate(rows) if rows else np.zeros(shape=0, dtype=FaultSummaryDtype)
+    return rows
+
+# Returns the .dat files matching a list of directories, files or glob patterns (sorted, no duplicates)
+def expandDatFiles(inputs, pattern='data_*.dat'):
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files += glob.glob(os.path.join(item, pattern))
+        else:
+            files += glob.glob(item)
+    return sorted(set(os.path.abspath(f) for f in files))
+
+# Returns the cache file of a .dat file for a given set of analysis parameters
+def faultCachePath(cacheDir, path, params):
+    st  = os.stat(path)
+    key = hashlib.sha1(repr((FaultSummaryDtype.descr, sorted(params.items()))).encode()).hexdigest()[:12]
+    return os.path.join(cacheDir, f'{os.path.basename(path)}.{st.st_size}.{st.st_mtime_ns}.{key}.npy')
+
+# Worker process entry point: returns (path, rows, error message)
+def _summarizeWorker(path, params):
+    try:
+        return path, summarizeFaultFile(path, **params), None
+    except Exception as e:
+        return path, None, f'{type(e).__name__}: {e}'
+
+# Summarizes a list of .dat files with a process pool
+#   workers  = number of worker processes (0 = os.cpu_count())
+#   cacheDir = per-file result cache (None = no cache)
+#   force    = ignore (and overwrite) cached results
+#   **params = summarizeFaultFile() parameters
+# Yields (path, rows, status) for every file as soon as it is available, where
+# status is 'cached', 'done' or the error message (rows is None on error)
+def iterFaultSummaries(paths, workers=0, cacheDir=None, force=False, **params):
+    pending = []
+
+    if cacheDir is not None:
+        os.makedirs(cacheDir, exist_ok=True)
+
+    # Reuse the cached results
+    for path in paths:
+        cache = faultCachePath(cacheDir, path, params) if cacheDir is not None else None
+        if (cache is not None) and (not force) and os.path.exists(cache):
+            yield path, np.load(cache), 'cached'
+        else:
+            pending.append((path, cache))
+
+    if not pending:
+        return
+
+    workers = workers if workers > 0 else (os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_summarizeWorker, path, params) : cache for path,cache in pending}
+        for future in concurrent.futures.as_completed(futures):
+            path, rows, error = future.result()
+            cache = futures[future]
+
+            # Save right away so that an interrupted batch resumes from here
+            if (error is None) and (cache is not None):
+                tmp = f'{cache}.{os.getpid()}.tmp'
+                with open(tmp, 'wb') as f:
+                    np.save(f, rows)
+                os.replace(tmp, cache)
+
+            yield path, rows, 'done' if error is None else error
+
+# Analyzes a list of .dat files with a process pool (see iterFaultSummaries())
+#   progress = progress(done, total, path, status) called in the driver for every file
+# Returns the concatenated FaultSummaryDtype rows, in file order
+def analyzeFaultFiles(paths, workers=0, cacheDir=None, force=False, progress=None, **params):
+    results = {}
+    for done,(path,rows,status) in enumerate(iterFaultSummaries(paths, workers=workers, cacheDir=cacheDir, force=force, **params), 1):
+        if rows is not None:
+            results[path] = rows
+        if progress is not None:
+            progress(done, len(paths), path, status)
+
+    rows = [results[p] for p in paths if p in results]
+    return np.concatenate(rows) if rows else np.zeros(shape=0, dtype=FaultSummaryDtype)
+
+# Saves a summary table (.npy structured array, written atomically)
+def saveFaultSummary(path, rows):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, rows)
+    os.replace(tmp, path)
+
+# Returns a progress() callback for analyzeFaultFiles() that prints one line per file with an ETA
+def printProgress():
+    t0 = time.monotonic()
+    def progress(done, total, path, status):
+        elapsed = time.monotonic() - t0
+        eta = elapsed/done*(total-done) if done else 0.0
+        print(f'[{done}/{total}] {os.path.basename(path)}: {status} (elapsed {elapsed:.1f} s, ETA {eta:.1f} s)', flush=True)
+    return progress
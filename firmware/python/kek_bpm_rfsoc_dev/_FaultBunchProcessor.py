@@ -0,0 +1,292 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import rogue.interfaces.stream as ris
+import pyrogue as pr
+import numpy as np
+import time
+
+import kek_bpm_rfsoc_dev as rfsoc
+
+# Parses a FaultBunchProcessor frame payload (bytes, bytearray or numpy array)
+# Returns a dictionary with 'eventCnt', 'start', 'bunchIndex' and the
+# (numTurns, nBunch) 'dv', 'uv', 'chargeD' and 'chargeU' matrices (zero-copy views into data)
+def parseFaultBunchFrame(data):
+    buf = np.frombuffer(data, dtype=np.uint8)
+    hdr = buf[:16].view('<u4')
+    numTurns = int(hdr[2])
+    numBunch = int(hdr[3])
+    size     = numTurns*numBunch
+    offset   = 16 + 4*numBunch
+
+    results = {
+        'eventCnt'   : int(hdr[0]),
+        'start'      : int(hdr[1]),
+        'bunchIndex' : np.frombuffer(buf, dtype='<u4', count=numBunch, offset=16),
+    }
+    for i,key in enumerate(['dv','uv','chargeD','chargeU']):
+        results[key] = np.frombuffer(buf, dtype='<f4', count=size, offset=offset+4*size*i).reshape(numTurns,numBunch)
+    return results
+
+# Class for online bunch-by-bunch, turn-by-turn extraction of the AMP fault captures
+class FaultBunchProcessor(pr.DataReceiver,ris.Master):
+    # Init method must call the parent class init
+    def __init__( self,
+            hidden      = True,
+            **kwargs):
+        pr.Device.__init__(self, hidden=hidden, **kwargs)
+        ris.Slave.__init__(self)
+        ris.Master.__init__(self)
+        pr.DataReceiver.__init__(self, enableOnStart=True, hideData=True, hidden=hidden, **kwargs)
+
+        # Not saving config/state to YAML
+        guiGroups = ['NoStream','NoState','NoConfig']
+
+        # Remove data variable from stream and server
+        self.Data.addToGroup('NoServe')
+        self.Data.addToGroup('NoStream')
+        self.Data.addToGroup('NoStatus')
+
+        # Staging buffer for the derived stream
+        self._frameBuffer = np.zeros(shape=0, dtype='<u4')
+
+        #-----------------------------------------------------------------------------
+        # Configuration
+        #-----------------------------------------------------------------------------
+
+        self.add(pr.LocalVariable(
+            name        = 'Threshold',
+            description = 'Channel 0 amplitude above which a bucket is considered filled',
+            typeStr     = 'Int32',
+            value       = 500,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'GapThreshold',
+            description = 'Channel 0 amplitude below which a sample is considered in the abort gap',
+            typeStr     = 'Int32',
+            value       = 500,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'GapWidth',
+            description = 'Number of consecutive samples below GapThreshold that define the abort gap',
+            typeStr     = 'UInt32',
+            value       = 50,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'MinBunches',
+            description = 'Minimum number of filled buckets for a valid capture',
+            typeStr     = 'UInt32',
+            value       = 300,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'NumTurns',
+            description = 'Number of turns to extract (0 = all available turns)',
+            typeStr     = 'UInt32',
+            value       = 0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'BaselineTurns',
+            description = 'Number of leading turns used for the position and charge baseline',
+            typeStr     = 'UInt32',
+            value       = 10,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'Harmonic',
+            description = 'Number of RF buckets per turn',
+            typeStr     = 'UInt32',
+            value       = 5120,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'PositionScale',
+            description = 'delta/sum to position scale factor',
+            typeStr     = 'Float',
+            units       = 'mm',
+            value       = -16.58/5,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'StreamEnable',
+            description = 'Enables the derived (turn, bunch) results stream',
+            typeStr     = 'Bool',
+            value       = False,
+        ))
+
+        #-----------------------------------------------------------------------------
+        # Results
+        #-----------------------------------------------------------------------------
+
+        self.add(pr.LocalVariable(
+            name        = 'EventCnt',
+            description = 'Increments per valid fault capture',
+            typeStr     = 'UInt32',
+            mode        = 'RO',
+            value       = 0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'InvalidCnt',
+            description = 'Increments per fault capture without abort gap or with too few bunches',
+            typeStr     = 'UInt32',
+            mode        = 'RO',
+            value       = 0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'GapStart',
+            description = 'Sample index of the first bucket after the abort gap',
+            typeStr     = 'UInt32',
+            mode        = 'RO',
+            value       = 0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'NumBunches',
+            description = 'Number of filled buckets in the last capture',
+            typeStr     = 'UInt32',
+            mode        = 'RO',
+            value       = 0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'TurnCount',
+            description = 'Number of turns extracted from the last capture',
+            typeStr     = 'UInt32',
+            mode        = 'RO',
+            value       = 0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'ProcessLatency',
+            description = 'Time spent extracting the last capture',
+            typeStr     = 'Float',
+            mode        = 'RO',
+            units       = 'microsec',
+            disp        = '{:1.1f}',
+            value       = 0.0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'BunchIndex',
+            description = 'Bucket number of every filled bucket',
+            typeStr     = 'Int32[np]',
+            value       = np.zeros(shape=1, dtype=np.int32, order='C'),
+            hidden      = True,
+            groups      = guiGroups,
+        ))
+
+        for key,desc in [('Dv','Downstream vertical position (mm)'),
+                         ('Uv','Upstream vertical position (mm)'),
+                         ('ChargeD','Downstream normalized charge'),
+                         ('ChargeU','Upstream normalized charge')]:
+            self.add(pr.LocalVariable(
+                name        = key,
+                description = f'{desc}, (turn, bunch) matrix',
+                typeStr     = 'Float[np]',
+                value       = np.zeros(shape=[1,1], dtype=np.float32, order='C'),
+                hidden      = True,
+                groups      = guiGroups,
+            ))
+
+            self.add(pr.LocalVariable(
+                name        = f'{key}LastTurn',
+                description = f'{desc} of the last extracted turn',
+                typeStr     = 'Float[np]',
+                value       = np.zeros(shape=1, dtype=np.float32, order='C'),
+                hidden      = True,
+                groups      = guiGroups,
+            ))
+
+    # Method which is called when a frame is received
+    def process(self,frame):
+        t0 = time.perf_counter()
+
+        # Convert the frame data into a (4, N) numpy 16-bit integer array
+        dat = frame.getNumpy(0, frame.getPayload()).view(np.int16)
+        waveforms = np.ascontiguousarray(dat[:4*(len(dat)//4)].reshape(-1, 4).T)
+
+        results = rfsoc.extractBunches(
+            waveforms,
+            threshold     = self.Threshold.value(),
+            gapThreshold  = self.GapThreshold.value(),
+            gapWidth      = self.GapWidth.value(),
+            numTurns      = self.NumTurns.value(),
+            baselineTurns = self.BaselineTurns.value(),
+            minBunches    = self.MinBunches.value(),
+            harmonic      = self.Harmonic.value(),
+            scale         = self.PositionScale.value(),
+        )
+
+        if results is None:
+            self.InvalidCnt.set(self.InvalidCnt.value()+1)
+            return
+
+        with self.root.updateGroup():
+            self.GapStart.set(results['start'])
+            self.NumBunches.set(len(results['bunchIndex']))
+            self.TurnCount.set(results['dv'].shape[0])
+            self.BunchIndex.set(results['bunchIndex'].astype(np.int32))
+            for key,res in [('Dv','dv'),('Uv','uv'),('ChargeD','chargeD'),('ChargeU','chargeU')]:
+                mat = results[res].astype(np.float32)
+                self.node(key).set(mat)
+                self.node(f'{key}LastTurn').set(mat[-1])
+            self.EventCnt.set(self.EventCnt.value()+1)
+
+        if self.StreamEnable.value():
+            self.ResultsFrameGen(results)
+
+        self.ProcessLatency.set((time.perf_counter()-t0)*1.0E+6)
+
+    # Method for generating a frame with the results
+    def ResultsFrameGen(self,results):
+
+        # event counter (UInt32) + start (UInt32) + numTurns (UInt32) + nBunch (UInt32)
+        # bunchIndex (UInt32[nBunch])
+        # dv, uv, chargeD, chargeU (Float32[numTurns*nBunch] each)
+        numTurns, numBunch = results['dv'].shape
+        size  = numTurns*numBunch
+        words = 4 + numBunch + 4*size
+
+        # Grow the staging buffer to the largest event seen
+        if len(self._frameBuffer) < words:
+            self._frameBuffer = np.zeros(shape=words, dtype='<u4')
+
+        buf  = self._frameBuffer[:words]
+        fbuf = buf.view('<f4')
+        buf[0:4] = [self.EventCnt.value(), results['start'], numTurns, numBunch]
+        buf[4:4+numBunch] = results['bunchIndex']
+        offset = 4+numBunch
+        for i,key in enumerate(['dv','uv','chargeD','chargeU']):
+            fbuf[offset+size*i:offset+size*(i+1)] = results[key].ravel()
+
+        # Here we request a frame capable of holding size bytes
+        frame = self._reqFrame(4*words, True)
+
+        # Write the results into the frame with a single write
+        frame.write(buf.view(np.uint8),0)
+
+        # Send the frame results
+        self._sendFrame(frame)
+
+    # Overload the `>>` python operator for a connection for this custom master stream module
+    def __rshift__(self,other):
+        pr.streamConnect(self,other)
+        return other
+
+    # Overload the `<<` python operator for a connection for this custom master stream module
+    def __lshift__(self,other):
+        pr.streamConnect(other,self)
+        return other
@@ -0,0 +1,176 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import os
+import datetime
+import sqlite3
+import numpy as np
+
+import kek_bpm_rfsoc_dev as rfsoc
+
+# SQLite catalog of the fault events, one row per event
+#
+# The events table holds the FaultSummaryDtype columns (with the full file path
+# instead of the file name) plus maxExcursion = max(dvMaxAbs, uvMaxAbs). The
+# files table records the size and mtime of every cataloged file, so that
+# addFile() and backfill() only re-analyze new or modified files.
+#
+# The stored record offset jumps straight to the event: load() seeks there and
+# decodes only the records of that event, without indexing the file.
+
+_sqlTypes = {'U': 'TEXT', 'i': 'INTEGER', 'u': 'INTEGER', 'b': 'INTEGER', 'f': 'REAL'}
+
+_summaryColumns = [name for name in rfsoc.FaultSummaryDtype.names if name != 'file']
+
+class FaultCatalog(object):
+    #   path    = SQLite database file
+    #   timeout = seconds to wait for another writer (watcher workers, backfill) to release the database
+    def __init__(self, path, timeout=30.0):
+        self._path = path
+        self._db   = sqlite3.connect(path, timeout=timeout)
+        self._db.row_factory = sqlite3.Row
+
+        columns = ',\n'.join(f'    {name} {_sqlTypes[rfsoc.FaultSummaryDtype[name].kind]}' for name in _summaryColumns)
+        with self._db:
+            self._db.executescript(f'''
+CREATE TABLE IF NOT EXISTS files (
+    path   TEXT PRIMARY KEY,
+    size   INTEGER,
+    mtime  INTEGER
+);
+CREATE TABLE IF NOT EXISTS events (
+    path TEXT,
+{columns},
+    maxExcursion REAL,
+    PRIMARY KEY (path, event)
+);
+CREATE INDEX IF NOT EXISTS eventsTimestamp    ON events (timestamp);
+CREATE INDEX IF NOT EXISTS eventsNumBunches   ON events (numBunches);
+CREATE INDEX IF NOT EXISTS eventsLossTurnD    ON events (lossTurnD);
+CREATE INDEX IF NOT EXISTS eventsMaxExcursion ON events (maxExcursion);
+''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Method which closes the database
+    def close(self):
+        self._db.close()
+
+    @property
+    def path(self):
+        return self._path
+
+    # Returns True if the file is cataloged with its current size and mtime
+    def isCurrent(self, path):
+        path = os.path.abspath(path)
+        st   = os.stat(path)
+        row  = self._db.execute('SELECT size, mtime FROM files WHERE path = ?', (path,)).fetchone()
+        return (row is not None) and (row['size'] == st.st_size) and (row['mtime'] == st.st_mtime_ns)
+
+    # Method which replaces the events of a file with FaultSummaryDtype rows
+    def addRows(self, path, rows, size=None, mtime=None):
+        path = os.path.abspath(path)
+        if (size is None) or (mtime is None):
+            st = os.stat(path)
+            size, mtime = st.st_size, st.st_mtime_ns
+
+        names  = ['path'] + _summaryColumns + ['maxExcursion']
+        values = [
+            [path] + [row[name].item() for name in _summaryColumns] + [max(row['dvMaxAbs'].item(), row['uvMaxAbs'].item())]
+            for row in rows
+        ]
+
+        with self._db:
+            self._db.execute('DELETE FROM events WHERE path = ?', (path,))
+            self._db.executemany(f'INSERT INTO events ({",".join(names)}) VALUES ({",".join("?"*len(names))})', values)
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (path, size, mtime))
+
+    # Method which catalogs a single file (skipped when already current, unless force)
+    #   **params = summarizeFaultFile() parameters
+    # Returns the number of cataloged events (None when skipped)
+    def addFile(self, path, force=False, **params):
+        if (not force) and self.isCurrent(path):
+            return None
+        st   = os.stat(path)
+        rows = rfsoc.summarizeFaultFile(path, **params)
+        self.addRows(path, rows, size=st.st_size, mtime=st.st_mtime_ns)
+        return len(rows)
+
+    # Method which catalogs the new or modified files of a list with a process pool
+    #   progress = progress(done, total, path, status), see analyzeFaultFiles()
+    #   **params = iterFaultSummaries() parameters
+    # Every file is committed as soon as it is analyzed, so an interrupted backfill resumes where it stopped.
+    # Returns the number of analyzed files
+    def backfill(self, paths, force=False, progress=None, **params):
+        todo = [os.path.abspath(p) for p in paths if force or not self.isCurrent(p)]
+        stat = {p : os.stat(p) for p in todo}
+
+        for done,(path,rows,status) in enumerate(rfsoc.iterFaultSummaries(todo, force=force, **params), 1):
+            if rows is not None:
+                self.addRows(path, rows, size=stat[path].st_size, mtime=stat[path].st_mtime_ns)
+            if progress is not None:
+                progress(done, len(todo), path, status)
+        return len(todo)
+
+    # Method which removes the files that no longer exist
+    def prune(self):
+        missing = [(row['path'],) for row in self._db.execute('SELECT path FROM files') if not os.path.exists(row['path'])]
+        with self._db:
+            self._db.executemany('DELETE FROM events WHERE path = ?', missing)
+            self._db.executemany('DELETE FROM files WHERE path = ?', missing)
+        return len(missing)
+
+    # Method which runs a SELECT on the events table and returns the sqlite3.Row list
+    #   where = SQL condition (with ? placeholders for params)
+    def select(self, where='1', params=(), orderBy='timestamp'):
+        return self._db.execute(f'SELECT * FROM events WHERE {where} ORDER BY {orderBy}', params).fetchall()
+
+    # Method which returns the events of a time range and/or matching summary thresholds
+    #   start, stop   = time range (time.time() float or datetime), stop excluded
+    #   minBunches    = minimum number of filled buckets
+    #   minExcursion  = minimum max(|DV|, |UV|) (mm)
+    #   maxLossTurn   = charge loss (downstream) at or before this turn
+    #   valid         = only the events with an abort gap and enough bunches
+    def query(self, start=None, stop=None, minBunches=None, minExcursion=None, maxLossTurn=None, valid=True):
+        where  = []
+        params = []
+
+        def timeValue(t):
+            return t.timestamp() if isinstance(t, datetime.datetime) else float(t)
+
+        if start is not None:
+            where.append('timestamp >= ?')
+            params.append(timeValue(start))
+        if stop is not None:
+            where.append('timestamp < ?')
+            params.append(timeValue(stop))
+        if minBunches is not None:
+            where.append('numBunches >= ?')
+            params.append(int(minBunches))
+        if minExcursion is not None:
+            where.append('maxExcursion >= ?')
+            params.append(float(minExcursion))
+        if maxLossTurn is not None:
+            where.append('lossTurnD >= 0 AND lossTurnD <= ?')
+            params.append(int(maxLossTurn))
+        if valid:
+            where.append('valid')
+
+        return self.select(' AND '.join(where) if where else '1', params)
+
+    # Method which returns the (4, N) int16 waveforms of a cataloged event (row from query()/select())
+    # Only the records of the event are read: the file is not indexed (see readFaultEvent())
+    @staticmethod
+    def load(row):
+        return rfsoc.readFaultEvent(row['path'], row['offset'], channels=row['channels'].split(','))
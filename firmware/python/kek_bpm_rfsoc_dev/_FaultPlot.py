@@ -0,0 +1,206 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import concurrent.futures
+import numpy as np
+
+# Batch renderer of the abort summary plots (position and charge of the last turns)
+#
+# matplotlib is only imported when a renderer is created, so that the rest of the
+# package does not depend on it. The figures are drawn with the Agg canvas directly
+# (no pyplot state, whatever the caller's backend). Compared to building every
+# figure from scratch:
+#   - one figure per plane is built once and reused: only the scatter offsets
+#     and the title change between events
+#   - points falling on the same output pixel are drawn once (pre-decimation)
+#   - the 'tight' bounding box is computed once per figure, and every event is
+#     drawn once and cropped to it (savefig() draws twice and re-lays out the
+#     figure), then written as RGB with a fast deflate level
+#   - the scatter layers are rasterized (vector outputs stay small)
+#   - the planes can be rendered in parallel by worker processes, each one
+#     keeping its own figures
+#
+# The turn x bunch heatmaps (imshow) of makeplot.py and makeplot_manually.py are
+# not covered: they belong to the disabled old firmware analysis and are never saved.
+
+# Plane definitions of the abort summary plots
+AbortPlotPlanes = {
+    'UV' : {
+        'figsize'     : (16,6),
+        'posColor'    : 'tomato',
+        'chargeColor' : 'royalblue',
+        'posText'     : 'Upstream Vertical',
+        'chargeText'  : 'Upstream Charge',
+        'chargeLabel' : 'Charge',
+    },
+    'DV' : {
+        'figsize'     : (18,6),
+        'posColor'    : 'red',
+        'chargeColor' : 'blue',
+        'posText'     : 'Downstream Vertical',
+        'chargeText'  : 'Downstream Charge',
+        'chargeLabel' : 'Charge (a.u.)',
+    },
+}
+
+# Returns the mask of the points to draw: the first point of every output pixel,
+# dropping the points more than margin pixels outside of the axes
+#   xy = (N, 2) display (pixel) coordinates
+def decimatePixels(xy, bbox, margin=4):
+    valid = np.isfinite(xy).all(axis=1)
+    valid &= (xy[:,0] >= bbox.x0-margin) & (xy[:,0] <= bbox.x1+margin)
+    valid &= (xy[:,1] >= bbox.y0-margin) & (xy[:,1] <= bbox.y1+margin)
+
+    px = np.round(xy[valid]).astype(np.int64)
+    width = int(bbox.x1) + 2*margin + 2
+    key = (px[:,1]+margin+1)*width + (px[:,0]+margin+1)
+    _, first = np.unique(key, return_index=True)
+
+    mask = np.zeros(shape=len(xy), dtype=bool)
+    mask[np.flatnonzero(valid)[first]] = True
+    return mask
+
+class AbortPlotRenderer(object):
+    #   dpi       = output resolution
+    #   decimate  = draw a single point per output pixel
+    #   padInches     = padding around the tight bounding box
+    #   compressLevel = PNG deflate level (1 = fastest, 6 = matplotlib default)
+    def __init__(self, dpi=200, decimate=True, padInches=0.5, compressLevel=1):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from PIL import Image
+
+        self._figure        = lambda **kw: FigureCanvasAgg(Figure(**kw)).figure
+        self._image         = Image
+        self._dpi           = dpi
+        self._decimate      = decimate
+        self._padInches     = padInches
+        self._compressLevel = compressLevel
+        self._templates     = {}
+
+    # Builds the (position, charge) figure of a plane
+    def _template(self, plane, xlim):
+        key = (plane, tuple(xlim))
+        if key in self._templates:
+            return self._templates[key]
+
+        cfg = AbortPlotPlanes[plane]
+        fig = self._figure(figsize=cfg['figsize'], dpi=self._dpi)
+        ax1, ax2 = fig.subplots(2, 1, sharex=True)
+        title = ax1.set_title('')
+        pos = ax1.scatter([], [], color=cfg['posColor'], s=6, rasterized=True)
+        ax1.set_ylabel("Y position (mm)")
+        ax1.set_ylim(-0.4,0.4)
+        ax1.grid()
+        ax1.text(0.02,0.05,cfg['posText'],transform=ax1.transAxes,ha='left',va='bottom',fontsize=14)
+
+        charge = ax2.scatter([], [], color=cfg['chargeColor'], s=6, rasterized=True)
+        ax2.set_xlabel("Turn")
+        ax2.set_ylabel(cfg['chargeLabel'])
+        ax2.set_ylim(0,1.2)
+        ax2.grid()
+        ax2.set_xticks([0,1,2,3,4,5,6,7,8,9,10],['-10','-9','-8','-7','-6','-5','-4','-3','-2','-1','0'])
+        ax2.set_yticks([0,0.2,0.4,0.6,0.8,1])
+        ax2.set_xlim(*xlim)
+        ax2.text(0.02,0.05,cfg['chargeText'],transform=ax2.transAxes,ha='left',va='bottom',fontsize=14)
+        fig.subplots_adjust(hspace=.1)
+
+        self._templates[key] = {'fig': fig, 'title': title, 'layers': [(ax1, pos), (ax2, charge)], 'bbox': None}
+        return self._templates[key]
+
+    # Method which renders the (position, charge) plot of a plane into a PNG file
+    #   plane    = key of AbortPlotPlanes
+    #   x        = x coordinate (turn) of every point
+    #   position = position (mm) of every point
+    #   charge   = normalized charge of every point
+    # Returns the number of points drawn per layer
+    def render(self, path, plane, title, x, position, charge, xlim=(0,10)):
+        tpl = self._template(plane, xlim)
+        fig = tpl['fig']
+        tpl['title'].set_text(title)
+
+        drawn = []
+        x = np.asarray(x, dtype=np.float64).ravel()
+        for (ax, layer), y in zip(tpl['layers'], [position, charge]):
+            xy = np.column_stack([x, np.asarray(y, dtype=np.float64).ravel()])
+            if self._decimate:
+                xy = xy[decimatePixels(ax.transData.transform(xy), ax.bbox)]
+            layer.set_offsets(xy)
+            drawn.append(len(xy))
+
+        # The layout is fixed: compute the tight bounding box (in pixels) once
+        if tpl['bbox'] is None:
+            bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(self._padInches)
+            tpl['bbox'] = [int(round(v*self._dpi)) for v in bbox.extents]
+
+        fig.canvas.draw()
+        self._image.fromarray(self._crop(np.asarray(fig.canvas.buffer_rgba()), tpl['bbox'])).save(
+            path, format='png', compress_level=self._compressLevel)
+        return drawn
+
+    # Returns the RGB pixels of the (x0, y0, x1, y1) bounding box (from the bottom left corner),
+    # white outside of the figure
+    @staticmethod
+    def _crop(rgba, bbox):
+        height, width = rgba.shape[:2]
+        x0, y0, x1, y1 = bbox
+        out = np.full(shape=[y1-y0, x1-x0, 3], fill_value=255, dtype=np.uint8)
+
+        # Rows are stored from the top
+        r0, r1 = height-y1, height-y0
+        sr0, sr1 = max(r0, 0), min(r1, height)
+        sc0, sc1 = max(x0, 0), min(x1, width)
+        out[sr0-r0:sr1-r0, sc0-x0:sc1-x0] = rgba[sr0:sr1, sc0:sc1, :3]
+        return out
+
+    # Method which releases the figures
+    def close(self):
+        self._templates = {}
+
+# Renderer of the current worker process
+_workerRenderer = None
+
+def _renderWorker(job, kwargs):
+    global _workerRenderer
+    if _workerRenderer is None:
+        _workerRenderer = AbortPlotRenderer(**kwargs)
+    return _workerRenderer.render(**job)
+
+# Parallel renderer: every job (AbortPlotRenderer.render() arguments) runs in a worker
+# process, and each worker keeps its figures between calls
+#   workers  = number of worker processes (0 = render in this process)
+#   **kwargs = AbortPlotRenderer() parameters
+class AbortPlotPool(object):
+    def __init__(self, workers=2, **kwargs):
+        self._kwargs = kwargs
+        self._local  = AbortPlotRenderer(**kwargs) if workers == 0 else None
+        self._pool   = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Method which renders a list of jobs and returns their results
+    def render(self, jobs):
+        if self._pool is None:
+            return [self._local.render(**job) for job in jobs]
+        futures = [self._pool.submit(_renderWorker, job, self._kwargs) for job in jobs]
+        return [f.result() for f in futures]
+
+    # Method which stops the workers
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        if self._local is not None:
+            self._local.close()
+            self._local = None
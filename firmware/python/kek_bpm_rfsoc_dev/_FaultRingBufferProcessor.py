@@ -11,6 +11,7 @@
 import rogue.interfaces.stream as ris
 import pyrogue as pr
 import numpy as np
+import threading
 
 # Class for streaming RX
 class FaultRingBufferProcessor(pr.DataReceiver):
@@ -62,25 +63,158 @@ class FaultRingBufferProcessor(pr.DataReceiver):
             groups = guiGroups,
         ))
 
-        self._waveformData = [None for _ in range(4)]
+        #-----------------------------------------------------------------------------
+        # Min/max envelope pyramid of the full capture
+        #-----------------------------------------------------------------------------
+
+        self._envFactors = [8, 64, 512, 4096]
+
+        for factor in self._envFactors:
+            for i in range(4):
+                for stat in ['Min','Max']:
+                    self.add(pr.LocalVariable(
+                        name        = f'Envelope{factor}{stat}[{i}]',
+                        description = f'{stat} of every {factor} samples over the full capture',
+                        typeStr     = 'Int16[np]',
+                        value       = np.zeros(shape=1, dtype=np.int16, order='C'),
+                        hidden      = True,
+                        groups      = guiGroups,
+                    ))
+
+        self.add(pr.LocalVariable(
+            name        = 'WindowLevel',
+            description = 'Decimation factor of the display window',
+            typeStr     = 'UInt8',
+            value       = 0,
+            enum        = {0:'x1', 1:'x8', 2:'x64', 3:'x512', 4:'x4096'},
+            groups      = guiGroups,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'WindowStart',
+            description = 'First point of the display window (in points of the selected level)',
+            typeStr     = 'UInt32',
+            value       = 0,
+            groups      = guiGroups,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'WindowSize',
+            description = 'Number of points in the display window (0 = full capture)',
+            typeStr     = 'UInt32',
+            value       = 4096,
+            groups      = guiGroups,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'WindowTime',
+            description = 'Time steps of the display window (ns)',
+            typeStr     = 'Float[np]',
+            value       = np.zeros(shape=1, dtype=np.float64, order='C'),
+            hidden      = True,
+            groups      = guiGroups,
+        ))
+
+        for i in range(4):
+            for stat in ['Min','Max']:
+                self.add(pr.LocalVariable(
+                    name        = f'Window{stat}[{i}]',
+                    description = f'{stat} envelope of the display window',
+                    typeStr     = 'Int16[np]',
+                    value       = np.zeros(shape=1, dtype=np.int16, order='C'),
+                    hidden      = True,
+                    groups      = guiGroups,
+                ))
+
+        for var in [self.WindowLevel, self.WindowStart, self.WindowSize]:
+            var.addListener(self._windowChanged)
+
+        # Contiguous (4, N) capture buffer and its envelope pyramid
+        self._waveformData = np.zeros(shape=[4,0], dtype=np.int16, order='C')
+        self._envelope     = {}
+        self._envLock      = threading.Lock()
 
     # Method which updates the waveform PV from external function
     def UpdateWaveform(self):
         # Reset the flag
         self.NewDataReady.set(False)
 
+    # Method which builds the min/max envelope pyramid from the capture buffer
+    def _buildEnvelope(self):
+        envelope = {}
+        prevMin  = self._waveformData
+        prevMax  = self._waveformData
+        prevFactor = 1
+        for factor in self._envFactors:
+            step = factor // prevFactor
+
+            # Drop the oldest samples that do not fill a complete bin (keeps the end aligned)
+            size = (prevMin.shape[1] // step) * step
+            skip = prevMin.shape[1] - size
+            curMin = prevMin[:, skip:].reshape(4, -1, step).min(axis=2)
+            curMax = prevMax[:, skip:].reshape(4, -1, step).max(axis=2)
+
+            envelope[factor] = (curMin, curMax)
+            prevMin, prevMax, prevFactor = curMin, curMax, factor
+        return envelope
+
+    # Method which is called when the display window selection changes
+    def _windowChanged(self,path,value):
+        self._updateWindow()
+
+    # Method which publishes the selected display window
+    def _updateWindow(self):
+        with self._envLock:
+            factor = [1]+self._envFactors
+            factor = factor[self.WindowLevel.value()]
+            if factor == 1:
+                wMin = wMax = self._waveformData
+            elif factor in self._envelope:
+                wMin, wMax = self._envelope[factor]
+            else:
+                return
+
+            # Clamp the window to the available points
+            numPts = wMin.shape[1]
+            size   = self.WindowSize.value()
+            size   = numPts if (size == 0) else min(size, numPts)
+            start  = min(self.WindowStart.value(), numPts-size)
+            stop   = start + size
+
+            # Time relative to the end of the capture (ns)
+            self.WindowTime.set(-self._timeBin*factor*np.arange(numPts-start-1, numPts-stop-1, -1, dtype=np.float64))
+            for i in range(4):
+                self.WindowMin[i].set(np.copy(wMin[i,start:stop]), write=True)
+                self.WindowMax[i].set(np.copy(wMax[i,start:stop]), write=True)
+
     # Method which is called when a frame is received
     def process(self,frame):
         with self.root.updateGroup():
             # Convert the frame data into a numpy 16-bit integer array
             dat = frame.getNumpy(0, frame.getPayload()).view(np.int16)
 
-            # Reshape the array into (4, N) format
-            self._waveformData = dat.reshape(-1, 4).T  # Transpose to get (4, N) shape
+            with self._envLock:
+                # De-interleave once into the contiguous (4, N) buffer
+                size = len(dat) // 4
+                if self._waveformData.shape[1] != size:
+                    self._waveformData = np.zeros(shape=[4,size], dtype=np.int16, order='C')
+                np.copyto(self._waveformData, dat[:4*size].reshape(-1, 4).T)
+
+                # Build the envelope pyramid of the full capture
+                self._envelope = self._buildEnvelope()
 
             for i in range(4):
                 # Keep only the last self._maxDispSize columns for each channel
-                self.WaveformData[i].set(self._waveformData[i, -self._maxDispSize:], write=True)
+                # (copied: the capture buffer is overwritten in place by the next frame)
+                self.WaveformData[i].set(np.copy(self._waveformData[i, -self._maxDispSize:]), write=True)
+
+                # Publish the envelope pyramid
+                for factor,(eMin,eMax) in self._envelope.items():
+                    self.node(f'Envelope{factor}Min[{i}]').set(eMin[i], write=True)
+                    self.node(f'Envelope{factor}Max[{i}]').set(eMax[i], write=True)
+
+            # Publish the display window
+            self._updateWindow()
 
             # Set the flag
             self.NewDataReady.set(True)
@@ -0,0 +1,227 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import os
+import glob
+import time
+import threading
+import collections
+import concurrent.futures
+
+# Long running watcher of the StreamWriter output directory
+#
+# The StreamWriter holds a single file open: with Root.EnableAutoReopen it
+# closes the file holding a fault and opens the next AutoName() file. A file
+# is therefore complete when either
+#   1) a close event is received for it (watchdog/inotify, when available), or
+#   2) a newer file exists and its size has been stable for settleTime seconds.
+# The newest file is never processed before it is closed, so that a fault
+# written into it later is not missed.
+#
+# Every complete file is submitted exactly once to a process pool. The workers
+# stay alive between files, so the analysis modules are imported only once, and
+# back-to-back faults are queued instead of starting overlapping processes.
+# The optional callback runs in the watcher process, one file at a time, with
+# the result of the worker: shared resources (e.g. the FaultCatalog database)
+# are written there instead of from every worker.
+
+# Worker process entry point: returns (result, start time, end time)
+def _timedCall(func, path):
+    start = time.time()
+    result = func(path)
+    return result, start, time.time()
+
+class FaultFileWatcher(object):
+    #   directory    = StreamWriter output directory
+    #   func         = func(path) run in a worker process for every complete file (must be picklable)
+    #   callback     = callback(path, result) run in the watcher process after func succeeded
+    #   workers      = number of worker processes
+    #   settleTime   = seconds without size change before a file followed by a newer one is complete
+    #   pollInterval = seconds between directory scans
+    #   existing     = also process the (complete) files already present at start()
+    #   historySize  = number of latency records kept in history
+    def __init__(self, directory, func, callback=None, pattern='data_*.dat', workers=1, settleTime=1.0,
+                 pollInterval=0.5, existing=False, historySize=1000):
+        self._directory    = directory
+        self._func         = func
+        self._callback     = callback
+        self._pattern      = pattern
+        self._workers      = workers
+        self._settleTime   = settleTime
+        self._pollInterval = pollInterval
+        self._existing     = existing
+
+        self._files    = {}    # path -> [size, mtime_ns, monotonic and wall-clock time of the last size change]
+        self._closed   = set() # paths with a close event
+        self._done     = set() # paths already submitted
+        self._pending  = set()
+        self._lock     = threading.Lock()
+        self._wake     = threading.Event()
+        self._running  = False
+        self._thread   = None
+        self._pool     = None
+        self._cbLock   = threading.Lock()
+        self._observer = None
+
+        self.history = collections.deque(maxlen=historySize)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    # Method which starts the pool, the directory observer and the scan thread
+    def start(self):
+        self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self._workers)
+
+        # Skip the files already present, except the newest one which may still be written
+        if not self._existing:
+            self._done.update(self._listFiles()[:-1])
+
+        self._observer = self._startObserver()
+
+        self._running = True
+        self._thread  = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # Method which stops scanning and waits for the queued files to be processed
+    # The files followed by a newer one are submitted without waiting for settleTime.
+    def stop(self):
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.scan(settleTime=0.0)
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # Starts a watchdog observer that records close events and wakes up the scan thread.
+    # Returns None when watchdog is not installed (polling only).
+    def _startObserver(self):
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return None
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory:
+                    return
+                if event.event_type == 'closed':
+                    with watcher._lock:
+                        watcher._closed.add(os.path.abspath(event.src_path))
+                watcher._wake.set()
+
+        observer = Observer()
+        observer.schedule(Handler(), self._directory, recursive=False)
+        observer.start()
+        return observer
+
+    # Scan thread: wakes up on watchdog events or every pollInterval
+    def _run(self):
+        while self._running:
+            self._wake.wait(self._pollInterval)
+            self._wake.clear()
+            self.scan()
+
+    # Returns the files of the directory in creation (AutoName) order
+    def _listFiles(self):
+        return sorted(os.path.abspath(p) for p in glob.glob(os.path.join(self._directory, self._pattern)))
+
+    # Method which scans the directory and submits the complete files
+    # Returns the list of submitted files
+    def scan(self, settleTime=None):
+        settleTime = self._settleTime if settleTime is None else settleTime
+        now   = time.monotonic()
+        paths = self._listFiles()
+        ready = []
+
+        with self._lock:
+            closed = self._closed
+            self._closed = set()
+
+        for i,path in enumerate(paths):
+            if path in self._done:
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            # Track the size changes
+            entry = self._files.get(path)
+            if (entry is None) or (entry[0] != st.st_size) or (entry[1] != st.st_mtime_ns):
+                entry = self._files[path] = [st.st_size, st.st_mtime_ns, now, time.time()]
+
+            # AutoName() file names sort in creation order: any later name means the writer moved on
+            newer  = (i+1) < len(paths)
+            stable = (now - entry[2]) >= settleTime
+            if (path in closed) or (newer and stable):
+                ready.append(path)
+
+        for path in ready:
+            self._submit(path)
+        return ready
+
+    def _submit(self, path):
+        changed = self._files.pop(path)[3]
+        self._done.add(path)
+        self._pending.add(path)
+        submitted = time.time()
+        future = self._pool.submit(_timedCall, self._func, path)
+        future.add_done_callback(lambda f: self._finished(path, changed, submitted, f))
+
+    # Records the latency of a processed file
+    #   settle  = time between the last size change seen and the submission (close detection)
+    #   queue   = time spent waiting for a free worker
+    #   process = time spent in func (and callback)
+    #   total   = time between the last size change seen and the end of processing
+    def _finished(self, path, changed, submitted, future):
+        self._pending.discard(path)
+        record = {'path': path, 'error': None}
+        try:
+            record['result'], start, end = future.result()
+        except Exception as e:
+            record['error'] = f'{type(e).__name__}: {e}'
+            start = end = time.time()
+
+        # Hand the worker result to the callback
+        if (record['error'] is None) and (self._callback is not None):
+            try:
+                with self._cbLock:
+                    self._callback(path, record['result'])
+            except Exception as e:
+                record['error'] = f'callback {type(e).__name__}: {e}'
+            end = time.time()
+
+        record['settle']  = submitted - changed
+        record['queue']   = start - submitted
+        record['process'] = end - start
+        record['total']   = end - changed
+        self.history.append(record)
+
+        status = 'done' if record['error'] is None else record['error']
+        print( f'{os.path.basename(path)}: {status} (settle {record["settle"]:.2f} s, queue {record["queue"]:.2f} s, '
+               f'process {record["process"]:.2f} s, total {record["total"]:.2f} s)', flush=True )
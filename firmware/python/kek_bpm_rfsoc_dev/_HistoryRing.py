@@ -0,0 +1,64 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import numpy as np
+
+# Fixed-size (events x width) history ring for one or more named fields
+#
+# Every row is written twice, at index i and i+depth, into a (2*depth, width)
+# buffer. The last K entries (K <= depth) are then always the contiguous rows
+# ending at i+depth, so last() never has to copy or unwrap the ring.
+class HistoryRing(object):
+    def __init__(self, fields, depth, width, dtype=np.float32):
+        self._fields = list(fields)
+        self._depth  = int(depth)
+        self._width  = int(width)
+        self._dtype  = np.dtype(dtype)
+        self._buf    = {f : np.zeros(shape=[2*self._depth,self._width], dtype=self._dtype, order='C') for f in self._fields}
+        self._head   = 0 # Next row to write
+        self._count  = 0
+
+    @property
+    def depth(self):
+        return self._depth
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def count(self):
+        return min(self._count, self._depth)
+
+    # Returns the number of bytes needed for a ring of this size
+    @staticmethod
+    def nbytes(numFields, depth, width, dtype=np.float32):
+        return numFields * 2 * depth * width * np.dtype(dtype).itemsize
+
+    # Method which clears the ring without reallocating
+    def clear(self):
+        self._head  = 0
+        self._count = 0
+
+    # Method which appends one row per field
+    def append(self, **values):
+        i = self._head
+        for f in self._fields:
+            buf = self._buf[f]
+            buf[i,:] = values[f]
+            buf[i+self._depth,:] = buf[i,:]
+        self._head   = (i+1) % self._depth
+        self._count += 1
+
+    # Method which returns a dictionary of (k, width) views of the last k rows (oldest first)
+    def last(self, k=None):
+        k    = self.count if k is None else min(int(k), self.count)
+        stop = self._head + self._depth
+        return {f : self._buf[f][stop-k:stop] for f in self._fields}
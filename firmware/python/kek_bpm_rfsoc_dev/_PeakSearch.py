@@ -0,0 +1,171 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import numpy as np
+
+# Returns the number of bunch windows that the peak search walks through.
+# Matches range(startIndex, numSamples-pointsPerBunch+startIndex, pointsPerBunch)
+def peakSearchSize(numSamples, pointsPerBunch=12):
+    return max(0, -(-(numSamples-pointsPerBunch) // pointsPerBunch))
+
+# Batched peak search over a (numCh, N) block of waveforms
+#   waveforms      = (numCh, N) array (or (N,) for a single waveform)
+#   startIndex     = sample index of the first bunch window
+#   threshold      = peaks below threshold are replaced with zero
+#   pointsPerBunch = number of samples per bunch window
+# Returns (peaks, mask) with shape (numCh, nBunch), where mask is the
+# noise-threshold mask (True when the peak is above threshold)
+def peakSearch(waveforms, startIndex, threshold, pointsPerBunch=12):
+    waveforms = np.asarray(waveforms)
+    single    = (waveforms.ndim == 1)
+    if single:
+        waveforms = waveforms[np.newaxis,:]
+
+    numCh, numSamples = waveforms.shape
+    nBunch = peakSearchSize(numSamples, pointsPerBunch)
+
+    # The last window can run past the end of the waveform when startIndex > 0
+    nFull  = min(nBunch, (numSamples-startIndex) // pointsPerBunch)
+    stop   = startIndex + nFull*pointsPerBunch
+
+    peaks = np.empty(shape=(numCh, nBunch), dtype=np.int64)
+    if nFull > 0:
+        # (numCh, nFull, pointsPerBunch) view of the waveform, reduced along the bunch window
+        blocks = waveforms[:, startIndex:stop].reshape(numCh, nFull, pointsPerBunch)
+        np.max(blocks, axis=2, out=peaks[:,:nFull])
+    if nBunch > nFull:
+        # Truncated window at the end of the waveform
+        peaks[:,nFull] = np.max(waveforms[:, stop:], axis=1)
+
+    # Apply the noise threshold
+    mask = (peaks >= threshold)
+    peaks[~mask] = 0
+
+    if single:
+        return peaks[0], mask[0]
+    return peaks, mask
+
+# Returns the absolute sample index of the maximum of every bunch window, shape (numCh, nBunch)
+def peakIndex(waveforms, startIndex, pointsPerBunch=12):
+    waveforms = np.atleast_2d(waveforms)
+    numCh, numSamples = waveforms.shape
+    nBunch = peakSearchSize(numSamples, pointsPerBunch)
+    nFull  = min(nBunch, (numSamples-startIndex) // pointsPerBunch)
+    stop   = startIndex + nFull*pointsPerBunch
+
+    index = np.empty(shape=(numCh, nBunch), dtype=np.int64)
+    if nFull > 0:
+        blocks = waveforms[:, startIndex:stop].reshape(numCh, nFull, pointsPerBunch)
+        np.argmax(blocks, axis=2, out=index[:,:nFull])
+        index[:,:nFull] += startIndex + pointsPerBunch*np.arange(nFull)
+    if nBunch > nFull:
+        index[:,nFull] = stop + np.argmax(waveforms[:, stop:], axis=1)
+    return index
+
+# Sub-sample fit around given sample indices of a (numCh, N) block of waveforms
+#   index = (numCh, M) absolute sample index of each peak to refine
+#   mode  = 'parabolic' : 3-point parabola through the maximum and its neighbours
+#           'gaussian'  : 3-point fit of a Gaussian (parabola in log space),
+#                         falls back to parabolic where a sample is not positive
+#           'centroid'  : amplitude weighted centroid over +/- halfWidth samples (halfWidth >= 1),
+#                         the amplitude is the 3-point parabola through the maximum and its
+#                         neighbours evaluated at the centroid (within +/- 1 sample)
+# Returns (amplitude, position) with shape (numCh, M), where position is the
+# fractional sample index in the waveform
+def interpPeak(waveforms, index, mode='parabolic', halfWidth=1):
+    waveforms  = np.atleast_2d(waveforms)
+    numSamples = waveforms.shape[1]
+    y0 = np.take_along_axis(waveforms, index, axis=1).astype(np.float64)
+
+    if mode == 'centroid':
+        if halfWidth < 1:
+            raise ValueError( f'Centroid half width must be at least 1, got {halfWidth}' )
+        offsets = np.arange(-halfWidth, halfWidth+1)
+        idx = np.clip(index[:,:,np.newaxis] + offsets, 0, numSamples-1)
+        y   = np.take_along_axis(waveforms, idx.reshape(idx.shape[0],-1), axis=1).reshape(idx.shape).astype(np.float64)
+        wsum  = y.sum(axis=2)
+        delta = np.divide((y*offsets).sum(axis=2), wsum, out=np.zeros_like(wsum), where=(wsum!=0))
+
+        # Amplitude of the 3-point parabola at the centroid
+        ym = y[:,:,halfWidth-1]
+        yp = y[:,:,halfWidth+1]
+        d  = np.clip(delta, -1.0, 1.0)
+        amp = y0 + 0.5*(yp-ym)*d + 0.5*(ym-2.0*y0+yp)*d*d
+
+    elif mode in ['parabolic','gaussian']:
+        ym = np.take_along_axis(waveforms, np.maximum(index-1, 0), axis=1).astype(np.float64)
+        yp = np.take_along_axis(waveforms, np.minimum(index+1, numSamples-1), axis=1).astype(np.float64)
+
+        # Parabolic fit
+        den   = ym - 2.0*y0 + yp
+        delta = np.divide(0.5*(ym-yp), den, out=np.zeros_like(den), where=(den!=0))
+        amp   = y0 - 0.25*(ym-yp)*delta
+
+        # Gaussian fit where all three samples are positive
+        if mode == 'gaussian':
+            pos = (ym > 0) & (y0 > 0) & (yp > 0)
+            lm = np.log(ym, out=np.zeros_like(ym), where=pos)
+            l0 = np.log(y0, out=np.zeros_like(y0), where=pos)
+            lp = np.log(yp, out=np.zeros_like(yp), where=pos)
+            den = lm - 2.0*l0 + lp
+            ok  = pos & (den != 0)
+            gDelta = np.divide(0.5*(lm-lp), den, out=np.zeros_like(den), where=ok)
+            gAmp   = np.exp(l0 - 0.25*(lm-lp)*gDelta)
+            delta  = np.where(ok, gDelta, delta)
+            amp    = np.where(ok, gAmp, amp)
+
+        # A neighbour equal to the maximum can push the fit past +/- 0.5 sample
+        np.clip(delta, -0.5, 0.5, out=delta)
+
+    else:
+        raise ValueError( f'Unknown peak interpolation mode: {mode}' )
+
+    return amp, index + delta
+
+# Batched sub-sample peak interpolation of every bunch window (see interpPeak for the modes)
+# Returns (amplitude, position, mask) with shape (numCh, nBunch), where amplitudes
+# below threshold are zero
+def peakInterp(waveforms, startIndex, threshold, pointsPerBunch=12, mode='parabolic', halfWidth=1):
+    waveforms = np.asarray(waveforms)
+    single    = (waveforms.ndim == 1)
+    waveforms = np.atleast_2d(waveforms)
+
+    index = peakIndex(waveforms, startIndex, pointsPerBunch)
+    amp, position = interpPeak(waveforms, index, mode=mode, halfWidth=halfWidth)
+
+    # Apply the noise threshold
+    mask = (amp >= threshold)
+    amp[~mask] = 0.0
+
+    if single:
+        return amp[0], position[0], mask[0]
+    return amp, position, mask
+
+# Robust peak position of every channel over a stack of triggers
+#   waveforms = (numTrig, numCh, N) captures of the same pulse
+# Returns (peak, position, confidence) with shape (numCh,):
+#   position   = median over the triggers of the sub-sample peak position
+#   peak       = position rounded to the nearest sample
+#   confidence = fraction of the triggers whose rounded peak position is peak
+def triggerPeaks(waveforms, mode='parabolic'):
+    waveforms = np.asarray(waveforms)
+    numTrig, numCh, numSamples = waveforms.shape
+
+    # Sample maximum and sub-sample fit of all the channels of all the triggers at once
+    flat  = waveforms.reshape(numTrig*numCh, numSamples)
+    index = np.argmax(flat, axis=1)[:,np.newaxis]
+    _, position = interpPeak(flat, index, mode=mode)
+    position = position.reshape(numTrig, numCh)
+
+    rounded    = np.floor(position+0.5).astype(np.int64)
+    median     = np.median(position, axis=0)
+    peak       = np.clip(np.floor(median+0.5).astype(np.int64), 0, numSamples-1)
+    confidence = np.mean(rounded == peak, axis=0)
+    return peak, median, confidence
@@ -0,0 +1,148 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import numpy as np
+
+# Polynomial (h,v) -> (X,Y) position map
+#
+# Monomials are ordered by total degree, then by decreasing power of h:
+#   1, h, v, h^2, h*v, v^2, h^3, h^2*v, h*v^2, v^3, ...
+# which matches the 10-term 3rd-order chamber coefficient tables.
+class PolynomialMap(object):
+    def __init__(self, order=3):
+        self._order    = order
+        self._numTerms = (order+1)*(order+2)//2
+        self._coeff    = np.zeros(shape=[2,self._numTerms], dtype=np.float64, order='C')
+        self._basis    = None
+
+    @property
+    def order(self):
+        return self._order
+
+    @property
+    def numTerms(self):
+        return self._numTerms
+
+    # Method which loads the X/Y coefficients into a (2, numTerms) matrix
+    def setCoefficients(self, coeffX, coeffY):
+        if (len(coeffX) != self._numTerms) or (len(coeffY) != self._numTerms):
+            raise ValueError( f'PolynomialMap(order={self._order}) expects {self._numTerms} coefficients per axis' )
+        self._coeff[0,:] = coeffX
+        self._coeff[1,:] = coeffY
+
+    # Method which builds the (numTerms, N) monomial basis into a preallocated buffer
+    def basis(self, h, v):
+        size = len(h)
+        if (self._basis is None) or (self._basis.shape[1] != size):
+            self._basis = np.empty(shape=[self._numTerms,size], dtype=np.float64, order='C')
+        B = self._basis
+
+        # Degree 0 term
+        B[0,:] = 1.0
+
+        # Each degree d is built from degree d-1: multiply every term by h, and the last one by v
+        for d in range(1, self._order+1):
+            prev = (d-1)*d//2
+            cur  = d*(d+1)//2
+            np.multiply(B[prev:prev+d,:], h, out=B[cur:cur+d,:])
+            np.multiply(B[prev+d-1,:], v, out=B[cur+d,:])
+
+        return B
+
+    # Method which evaluates X and Y in a single matrix product
+    # Returns a (2, N) array with X in row 0 and Y in row 1
+    def evaluate(self, h, v):
+        return np.matmul(self._coeff, self.basis(h, v))
+
+# 2D lookup table (h,v) -> (X,Y) position map with bilinear interpolation
+#   hGrid, vGrid = uniformly spaced grid points
+#   xTable, yTable = (len(hGrid), len(vGrid)) tables of X and Y
+# Points outside of the grid are clamped to the grid edge.
+class LookupTableMap(object):
+    def __init__(self, hGrid, vGrid, xTable, yTable):
+        hGrid = np.asarray(hGrid, dtype=np.float64)
+        vGrid = np.asarray(vGrid, dtype=np.float64)
+        for grid in [hGrid, vGrid]:
+            if (len(grid) < 2) or not np.allclose(np.diff(grid), grid[1]-grid[0]):
+                raise ValueError( 'LookupTableMap requires uniformly spaced grids with at least 2 points' )
+        self._h0 = hGrid[0]
+        self._v0 = vGrid[0]
+        self._dh = hGrid[1]-hGrid[0]
+        self._dv = vGrid[1]-vGrid[0]
+        self._nh = len(hGrid)
+        self._nv = len(vGrid)
+
+        xTable = np.asarray(xTable, dtype=np.float64)
+        yTable = np.asarray(yTable, dtype=np.float64)
+        if (xTable.shape != (self._nh,self._nv)) or (yTable.shape != (self._nh,self._nv)):
+            raise ValueError( 'LookupTableMap table shape does not match the grids' )
+
+        # Precompute the bilinear coefficients of every cell, so that a single row gather
+        # per point returns everything needed for both axes:
+        #   f(t,u) = c0 + c1*t + c2*u + c3*t*u   with t,u in [0,1] inside the cell
+        T   = np.stack([xTable, yTable], axis=-1)  # (nh, nv, 2)
+        t00 = T[:-1,:-1]
+        t10 = T[1:,:-1]
+        t01 = T[:-1,1:]
+        t11 = T[1:,1:]
+        self._cells = np.ascontiguousarray(np.stack([t00, t10-t00, t01-t00, t11-t10-t01+t00], axis=-1).reshape(-1,2,4))
+
+    # Builds the table by evaluating a PolynomialMap on a size x size grid over [-extent, +extent]
+    @classmethod
+    def fromPolynomial(cls, polyMap, size=257, extent=1.0):
+        grid = np.linspace(-extent, extent, num=size)
+        h, v = np.meshgrid(grid, grid, indexing='ij')
+        xy = polyMap.evaluate(h.ravel(), v.ravel())
+        return cls(grid, grid, xy[0].reshape(size,size), xy[1].reshape(size,size))
+
+    # Loads the table from a calibration file (.npz with 'h', 'v', 'x' and 'y' arrays)
+    @classmethod
+    def fromFile(cls, path):
+        with np.load(path) as cal:
+            return cls(cal['h'], cal['v'], cal['x'], cal['y'])
+
+    # Method which evaluates X and Y with bilinear interpolation
+    # Returns a (2, N) array with X in row 0 and Y in row 1
+    def evaluate(self, h, v):
+        fh = np.minimum(np.maximum((np.asarray(h)-self._h0)/self._dh, 0), self._nh-1)
+        fv = np.minimum(np.maximum((np.asarray(v)-self._v0)/self._dv, 0), self._nv-1)
+        i  = np.minimum(fh.astype(np.int64), self._nh-2)
+        j  = np.minimum(fv.astype(np.int64), self._nv-2)
+        t  = (fh - i)[:,np.newaxis]
+        u  = (fv - j)[:,np.newaxis]
+
+        c = self._cells.take(i*(self._nv-1) + j, axis=0)  # (N, 2, 4)
+        xy = c[:,:,0] + t*c[:,:,1] + u*(c[:,:,2] + t*c[:,:,3])
+        return xy.T
+
+# Compares a candidate position map against a reference map on (h,v) points
+# Returns a dictionary with the mean evaluation times (seconds) and the X/Y residuals
+def comparePositionMaps(reference, candidate, h, v, repeat=100):
+    import time
+
+    def timeit(posMap):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            xy = posMap.evaluate(h, v)
+        return xy, (time.perf_counter()-start)/repeat
+
+    refXY, refTime = timeit(reference)
+    canXY, canTime = timeit(candidate)
+    residual = canXY - refXY
+
+    return {
+        'referenceTime' : refTime,
+        'candidateTime' : canTime,
+        'speedup'       : refTime/canTime if canTime > 0 else np.inf,
+        'residualRmsX'  : float(np.sqrt(np.mean(residual[0]**2))),
+        'residualRmsY'  : float(np.sqrt(np.mean(residual[1]**2))),
+        'residualMaxX'  : float(np.max(np.abs(residual[0]))),
+        'residualMaxY'  : float(np.max(np.abs(residual[1]))),
+    }
@@ -10,47 +10,142 @@
 
 import rogue.interfaces.stream as ris
 import pyrogue as pr
+import numpy as np
+import threading
 import time
 import struct
 
-class PrependLocalTime(ris.Master, ris.Slave):
-    def __init__(self,**kwargs):
+# Local time header prepended to the fault captures
+#
+# Version 0 (8 bytes)  : time.time() (Float64), the original layout
+# Version 1 (32 bytes) : written by Root (AmpFaultWithHdr), read by DatFile and the analysis notebooks
+#   magic      (8 bytes) = LocalTimeMagic, a Float64 NaN so that it can never be read as a version 0 time
+#   version    (UInt16)
+#   headerSize (UInt16)  = 32
+#   payload    (UInt32)  = size of the capture (bytes)
+#   timeNs     (Int64)   = time.time_ns()
+#   sequence   (UInt64)  = frame counter since the start of the process
+LocalTimeMagic    = b'KEKLT\x00\xf8\x7f'
+LocalTimeVersion  = 1
+LocalTimeHeader   = struct.Struct('<8sHHIqQ')
+LocalTimeHeaderV0 = struct.Struct('<d')
+
+# Returns (version, timestamp, sequence, headerSize) of the header at the start of a record payload,
+# sequence is -1 for a version 0 header
+def parseLocalTimeHeader(data):
+    data = bytes(data[:LocalTimeHeader.size])
+    if (len(data) == LocalTimeHeader.size) and (data[:8] == LocalTimeMagic):
+        _, version, hdrSize, _, timeNs, seq = LocalTimeHeader.unpack(data)
+        return version, timeNs*1.0E-9, seq, hdrSize
+    return 0, LocalTimeHeaderV0.unpack(data[:8])[0], -1, LocalTimeHeaderV0.size
+
+class PrependLocalTime(pr.Device, ris.Master, ris.Slave):
+    #   headerVersion = 0 (8-byte time.time() header) or 1 (32-byte header)
+    def __init__(self, headerVersion=0, **kwargs):
+        pr.Device.__init__(self, **kwargs)
         ris.Slave.__init__(self)
         ris.Master.__init__(self)
 
+        if headerVersion not in (0, LocalTimeVersion):
+            raise ValueError( f'Unsupported local time header version {headerVersion}' )
+
+        # Not saving config/state to YAML
+        guiGroups = ['NoStream','NoState','NoConfig']
+
+        self._version = headerVersion
+        self._hdrSize = LocalTimeHeader.size if headerVersion else LocalTimeHeaderV0.size
+        self._hdr     = bytearray(self._hdrSize)
+
+        # Reused capture buffer, grown to the largest frame seen
+        self._ibData  = np.zeros(shape=0, dtype=np.uint8)
+        self._seq     = 0
+        self._lock    = threading.Lock()
+
+        for name,description,typeStr in [
+                ('FrameCount', 'Number of frames forwarded',                           'UInt64'),
+                ('ByteCount',  'Number of capture bytes forwarded',                    'UInt64'),
+                ('Sequence',   'Sequence number of the last frame',                    'UInt64'),
+                ('CopyCount',  'Number of capture payload copies: 2 per frame (frame.read() into a reused buffer, then obFrame.write()), not 1: the rogue Python API has no frame-to-frame copy', 'UInt64'),
+            ]:
+            self.add(pr.LocalVariable(
+                name        = name,
+                description = description,
+                typeStr     = typeStr,
+                mode        = 'RO',
+                value       = 0,
+                groups      = guiGroups,
+            ))
+
+        self.add(pr.LocalVariable(
+            name        = 'ProcessTime',
+            description = 'Time spent in _acceptFrame() for the last frame',
+            typeStr     = 'Float',
+            mode        = 'RO',
+            units       = 'microsec',
+            disp        = '{:1.1f}',
+            value       = 0.0,
+            groups      = guiGroups,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'Throughput',
+            description = 'Capture bytes per second through _acceptFrame() for the last frame',
+            typeStr     = 'Float',
+            mode        = 'RO',
+            units       = 'MB/s',
+            disp        = '{:1.1f}',
+            value       = 0.0,
+            groups      = guiGroups,
+        ))
+
     # Method which is called when a frame is received
     def _acceptFrame(self,frame):
+        t0 = time.perf_counter()
 
         # First it is good practice to hold a lock on the frame data.
-        with frame.lock():
+        with frame.lock(), self._lock:
 
             # Next we can get the size of the inbound frame payload
             ibSize = frame.getPayload()
 
-            # To access the data we need to create a byte array to hold the data
-            ibData = bytearray(ibSize)
+            # Set outbound frame payload to be header size bytes more than inbound
+            obSize = ibSize + self._hdrSize
 
-            # Next we read the frame data into the byte array, from offset 0
-            frame.read(ibData,0)
+            # Grow the capture buffer (no allocation once the largest capture was seen)
+            if len(self._ibData) < ibSize:
+                self._ibData = np.zeros(shape=ibSize, dtype=np.uint8)
+            ibData = self._ibData[:ibSize]
 
-            # Set outbound frame payload to be 8 bytes more than inbound
-            obSize = ibSize + 8
+            # Read the inbound frame (1st copy)
+            frame.read(ibData, 0)
 
             # Here we request a new frame capable of holding `obSize` bytes
             obFrame = self._reqFrame(obSize, True)
 
-            # Create a new byte array to hold the outbound data
-            obData = bytearray(obSize)
-
             # Add the header ("localtime") to the outbound frame at offset 0 bytes
-            hdr = bytearray(struct.pack("<d", time.time() ))
-            obFrame.write(hdr,0)
+            if self._version:
+                LocalTimeHeader.pack_into(self._hdr, 0, LocalTimeMagic, LocalTimeVersion, self._hdrSize, ibSize, time.time_ns(), self._seq)
+            else:
+                LocalTimeHeaderV0.pack_into(self._hdr, 0, time.time())
+            obFrame.write(self._hdr, 0)
+
+            # Write the inbound frame right after the header (2nd copy)
+            obFrame.write(ibData, self._hdrSize)
+
+            seq = self._seq
+            self._seq += 1
 
-            # Write the inbound frame to the outbound frame at offset 8 bytes
-            obFrame.write(ibData,8)
+        # Send the frame
+        self._sendFrame(obFrame)
 
-            # Send the frame
-            self._sendFrame(obFrame)
+        # Update the counters
+        dt = time.perf_counter()-t0
+        self.FrameCount.set(self.FrameCount.value()+1)
+        self.ByteCount.set(self.ByteCount.value()+ibSize)
+        self.Sequence.set(seq)
+        self.CopyCount.set(self.CopyCount.value()+2)
+        self.ProcessTime.set(dt*1.0E+6)
+        self.Throughput.set(ibSize/dt*1.0E-6 if dt > 0 else 0.0)
 
     def __rshift__(self,other):
         pr.streamConnect(self,other)
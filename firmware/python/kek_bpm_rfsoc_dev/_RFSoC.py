@@ -16,10 +16,11 @@ import kek_bpm_rfsoc_dev                             as rfsoc
 
 class RFSoC(pr.Device):
     def __init__(self,
-            sampleRate  = 0.0,
-            ampDispProc = None,
-            SSR         = 16,
-            boardType   = None,
+            sampleRate   = 0.0,
+            ampDispProc  = None,
+            eventBuilder = None,
+            SSR          = 16,
+            boardType    = None,
         **kwargs):
         super().__init__(**kwargs)
 
@@ -36,11 +37,12 @@ class RFSoC(pr.Device):
             ))
 
         self.add(rfsoc.Application(
-            offset      = 0xA000_0000,
-            sampleRate  = sampleRate,
-            ampDispProc = ampDispProc,
-            SSR         = SSR,
-            boardType   = boardType,
-            expand      = True,
-            enabled     = False, # Do not configure until after LMK/LMX is up
+            offset       = 0xA000_0000,
+            sampleRate   = sampleRate,
+            ampDispProc  = ampDispProc,
+            eventBuilder = eventBuilder,
+            SSR          = SSR,
+            boardType    = boardType,
+            expand       = True,
+            enabled      = False, # Do not configure until after LMK/LMX is up
         ))
@@ -9,22 +9,47 @@
 #-----------------------------------------------------------------------------
 
 import pyrogue as pr
+import rogue.interfaces.memory as rim
+import numpy as np
+import collections
+import threading
 import time
 
+import kek_bpm_rfsoc_dev as rfsoc
+
 class ReadoutCtrl(pr.Device):
     def __init__(self,
-            sampleRate  = 0.0,
-            ampDispProc = None,
-            SSR         = 16,
-            boardType   = None,
+            sampleRate   = 0.0,
+            ampDispProc  = None,
+            eventBuilder = None,
+            SSR          = 16,
+            boardType    = None,
         **kwargs):
         super().__init__(**kwargs)
 
         self.smplTime = 1/sampleRate
         self.ampDispProc = ampDispProc
+        self.eventBuilder = eventBuilder
         self._LiveDispTrigCnt = 0
         self._SSR = SSR
 
+        # Event driven live display trigger (with an EventBuilder)
+        self._trigSeq      = 0
+        self._trigTime     = 0.0
+        self._waitingData  = False
+        self._eventTimes   = collections.deque()
+        self._bucket       = rfsoc.TokenBucket(rate=1.0, burst=1)
+        self._rearm        = threading.Condition()
+        self._rearmPending = False
+        self._schedRun     = False
+        self._scheduler    = None
+
+        # Delay tuning: the events are handed to collectTriggers() instead of the display
+        self._tuning       = False
+        self._tuneMaxIter  = 10
+        self._tuneBuffer   = None
+        self._tuneDone     = threading.Event()
+
         self.add(pr.RemoteVariable(
             name         = 'LiveDispTrigRaw',
             description  = 'Live Display Trigger',
@@ -58,8 +83,85 @@ class ReadoutCtrl(pr.Device):
             hidden = False,
         ))
 
+        #-----------------------------------------------------------------------------
+        # Event driven live display trigger: rearmed as soon as the previous
+        # four-channel event has been consumed, limited by a token bucket
+        #-----------------------------------------------------------------------------
+
+        self.add(pr.LocalVariable(
+            name        = 'LiveDispMaxRate',
+            description = 'Maximum live display trigger rate (0 = unlimited)',
+            typeStr     = 'Float',
+            units       = 'Hz',
+            value       = 1.0,
+            minimum     = 0.0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'LiveDispBurst',
+            description = 'Number of triggers allowed back to back after an idle period',
+            typeStr     = 'UInt8',
+            value       = 1,
+            minimum     = 1,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'LiveDispTimeout',
+            description = 'Trigger again if no event was received after this time',
+            typeStr     = 'Float',
+            units       = 's',
+            value       = 1.0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'LiveDispRate',
+            description = 'Achieved live display event rate',
+            typeStr     = 'Float',
+            mode        = 'RO',
+            units       = 'Hz',
+            disp        = '{:1.1f}',
+            value       = 0.0,
+            groups      = ['NoStream','NoState','NoConfig'],
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'LiveDispLatency',
+            description = 'Time between the trigger and the last channel of its event',
+            typeStr     = 'Float',
+            mode        = 'RO',
+            units       = 'microsec',
+            disp        = '{:1.1f}',
+            value       = 0.0,
+            groups      = ['NoStream','NoState','NoConfig'],
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'LiveDispTimeoutCnt',
+            description = 'Number of triggers without an event within LiveDispTimeout',
+            typeStr     = 'UInt32',
+            mode        = 'RO',
+            value       = 0,
+            groups      = ['NoStream','NoState','NoConfig'],
+        ))
+
+        self.LiveDispMaxRate.addListener(self._bucketChanged)
+        self.LiveDispBurst.addListener(self._bucketChanged)
+        self.EnableSoftTrig.addListener(self._softTrigChanged)
+
+        if self.eventBuilder is not None:
+            self.eventBuilder.addConsumer(self._liveDispEvent)
+
         @self.command(description  = 'Force a DAC signal generator trigger from software',hidden=True)
         def getWaveformBurst():
+            # tuneAmpDelays() fires its own triggers
+            if self._tuning:
+                return
+
+            # Event driven mode: the scheduler rearms the trigger, only recover lost events here
+            if self.eventBuilder is not None:
+                self._liveDispWatchdog()
+                return
+
             # Check if data received from all sockets
             if self.ampDispProc[0].NewDataReady.get() and self.ampDispProc[1].NewDataReady.get() and self.ampDispProc[2].NewDataReady.get() and self.ampDispProc[3].NewDataReady.get():
                 for i in range(4):
@@ -73,8 +175,7 @@ class ReadoutCtrl(pr.Device):
 
             # Check if we execute software trigger
             if self.EnableSoftTrig.get() and armTrig:
-                self.LiveDispTrig()
-                self._LiveDispTrigCnt = self._LiveDispTrigCnt + 1
+                self._fireLiveDisp()
 
         self.add(pr.LocalVariable(
             name         = 'GetWaveformBurst',
@@ -286,42 +387,243 @@ class ReadoutCtrl(pr.Device):
             linkedSet    = lambda value, write: self.FaultTrigDlyRaw.set(int(value/(1.0/254.5))-1),
         ))
 
+        self.add(pr.LocalVariable(
+            name        = 'AmpDelayTriggers',
+            description = 'Number of triggers per tuneAmpDelays() iteration',
+            typeStr     = 'UInt8',
+            value       = 8,
+            minimum     = 1,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'AmpDelayConfidence',
+            description = 'Fraction of the triggers agreeing with the tuned peak position (worst enabled channel)',
+            typeStr     = 'Float',
+            mode        = 'RO',
+            disp        = '{:1.2f}',
+            value       = 0.0,
+            groups      = ['NoStream','NoState','NoConfig'],
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'AmpDelayTuneTime',
+            description = 'Duration of the last tuneAmpDelays()',
+            typeStr     = 'Float',
+            mode        = 'RO',
+            units       = 's',
+            disp        = '{:1.3f}',
+            value       = 0.0,
+            groups      = ['NoStream','NoState','NoConfig'],
+        ))
+
         @self.command(description  = 'Tuning the amplitude delays before the Position calculating',hidden=False)
         def tuneAmpDelays(arg):
             chMask = int(arg)
-#            print(chMask)
             print('ReadoutCtrl.tuneAmpDelays()')
-            peak  = [0,1,2,3]
-
-            # retry until locked
-            while max(peak) - min(peak) > 1:
-
-                # Reset the delays
-                [self.FineDelay[i].set(0) for i in range(4)]
-                [self.CourseDelay[i].set(0) for i in range(4)]
-                time.sleep(1)
-
-                # Trigger 1st event and check the pattern
-                cnt = self._LiveDispTrigCnt
-                while cnt == self._LiveDispTrigCnt:
-                    time.sleep(0.01)
-
-                finedelay = [self.ampDispProc[i].peaksearch() % self._SSR for i in range(4)]
-                intdev = [self.ampDispProc[i].peaksearch() // self._SSR for i in range(4)]
-                coursedelay = [max(intdev) - intdev[i] for i in range(4)]
-                print( f'peak array = {[self.ampDispProc[i].peaksearch() for i in range(4)]}' )
-                print( f'setting finedelays = {finedelay}' )
-                print( f'setting coursedelays = {coursedelay}' )
-                [self.FineDelay[i].set(finedelay[i]) for i in range(4)]
-                [self.CourseDelay[i].set(coursedelay[i]) for i in range(4)]
-                time.sleep(1)
-                # Trigger 2nd event and check the lock pattern (all zeros)
-                cnt = self._LiveDispTrigCnt
-                while cnt == self._LiveDispTrigCnt:
-                    time.sleep(0.01)
-                peak = [self.ampDispProc[i].peaksearch() for i in range(4)]
-                for i in range(4):
-                    if (chMask>>i)&0x1  != 0x1:
-                        print( f'Skipping channel = {i}')
-                        peak[i] = peak[0] if i!=0 else peak[3]
-                print( f'Checking peak alignment = {peak}' )
+            t0 = time.perf_counter()
+            numTrig = self.AmpDelayTriggers.value()
+            enabled = [i for i in range(4) if (chMask>>i)&0x1 == 0x1]
+            for i in range(4):
+                if i not in enabled:
+                    print( f'Skipping channel = {i}')
+
+            self._tuning = True
+            try:
+                # retry until locked
+                for _ in range(self._tuneMaxIter):
+
+                    # Reset the delays and find the peaks
+                    self.setAmpDelays([0]*4, [0]*4)
+                    peak, position, confidence = rfsoc.triggerPeaks(self.collectTriggers(numTrig, self._SSR*4))
+
+                    finedelay = [int(peak[i]) % self._SSR for i in range(4)]
+                    intdev = [int(peak[i]) // self._SSR for i in range(4)]
+                    coursedelay = [max(intdev) - intdev[i] for i in range(4)]
+                    print( f'peak array = {peak.tolist()} (sub-sample {np.round(position,2).tolist()}, confidence {np.round(confidence,2).tolist()})' )
+                    print( f'setting finedelays = {finedelay}' )
+                    print( f'setting coursedelays = {coursedelay}' )
+                    self.setAmpDelays(finedelay, coursedelay)
+
+                    # Check the lock pattern (all the peaks aligned)
+                    peak, _, check = rfsoc.triggerPeaks(self.collectTriggers(numTrig, self._SSR*4))
+                    print( f'Checking peak alignment = {peak.tolist()}' )
+                    if len(enabled) > 0:
+                        self.AmpDelayConfidence.set(float(min(min(confidence[enabled]), min(check[enabled]))))
+                    if (len(enabled) == 0) or (max(peak[enabled]) - min(peak[enabled]) <= 1):
+                        break
+                else:
+                    print( f'ReadoutCtrl.tuneAmpDelays(): not locked after {self._tuneMaxIter} iterations' )
+            finally:
+                self._tuning = False
+                if self.EnableSoftTrig.value() and (self.eventBuilder is not None):
+                    self._requestRearm()
+                self.AmpDelayTuneTime.set(time.perf_counter()-t0)
+                print( f'tuneAmpDelays done in {self.AmpDelayTuneTime.value():.3f} s, confidence = {self.AmpDelayConfidence.value():.2f}' )
+
+    def _start(self):
+        super()._start()
+        if self.eventBuilder is not None:
+            self._schedRun  = True
+            self._scheduler = threading.Thread(target=self._liveDispScheduler, daemon=True)
+            self._scheduler.start()
+
+    def _stop(self):
+        if self._scheduler is not None:
+            with self._rearm:
+                self._schedRun = False
+                self._rearm.notify()
+            self._scheduler.join()
+            self._scheduler = None
+        super()._stop()
+
+    # Method which fires the live display trigger
+    def _fireLiveDisp(self):
+        if self.eventBuilder is not None:
+            self._trigSeq = self.eventBuilder.arm()
+        self._trigTime    = time.perf_counter()
+        self._waitingData = True
+        self.LiveDispTrig()
+        self._LiveDispTrigCnt = self._LiveDispTrigCnt + 1
+
+    # Method which sets the fine and course delays of the four channels in one batched transaction:
+    # the eight shadow values are updated first, then each register word (FineDelay at 0x14,
+    # CourseDelay at 0x18) is written once, verified once and checked
+    def setAmpDelays(self,fine,course):
+        variables = [self.FineDelay[i] for i in range(4)] + [self.CourseDelay[i] for i in range(4)]
+        for var,value in zip(variables, list(fine)+list(course)):
+            var.set(int(value), write=False)
+
+        # Distinct blocks, in variable order
+        blocks = list(dict.fromkeys(var._block for var in variables))
+        for block in blocks:
+            pr.startTransaction(block, type=rim.Write, forceWr=True)
+        for block in blocks:
+            pr.startTransaction(block, type=rim.Verify)
+        for block in blocks:
+            pr.checkTransaction(block)
+
+    # Method which fires num triggers and returns the first size samples of each event, shape (num, 4, size)
+    #   timeout = seconds to wait for each event before firing again
+    def collectTriggers(self,num,size,timeout=0.5,retries=3):
+        data = np.zeros(shape=[num,4,size], dtype=np.int16, order='C')
+        for k in range(num):
+            for _ in range(retries+1):
+                if self._collectTrigger(data[k], timeout):
+                    break
+            else:
+                raise TimeoutError( f'ReadoutCtrl.collectTriggers(): no live display event after {retries+1} triggers' )
+        return data
+
+    # Method which fires one trigger and copies its event into buff
+    # Returns False on timeout
+    def _collectTrigger(self,buff,timeout):
+        # Event driven: the event is copied by _liveDispEvent()
+        if self.eventBuilder is not None:
+            self._tuneDone.clear()
+            self._tuneBuffer = buff
+            try:
+                self._fireLiveDisp()
+                return self._tuneDone.wait(timeout)
+            finally:
+                self._tuneBuffer = None
+
+        # Without an event builder: wait for the four receivers
+        for i in range(4):
+            self.ampDispProc[i].UpdateWaveform()
+        self._fireLiveDisp()
+        stop = time.perf_counter() + timeout
+        while not all(self.ampDispProc[i].NewDataReady.value() for i in range(4)):
+            if time.perf_counter() > stop:
+                return False
+            time.sleep(0.001)
+        for i in range(4):
+            waveform = self.ampDispProc[i]._waveformData
+            size = min(buff.shape[1], len(waveform))
+            buff[i,:size] = waveform[:size]
+        return True
+
+    # Method which asks the scheduler for the next trigger
+    def _requestRearm(self):
+        with self._rearm:
+            self._rearmPending = True
+            self._rearm.notify()
+
+    # Scheduler thread: fires the trigger when rearm is requested and a token is available
+    def _liveDispScheduler(self):
+        while True:
+            with self._rearm:
+                while self._schedRun and not self._rearmPending:
+                    self._rearm.wait()
+                if not self._schedRun:
+                    return
+                self._rearmPending = False
+
+                # Wait for a token (interrupted by _stop())
+                wait = self._bucket.take()
+                while self._schedRun and (wait > 0):
+                    self._rearm.wait(wait)
+                    wait = self._bucket.take()
+                if not self._schedRun:
+                    return
+
+            if self.EnableSoftTrig.value() and not self._tuning:
+                self._fireLiveDisp()
+
+    # Method which is called by the EventBuilder with each complete event
+    def _liveDispEvent(self,event):
+        # Ignore the events of an older trigger
+        if event.seq != self._trigSeq:
+            return
+
+        # Delay tuning: copy the event for collectTriggers()
+        buff = self._tuneBuffer
+        if buff is not None:
+            size = min(buff.shape[1], event.waveforms.shape[1])
+            buff[:,:size] = event.waveforms[:,:size]
+            self._tuneDone.set()
+            return
+
+        # Update the waveform PVs with the matched event (not the last frame of each receiver)
+        for i in range(4):
+            self.ampDispProc[i].UpdateWaveform(event.waveforms[i])
+
+        now = time.perf_counter()
+        self._waitingData = False
+        self.LiveDispLatency.set((event.tLast-self._trigTime)*1.0E+6)
+        self._eventTimes.append(now)
+        self._updateRate(now)
+
+        # The event has been consumed: rearm
+        if self.EnableSoftTrig.value():
+            self._requestRearm()
+
+    # Method which updates the achieved event rate over the last 2 seconds
+    def _updateRate(self,now):
+        while self._eventTimes and (now-self._eventTimes[0] > 2.0):
+            self._eventTimes.popleft()
+        times = self._eventTimes
+        rate  = (len(times)-1)/(times[-1]-times[0]) if (len(times) > 1) and (times[-1] > times[0]) else 0.0
+        self.LiveDispRate.set(rate)
+
+    # Method which recovers from lost events (called by the GetWaveformBurst poll)
+    def _liveDispWatchdog(self):
+        now = time.perf_counter()
+        self._updateRate(now)
+        if not self.EnableSoftTrig.value():
+            return
+        if self._waitingData:
+            if now-self._trigTime > self.LiveDispTimeout.value():
+                self.LiveDispTimeoutCnt.set(self.LiveDispTimeoutCnt.value()+1)
+                self._requestRearm()
+        else:
+            self._requestRearm()
+
+    # Method which is called when the rate limit changes
+    def _bucketChanged(self,path,value):
+        self._bucket.rate  = self.LiveDispMaxRate.value()
+        self._bucket.burst = self.LiveDispBurst.value()
+
+    # Method which is called when EnableSoftTrig changes
+    def _softTrigChanged(self,path,value):
+        if value and (self.eventBuilder is not None):
+            self._requestRearm()
@@ -11,15 +11,41 @@
 import pyrogue as pr
 import numpy as np
 import axi_soc_ultra_plus_core.rfsoc_utility as rfsoc_utility
+import kek_bpm_rfsoc_dev as rfsoc
 
 # Class for streaming RX
 class RingBufferProcessor(rfsoc_utility.RingBufferProcessor):
     # Init method must call the parent class init
-    def __init__( self,faultDisp=False,SSR=16,**kwargs):
+    #   directRead = read the frame payload straight into a preallocated buffer (when the Data variable is hidden)
+    def __init__( self,faultDisp=False,SSR=16,directRead=True,**kwargs):
         super().__init__(**kwargs)
         self._waveformData = np.zeros(shape=self._maxSize, dtype=np.int16, order='C')
         self._faultDisp = faultDisp
         self._SSR = SSR
+        self._directRead = directRead
+
+        # Ping-pong receive buffers: a frame is read into the buffer that is not published,
+        # which then becomes the WaveformData value (no further copy)
+        self._rxBuffers = [np.zeros(shape=self._maxSize, dtype=np.int16, order='C') for _ in range(2)]
+        self._rxIndex   = 0
+
+        self.add(pr.LocalVariable(
+            name        = 'FrameCopies',
+            description = 'Number of payload copies made by process() for the last frame',
+            typeStr     = 'UInt32',
+            mode        = 'RO',
+            value       = 0,
+            groups      = ['NoStream','NoState','NoConfig'],
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'CopyCount',
+            description = 'Total number of payload copies made by process()',
+            typeStr     = 'UInt64',
+            mode        = 'RO',
+            value       = 0,
+            groups      = ['NoStream','NoState','NoConfig'],
+        ))
         self._timeStepsFine   = np.linspace(0, self._timeBin*(self._maxSize-1),   num=self._maxSize)
         self._timeStepsCourse = np.linspace(0, self._timeBin*(self._maxSize-1)*8, num=self._maxSize)
 
@@ -30,11 +56,25 @@ class RingBufferProcessor(rfsoc_utility.RingBufferProcessor):
     # Method which is called when a frame is received
     def process(self,frame):
         with self.root.updateGroup():
-            pr.DataReceiver.process(self,frame)
+            accept = not(self.NewDataReady.value()) or (self._faultDisp)
+
+            if self._directRead and self.Data.hidden:
+                # Skip the Data variable: the frame is only read when it is used
+                copies = self._readFrame(frame) if accept else 0
+
+                # Same receive flag as pr.DataReceiver.process()
+                self.Updated.set(True,write=True)
+            else:
+                pr.DataReceiver.process(self,frame)
+                copies = 1
 
-            # Get data from frame
-            if not(self.NewDataReady.value()) or (self._faultDisp):
-                self._waveformData = self.Data.value()[:].view(np.int16)
+                # Get data from frame
+                if accept:
+                    self._waveformData = self.Data.value()[:].view(np.int16)
+
+            # Update the copy counters
+            self.FrameCopies.set(copies)
+            self.CopyCount.set(self.CopyCount.value()+copies)
 
             # Set the flag
             self.NewDataReady.set(True)
@@ -43,8 +83,26 @@ class RingBufferProcessor(rfsoc_utility.RingBufferProcessor):
             if self._faultDisp:
                 self.WaveformData.set(self._waveformData,write=True)
 
+    # Method which reads the frame payload into the next receive buffer
+    # Returns the number of payload copies
+    def _readFrame(self,frame):
+        size = frame.getPayload() // 2
+
+        # Grow the receive buffers if the frame is larger than maxSize
+        if size > len(self._rxBuffers[0]):
+            self._rxBuffers = [np.zeros(shape=size, dtype=np.int16, order='C') for _ in range(2)]
+
+        self._rxIndex ^= 1
+        buff = self._rxBuffers[self._rxIndex][:size]
+        frame.read(buff.view(np.uint8),0)
+        self._waveformData = buff
+        return 1
+
     # Method which updates the waveform PV from external function
-    def UpdateWaveform(self):
+    #   waveform = data to publish instead of the last received frame (copied)
+    def UpdateWaveform(self,waveform=None):
+        if waveform is not None:
+            self._waveformData = np.array(waveform, dtype=np.int16)
         self.WaveformData.set(self._waveformData,write=True)
         self.NewDataReady.set(False)
 
@@ -52,3 +110,9 @@ class RingBufferProcessor(rfsoc_utility.RingBufferProcessor):
     def peaksearch(self):
         max_index = np.argmax(self._waveformData[:self._SSR*4])
         return int(max_index)
+
+    # Method which finds the sub-sample peak position (mode = 'parabolic', 'gaussian' or 'centroid')
+    def peaksearchFine(self,mode='parabolic'):
+        index = np.array([[self.peaksearch()]])
+        _,position = rfsoc.interpPeak(self._waveformData, index, mode=mode)
+        return float(position[0,0])
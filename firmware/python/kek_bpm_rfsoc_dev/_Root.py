@@ -36,6 +36,7 @@ class Root(pr.Root):
             top_level  = '',
             bpmFreqMHz = 0   , # 0MHz (DDC bypass), 2000 MHz, 1000 MHz or 500MHz
             zmqSrvEn   = True, # Flag to include the ZMQ server
+            streamProcEn = False, # Flag to include the BPM stream processor (AMP live display events)
             chMask     = 0xF,
             boardType  = None, # Either zcu111 or zcu208 or rfsoc4x2
             **kwargs):
@@ -89,7 +90,11 @@ class Root(pr.Root):
         self.ampFaultBuff =  stream.TcpClient(ip,10000+2*(8))
 
         # Used to prepend the local time into a stream
-        self.ampFaultWithHdr = rfsoc.PrependLocalTime()
+        self.ampFaultWithHdr = rfsoc.PrependLocalTime(
+            name          = 'AmpFaultWithHdr',
+            headerVersion = 1,
+            hidden        = True,
+        )
 
         ##################################################################################
 
@@ -119,7 +124,7 @@ class Root(pr.Root):
                 description = 'Fifo to prevent back pressuring stream',
                 maxDepth    = 1, # Drop if more than 1 frame in FIFO
                 trimSize    = 0, # No triming
-                noCopy      = False, # Create copy of buffer
+                noCopy      = True, # Queue the received frame (the processors copy the payload out)
                 )
 
             self.ampDispFifo[i] = pr.interfaces.stream.Fifo(
@@ -127,14 +132,25 @@ class Root(pr.Root):
                 description = 'Fifo to prevent back pressuring stream',
                 maxDepth    = 1, # Drop if more than 1 frame in FIFO
                 trimSize    = 0, # No triming
-                noCopy      = False, # Create copy of buffer
+                noCopy      = True, # Queue the received frame (the processors copy the payload out)
                 )
 
+        # Coherent four-channel events of the AMP live display path
+        self.ampEventBuilder = rfsoc.EventBuilder(
+            name    = 'AmpEventBuilder',
+            maxSize = self.SSR*2**9,
+        )
+
         self.ampFaultProc = rfsoc.FaultRingBufferProcessor(
             name   = 'AmpFaultProcessor',
             hidden = True,
         )
 
+        self.ampFaultBunchProc = rfsoc.FaultBunchProcessor(
+            name   = 'AmpFaultBunchProcessor',
+            hidden = True,
+        )
+
         ##################################################################################
 
         # Connect the rogue stream arrays
@@ -147,12 +163,32 @@ class Root(pr.Root):
             # AMP Live Display Path
             self.ampDispBuff[i] >> self.ampDispFifo[i] >> self.ampDispProc[i]
             self.add(self.ampDispProc[i])
+            self.ampDispFifo[i] >> self.ampEventBuilder.getChannel(i)
+
+        # AMP Live Display Event Builder
+        self.add(self.ampEventBuilder)
+
+        # BPM stream processor: peak search and position calculation of every AMP live display event,
+        # results frames recorded on channel 17
+        if streamProcEn:
+            self.ampStreamProc = rfsoc.StreamProcessor(
+                name         = 'AmpStreamProcessor',
+                waveformRx   = self.ampDispProc,
+                eventBuilder = self.ampEventBuilder,
+            )
+            self.ampStreamProc >> self.dataWriter.getChannel(17)
+            self.add(self.ampStreamProc)
 
         # AMP Fault Display Path
         self.ampFaultBuff >> self.ampFaultWithHdr >> self.dataWriter.getChannel(i+12)
+        self.add(self.ampFaultWithHdr)
         self.ampFaultBuff >> self.ampFaultProc
         self.add(self.ampFaultProc)
 
+        # AMP Fault bunch-by-bunch extraction (derived stream only sent when StreamEnable=True)
+        self.ampFaultBuff >> self.ampFaultBunchProc >> self.dataWriter.getChannel(16)
+        self.add(self.ampFaultBunchProc)
+
         ##################################################################################
         ##                              Register Access
         ##################################################################################
@@ -182,13 +218,14 @@ class Root(pr.Root):
 
         # Added the RFSoC HW device
         self.add(rfsoc.RFSoC(
-            memBase     = self.memMap,
-            sampleRate  = self.sampleRate,
-            ampDispProc = [self.AmpDispProcessor[x] for x in range(4)],
-            SSR         = self.SSR,
-            offset      = 0x04_0000_0000, # Full 40-bit address space
-            expand      = True,
-            boardType   = self.boardType,
+            memBase      = self.memMap,
+            sampleRate   = self.sampleRate,
+            ampDispProc  = [self.AmpDispProcessor[x] for x in range(4)],
+            eventBuilder = self.ampEventBuilder,
+            SSR          = self.SSR,
+            offset       = 0x04_0000_0000, # Full 40-bit address space
+            expand       = True,
+            boardType    = self.boardType,
         ))
 
         ##################################################################################
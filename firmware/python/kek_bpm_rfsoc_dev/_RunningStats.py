@@ -0,0 +1,72 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import numpy as np
+
+# Element-wise running statistics (Welford) over a stream of equal length arrays
+#   window = 0 : cumulative mean/variance since the last reset
+#   window > 0 : the sample weight never drops below 1/window, so older events
+#                are forgotten with an effective memory of `window` events
+#   decay      : weight of the newest event in the exponential moving average
+# Min/Max are tracked since the last reset.
+class RunningStats(object):
+    def __init__(self, window=0, decay=0.1):
+        self.window = window
+        self.decay  = decay
+        self.reset()
+
+    # Method which clears the statistics
+    def reset(self):
+        self.count = 0
+        self.mean  = None
+        self.var   = None
+        self.min   = None
+        self.max   = None
+        self.ema   = None
+        self._delta = None
+
+    # Method which adds one event to the statistics
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+
+        # First event (or the number of elements changed)
+        if (self.mean is None) or (self.mean.shape != x.shape):
+            self.count  = 1
+            self.mean   = np.array(x)
+            self.var    = np.zeros_like(self.mean)
+            self.min    = np.array(x)
+            self.max    = np.array(x)
+            self.ema    = np.array(x)
+            self._delta = np.empty_like(self.mean)
+            return
+
+        self.count += 1
+        n = self.count if (self.window <= 0) else min(self.count, self.window)
+        w = 1.0/n
+
+        # Welford update in variance form:
+        #   mean += w*delta
+        #   var   = (1-w)*(var + w*delta^2)
+        delta = np.subtract(x, self.mean, out=self._delta)
+        self.mean += w*delta
+        np.multiply(delta, delta, out=delta)
+        delta *= w
+        self.var += delta
+        self.var *= (1.0-w)
+
+        np.minimum(self.min, x, out=self.min)
+        np.maximum(self.max, x, out=self.max)
+
+        # Exponential moving average
+        self.ema += self.decay*(x-self.ema)
+
+    # Method which returns the (population) standard deviation
+    def std(self):
+        return None if self.var is None else np.sqrt(self.var)
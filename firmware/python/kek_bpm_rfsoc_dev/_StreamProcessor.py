@@ -13,23 +13,64 @@ import rogue.interfaces.stream as ris
 
 import numpy as np
 import math
-import struct
+import queue
+import threading
+import time
+
+import kek_bpm_rfsoc_dev as rfsoc
+
+# Parses a ResultsFrameGen() frame payload (bytes, bytearray or numpy array)
+# Returns (eventCnt, xpos, ypos) where xpos and ypos are zero-copy views into data
+def parseResultsFrame(data):
+    buf = np.frombuffer(data, dtype=np.uint8)
+    hdr = buf.view('<u4')
+    lenX = int(hdr[1])
+    lenY = int(hdr[2+lenX])
+    xpos = np.frombuffer(buf, dtype='<f4', count=lenX, offset=8)
+    ypos = np.frombuffer(buf, dtype='<f4', count=lenY, offset=12+4*lenX)
+    return int(hdr[0]), xpos, ypos
 
 # Class for streaming RX
 class StreamProcessor(pr.Device,ris.Master):
     # Init method must call the parent class init
-    def __init__(self,waveformRx,**kwargs):
+    #   eventBuilder = optional EventBuilder: processEvent() then runs once per complete four-channel event
+    def __init__(self,waveformRx,eventBuilder=None,**kwargs):
         pr.Device.__init__(self, **kwargs)
         ris.Master.__init__(self)
 
         # Pointer to the waveform receiver devices
         self.waveformRx = waveformRx
+        self.eventBuilder = eventBuilder
 
         # Local Variables
         self._xx = np.nan
         self._yy = np.nan
         self._lenXX = 0
         self._lenYY = 0
+        self._sum   = np.nan
+        self._peakPos = None
+        self._waveformBlock = None
+        self._posMap    = rfsoc.PolynomialMap(order=3)
+        self._posMapSel = None
+        self._lutCache  = {}
+        self._frameBuffer = np.zeros(shape=0, dtype='<u4')
+
+        # Pipelined mode: snapshot buffers and worker thread
+        self._snapshot  = []
+        self._snapSize  = None
+        self._snapDepth = None
+        self._snapGen   = 0
+        self._snapFree  = queue.Queue()
+        self._snapReady = queue.Queue()
+        self._snapPinned = None
+        self._snapLock  = threading.Lock()
+        self._worker    = None
+
+        # Per-bunch running statistics
+        self._stats = {q : rfsoc.RunningStats() for q in ['Xpos','Ypos','Sum']}
+
+        # Turn-by-turn history of the per-bunch results
+        self._history = None
 
         #-----------------------------------------------------------------------------
         # Configurable variables
@@ -91,6 +132,54 @@ class StreamProcessor(pr.Device,ris.Master):
             value       = 500,
         ))
 
+        self.add(pr.LocalVariable(
+            name        = 'PeakInterpMode',
+            description = 'Sub-sample interpolation of the per-bunch peak amplitude',
+            typeStr     = 'UInt8',
+            value       = 0,
+            enum        = {
+                0 : 'None',
+                1 : 'Parabolic',
+                2 : 'Gaussian',
+                3 : 'Centroid',
+            },
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'PeakInterpHalfWidth',
+            description = 'Half width (samples) of the window of the Centroid peak interpolation',
+            typeStr     = 'UInt8',
+            value       = 1,
+            minimum     = 1,
+            maximum     = 5,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'PosMapMode',
+            description = 'Position mapping backend',
+            typeStr     = 'UInt8',
+            value       = 0,
+            enum        = {
+                0 : 'Polynomial',
+                1 : 'LookupTable',
+            },
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'LutGridSize',
+            description = 'Number of grid points per axis when building the lookup table from the coefficients',
+            typeStr     = 'UInt16',
+            value       = 257,
+            minimum     = 2,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'LutFile',
+            description = 'Optional calibration file (.npz with h, v, x and y arrays) for the lookup table, empty = build from coefficients',
+            typeStr     = 'str',
+            value       = '',
+        ))
+
         coeffX = np.zeros(shape=[18,10], dtype=np.float32, order='C')
         coeffY = np.zeros(shape=[18,10], dtype=np.float32, order='C')
 
@@ -169,6 +258,24 @@ class StreamProcessor(pr.Device,ris.Master):
                 hidden      = True,
             ))
 
+        # Invalidate the cached position map coefficients when the chamber or its coefficients change
+        self.chamberType.addListener(self._posMapChanged)
+        for i in range(18):
+            self.coeffX[i].addListener(self._coeffChanged)
+            self.coeffY[i].addListener(self._coeffChanged)
+
+        @self.command(description='Compare the lookup table against the polynomial for the current chamberType')
+        def BenchmarkPosMap():
+            sel  = self.chamberType.value()
+            poly = rfsoc.PolynomialMap(order=3)
+            poly.setCoefficients(self.coeffX[sel].value(), self.coeffY[sel].value())
+            grid = np.linspace(-0.5, 0.5, num=64)
+            h, v = np.meshgrid(grid, grid)
+            result = rfsoc.comparePositionMaps(poly, self.lookupTable(sel), h.ravel(), v.ravel())
+            for k,value in result.items():
+                print( f'{k} = {value:.3e}' )
+            return result
+
         #-----------------------------------------------------------------------------
         # Outputs
         #-----------------------------------------------------------------------------
@@ -191,6 +298,16 @@ class StreamProcessor(pr.Device,ris.Master):
             hidden      = True,
         ))
 
+        for i in range(4):
+            self.add(pr.LocalVariable(
+                name        = f'PeakPos[{i}]',
+                description = f'Sub-sample peak position (waveform sample index) of every bunch of channel {i}, empty when PeakInterpMode is None',
+                typeStr     = 'Float[np]',
+                disp        = '',
+                value       = np.zeros(shape=0, dtype=np.float64, order='C'),
+                hidden      = True,
+            ))
+
         self.add(pr.LocalVariable(
             name        = 'StepsX',
             description = 'X position steps for GUI display',
@@ -248,18 +365,159 @@ class StreamProcessor(pr.Device,ris.Master):
             value       = 0,
         ))
 
+        #-----------------------------------------------------------------------------
+        # Per-bunch running statistics
+        #-----------------------------------------------------------------------------
+
+        self.add(pr.LocalVariable(
+            name        = 'StatsWindow',
+            description = 'Effective number of events in the running mean/variance (0 = cumulative since reset)',
+            typeStr     = 'UInt32',
+            value       = 0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'StatsDecay',
+            description = 'Weight of the newest event in the exponential moving average',
+            typeStr     = 'Float',
+            value       = 0.1,
+            minimum     = 0.0,
+            maximum     = 1.0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'StatsCount',
+            description = 'Number of events in the running statistics since reset',
+            typeStr     = 'UInt32',
+            mode        = 'RO',
+            value       = 0,
+        ))
+
+        for q in ['Xpos','Ypos','Sum']:
+            for stat in ['Mean','Var','Min','Max','Ema']:
+                self.add(pr.LocalVariable(
+                    name        = f'{q}{stat}',
+                    description = f'Per-bunch running {stat} of {q}',
+                    typeStr     = 'Float[np]',
+                    mode        = 'RO',
+                    value       = np.zeros(shape=1, dtype=np.float64, order='C'),
+                    hidden      = True,
+                ))
+
+        @self.command(description='Reset the per-bunch running statistics')
+        def StatsReset():
+            for q in self._stats:
+                self._stats[q].reset()
+            self.StatsCount.set(0)
+
+        #-----------------------------------------------------------------------------
+        # Turn-by-turn history
+        #-----------------------------------------------------------------------------
+
+        self.add(pr.LocalVariable(
+            name        = 'HistoryDepth',
+            description = 'Number of events kept in the per-bunch history ring (0 = disabled), allocated on the next event',
+            typeStr     = 'UInt32',
+            value       = 0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'HistoryMaxSize',
+            description = 'Memory cap for the history ring, HistoryDepth is reduced to fit',
+            typeStr     = 'UInt32',
+            units       = 'MB',
+            value       = 256,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'HistoryCount',
+            description = 'Number of valid events in the history ring',
+            typeStr     = 'UInt32',
+            mode        = 'RO',
+            value       = 0,
+        ))
+
+        @self.command(description='Clear the per-bunch history ring')
+        def HistoryReset():
+            if self._history is not None:
+                self._history.clear()
+            self.HistoryCount.set(0)
+
+        #-----------------------------------------------------------------------------
+        # Pipelined processing
+        #-----------------------------------------------------------------------------
+
+        self.add(pr.LocalVariable(
+            name        = 'PipelineEnable',
+            description = 'Snapshot the waveforms under lock and run the analysis in a background worker thread',
+            value       = False,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'PipelineDepth',
+            description = 'Number of snapshots that can wait for the worker before events are dropped',
+            typeStr     = 'UInt8',
+            value       = 1,
+            minimum     = 1,
+            maximum     = 8,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'QueueLevel',
+            description = 'Number of snapshots waiting for the worker',
+            typeStr     = 'UInt8',
+            mode        = 'RO',
+            value       = 0,
+        ))
+
+        self.add(pr.LocalVariable(
+            name        = 'DroppedEventCnt',
+            description = 'Increments when no free snapshot buffer is available',
+            typeStr     = 'UInt32',
+            mode        = 'RO',
+            value       = 0,
+        ))
+
+        for stage in ['Snapshot','Queue','PeakSearch','PosCalc','Stats','FrameGen']:
+            self.add(pr.LocalVariable(
+                name        = f'{stage}Latency',
+                description = f'Time spent in the {stage} stage of the last event',
+                typeStr     = 'Float',
+                mode        = 'RO',
+                units       = 'microsec',
+                disp        = '{:1.1f}',
+                value       = 0.0,
+            ))
+
+        # Event driven processing
+        if self.eventBuilder is not None:
+            self.eventBuilder.addConsumer(self.processEvent)
+
+    def _start(self):
+        super()._start()
+        self._worker = threading.Thread(target=self._pipelineWorker, daemon=True)
+        self._worker.start()
+
+    def _stop(self):
+        if self._worker is not None:
+            self._snapReady.put(None)
+            self._worker.join()
+            self._worker = None
+        super()._stop()
+
     # Method which is called to run BPM sub process
     def gpSubProcess(self):
 
+        # Check for pipelined mode
+        if self.PipelineEnable.value():
+            self._snapshotEvent()
+            return
+
         # Lock the waveform variables while processing them
         with self.waveformRx[0].WaveformData.lock, self.waveformRx[1].WaveformData.lock, self.waveformRx[2].WaveformData.lock, self.waveformRx[3].WaveformData.lock:
 
-            # Find the peaks per waveforms
-            index=np.argmin(self.waveformRx[0]._waveformData[:12])
-            a_peak = self.peak_search(waveform=self.waveformRx[0]._waveformData,start_index=index)
-            b_peak = self.peak_search(waveform=self.waveformRx[1]._waveformData,start_index=index)
-            c_peak = self.peak_search(waveform=self.waveformRx[2]._waveformData,start_index=index)
-            d_peak = self.peak_search(waveform=self.waveformRx[3]._waveformData,start_index=index)
+            # Gather the four waveforms into a single (4, N) block
+            block = self.waveformBlock([self.waveformRx[i]._waveformData for i in range(4)])
 
             # Update the waveform PVs
             [self.waveformRx[i].UpdateWaveform() for i in range(4)]
@@ -267,77 +525,260 @@ class StreamProcessor(pr.Device,ris.Master):
             # Clear the flag from each receiver
             [self.waveformRx[i].NewDataReady.set(False) for i in range(4)]
 
+        # Run the analysis on the local copy
+        self._processEvent(block)
+
+    # Method which is called by the EventBuilder with each complete event
+    def processEvent(self,event):
+
+        # Check for pipelined mode
+        if self.PipelineEnable.value():
+            t0 = time.perf_counter()
+            self._queueSnapshot(event.waveforms, t0)
+            return
+
+        # The event buffer stays valid until this method returns
+        self._processEvent(event.waveforms)
+
+    # Method which runs peak search, chamber calculation and frame generation on a (4, N) block
+    def _processEvent(self,block):
+        t0 = time.perf_counter()
+
+        # Find the peaks for all four waveforms in one pass
+        index=np.argmin(block[0,:12])
+        mode = self.PeakInterpMode.getDisp()
+        if mode == 'None':
+            peaks,_ = rfsoc.peakSearch(waveforms=block, startIndex=index, threshold=self.noise_threshold.value())
+            self._peakPos = None
+        else:
+            peaks,self._peakPos,_ = rfsoc.peakInterp(waveforms=block, startIndex=index, threshold=self.noise_threshold.value(),
+                                                     mode=mode.lower(), halfWidth=self.PeakInterpHalfWidth.value())
+        a_peak, b_peak, c_peak, d_peak = peaks
+
+        # Publish the sub-sample peak positions
+        for i in range(4):
+            self.PeakPos[i].set(np.zeros(shape=0) if self._peakPos is None else self._peakPos[i])
+        t1 = time.perf_counter()
+
         # Run chamber calculation
         self.poscalc(sel=self.chamberType.value() , a=a_peak , b=b_peak , c=c_peak , d=d_peak)
+        t2 = time.perf_counter()
+
+        # Update the per-bunch running statistics and history
+        self.updateStats()
+        self.updateHistory()
+        t3 = time.perf_counter()
 
         # Generate the streaming frame with results
         self.ResultsFrameGen()
+        t4 = time.perf_counter()
 
         # Increment the counter
         self.EventCnt.set(self.EventCnt.value()+1)
 
+        # Update the per-stage latencies
+        self.PeakSearchLatency.set((t1-t0)*1.0E+6)
+        self.PosCalcLatency.set((t2-t1)*1.0E+6)
+        self.StatsLatency.set((t3-t2)*1.0E+6)
+        self.FrameGenLatency.set((t4-t3)*1.0E+6)
+
+    # Method which updates the per-bunch running statistics with the latest event
+    def updateStats(self):
+        window = self.StatsWindow.value()
+        decay  = self.StatsDecay.value()
+        for q,x in [('Xpos',self._xx),('Ypos',self._yy),('Sum',self._sum)]:
+            stats = self._stats[q]
+            stats.window = window
+            stats.decay  = decay
+            stats.update(x)
+            for stat,value in [('Mean',stats.mean),('Var',stats.var),('Min',stats.min),('Max',stats.max),('Ema',stats.ema)]:
+                getattr(self,f'{q}{stat}').set(np.copy(value))
+        self.StatsCount.set(self._stats['Xpos'].count)
+
+    # Method which appends the latest event to the history ring
+    def updateHistory(self):
+        width = self._lenXX
+        depth = self.HistoryDepth.value()
+        names = ['Xpos','Ypos','Sum']
+
+        # Apply the memory cap
+        if width > 0:
+            maxBytes = self.HistoryMaxSize.value()*2**20
+            depth = min(depth, maxBytes // rfsoc.HistoryRing.nbytes(len(names), 1, width))
+        if depth == 0 or width == 0:
+            self._history = None
+            return
+
+        # (Re)allocate only when the size changes
+        if (self._history is None) or (self._history.depth != depth) or (self._history.width != width):
+            self._history = rfsoc.HistoryRing(fields=names, depth=depth, width=width)
+
+        self._history.append(Xpos=self._xx, Ypos=self._yy, Sum=self._sum)
+        self.HistoryCount.set(self._history.count)
+
+    # Method which returns the last k events of the history as {'Xpos','Ypos','Sum'} (k, nBunch) views
+    def getHistory(self,k=None):
+        if self._history is None:
+            return None
+        return self._history.last(k)
+
+    # Method which allocates the snapshot buffers (queue depth + one in the worker + one published)
+    def _allocSnapshots(self,size,depth):
+        self._snapGen  += 1
+        self._snapSize  = size
+        self._snapDepth = depth
+        self._snapshot  = [np.zeros(shape=[4,size], dtype=np.int16, order='C') for _ in range(depth+2)]
+        self._snapFree  = queue.Queue()
+        for i in range(depth+2):
+            self._snapFree.put(i)
+        self._snapPinned = None
+
+    # Method which copies the four waveforms into a free snapshot buffer and hands it to the worker
+    def _snapshotEvent(self):
+        t0 = time.perf_counter()
+
+        with self.waveformRx[0].WaveformData.lock, self.waveformRx[1].WaveformData.lock, self.waveformRx[2].WaveformData.lock, self.waveformRx[3].WaveformData.lock:
+
+            # Copy the waveforms into a snapshot buffer
+            self._queueSnapshot([self.waveformRx[i]._waveformData for i in range(4)], t0)
+
+            # Clear the flag from each receiver
+            [self.waveformRx[i].NewDataReady.set(False) for i in range(4)]
+
+    # Method which copies four waveforms into a free snapshot buffer and hands it to the worker
+    def _queueSnapshot(self,waveforms,t0):
+        with self._snapLock:
+            # (Re)allocate the snapshot buffers if the waveform size or depth changed
+            size  = min(len(waveforms[i]) for i in range(4))
+            depth = self.PipelineDepth.value()
+            if (size != self._snapSize) or (depth != self._snapDepth):
+                self._allocSnapshots(size,depth)
+
+            # Get a free snapshot buffer
+            try:
+                slot = self._snapFree.get_nowait()
+            except queue.Empty:
+                slot = None
+            gen = self._snapGen
+
+        # Copy the waveforms into the snapshot buffer
+        if slot is not None:
+            block = self._snapshot[slot]
+            for i in range(4):
+                block[i,:] = waveforms[i][:size]
+
+        # Check if the worker fell behind
+        if slot is None:
+            self.DroppedEventCnt.set(self.DroppedEventCnt.value()+1)
+            return
+
+        self.SnapshotLatency.set((time.perf_counter()-t0)*1.0E+6)
+        self._snapReady.put((gen, slot, block, time.perf_counter()))
+        self.QueueLevel.set(self._snapReady.qsize())
+
+    # Worker thread which runs the analysis outside of the waveform locks
+    def _pipelineWorker(self):
+        while True:
+            item = self._snapReady.get()
+            if item is None:
+                return
+            gen, slot, block, tQueued = item
+            self.QueueLatency.set((time.perf_counter()-tQueued)*1.0E+6)
+            self.QueueLevel.set(self._snapReady.qsize())
+
+            try:
+                # Update the waveform PVs from the snapshot
+                [self.waveformRx[i].WaveformData.set(block[i],write=True) for i in range(4)]
+
+                # Run the analysis
+                self._processEvent(block)
+
+            # Keep the worker alive: a failed event must not stop the pipeline
+            except Exception:
+                self._log.exception('StreamProcessor pipeline worker: analysis failed')
+
+            # The published snapshot stays pinned until the next one replaces it
+            finally:
+                with self._snapLock:
+                    if gen == self._snapGen:
+                        if self._snapPinned is not None:
+                            self._snapFree.put(self._snapPinned)
+                        self._snapPinned = slot
+
     # Method for generating a frame with the results
     def ResultsFrameGen(self):
 
         # event counter (UInt32)
         # length(UInt32) + Float32[array]
         # length(UInt32) + Float32[array]
-        size  = 4 \
-              + 4 + 4*self._lenXX \
-              + 4 + 4*self._lenYY
+        words = 1 \
+              + 1 + self._lenXX \
+              + 1 + self._lenYY
+        size  = 4*words
+
+        # Grow the staging buffer to the largest event seen
+        if len(self._frameBuffer) < words:
+            self._frameBuffer = np.zeros(shape=words, dtype='<u4')
+
+        # Lay out the header and both arrays in one contiguous buffer
+        buf  = self._frameBuffer[:words]
+        fbuf = buf.view('<f4')
+        buf[0]  = self.EventCnt.value()
+        buf[1]  = self._lenXX
+        fbuf[2:2+self._lenXX] = self._xx
+        buf[2+self._lenXX] = self._lenYY
+        fbuf[3+self._lenXX:] = self._yy
 
         # Here we request a frame capable of holding size bytes
         frame = self._reqFrame(size, True)
-        offset = 0
-
-        # Write the Event counter into the frame
-        ba = bytearray(struct.pack("<I", self.EventCnt.value() ))
-        frame.write(ba,offset)
-        offset += 4
-
-        # Write the Xpos Length into the frame
-        ba = bytearray(struct.pack("<I", self._lenXX ))
-        frame.write(ba,offset)
-        offset += 4
-
-        # Write the Xpos into the frame
-        for i in range(self._lenXX):
-            ba = bytearray(struct.pack("<f", self._xx[i] ))
-            frame.write(ba,offset)
-            offset += 4
-
-        # Write the Ypos Length into the frame
-        ba = bytearray(struct.pack("<I", self._lenYY ))
-        frame.write(ba,offset)
-        offset += 4
-
-        # Write the Ypos into the frame
-        for i in range(self._lenYY):
-            ba = bytearray(struct.pack("<f", self._yy[i] ))
-            frame.write(ba,offset)
-            offset += 4
+
+        # Write the results into the frame with a single write
+        frame.write(buf.view(np.uint8),0)
 
         # Send the frame results
         self._sendFrame(frame)
 
+    # Method which is called when chamberType changes
+    def _posMapChanged(self,path,value):
+        self._posMapSel = None
+
+    # Method which is called when a coefficient variable changes
+    def _coeffChanged(self,path,value):
+        self._posMapSel = None
+        self._lutCache.clear()
+
+    # Method which returns the (cached) lookup table map for a chamber type
+    def lookupTable(self,sel):
+        key = (sel, self.LutGridSize.value(), self.LutFile.value())
+        if key not in self._lutCache:
+            if key[2] != '':
+                self._lutCache[key] = rfsoc.LookupTableMap.fromFile(key[2])
+            else:
+                poly = rfsoc.PolynomialMap(order=3)
+                poly.setCoefficients(self.coeffX[sel].value(), self.coeffY[sel].value())
+                self._lutCache[key] = rfsoc.LookupTableMap.fromPolynomial(poly, size=key[1])
+        return self._lutCache[key]
+
     # Method which is called to run chamber calculation
     def poscalc(self,sel,a,b,c,d):
-        h = np.divide((a-b-c+d), (a+b+c+d), out=np.zeros_like(a,dtype=np.float64), where=~((a==0)|(b==0)|(c==0)|(d==0)))
-        v = np.divide((a+b-c-d), (a+b+c+d), out=np.zeros_like(a,dtype=np.float64), where=~((a==0)|(b==0)|(c==0)|(d==0)))
-
-        # Select the X/Y coefficients
-        coeffX = self.coeffX[sel].value()
-        coeffY = self.coeffY[sel].value()
+        valid = ~((a==0)|(b==0)|(c==0)|(d==0))
+        total = a+b+c+d
+        self._sum = total
+        h = np.divide((a-b-c+d), total, out=np.zeros_like(a,dtype=np.float64), where=valid)
+        v = np.divide((a+b-c-d), total, out=np.zeros_like(a,dtype=np.float64), where=valid)
+
+        # Select the position map backend
+        if self.PosMapMode.getDisp() == 'LookupTable':
+            posMap = self.lookupTable(sel)
+        else:
+            # Load the X/Y coefficients only when the cached selection is stale
+            if self._posMapSel != sel:
+                self._posMap.setCoefficients(self.coeffX[sel].value(), self.coeffY[sel].value())
+                self._posMapSel = sel
+            posMap = self._posMap
 
         # Perform the chamber calculation
-        self._xx = coeffX[0] + \
-            coeffX[1] * h    + coeffX[2] * v + \
-            coeffX[3] * h**2 + coeffX[4] * h * v + coeffX[5] * v**2 + \
-            coeffX[6] * h**3 + coeffX[7] * h**2 * v + coeffX[8] * h * v**2 + coeffX[9] * v**3
-        self._yy = coeffY[0] + \
-            coeffY[1] * h    + coeffY[2] * v + \
-            coeffY[3] * h**2 + coeffY[4] * h * v + coeffY[5] * v**2 + \
-            coeffY[6] * h**3 + coeffY[7] * h**2 * v + coeffY[8] * h * v**2 + coeffY[9] * v**3
+        self._xx, self._yy = posMap.evaluate(h, v)
         self._lenXX = len(self._xx)
         self._lenYY = len(self._yy)
 
@@ -361,17 +802,19 @@ class StreamProcessor(pr.Device,ris.Master):
             self.YposSTD.set(np.nan)
             self.YposRMS.set(np.nan)
 
+    # Method which copies the waveforms into the preallocated (4, N) block
+    def waveformBlock(self,waveforms):
+        size = min(len(w) for w in waveforms)
+        if (self._waveformBlock is None) or (self._waveformBlock.shape[1] != size):
+            self._waveformBlock = np.zeros(shape=[len(waveforms),size], dtype=np.int16, order='C')
+        for i,w in enumerate(waveforms):
+            self._waveformBlock[i,:] = w[:size]
+        return self._waveformBlock
+
     # Method which is called to run peak search
     def peak_search(self,waveform,start_index):
-        mountain_maxima = []
-        points_per_bunch = 12
-        for i in range(start_index, len(waveform)-points_per_bunch+start_index, points_per_bunch):
-            peak = max(waveform[i:i+points_per_bunch])
-            if peak >= self.noise_threshold.value():
-                mountain_maxima.append(peak)
-            else:
-                mountain_maxima.append(0)
-        return np.array(mountain_maxima)
+        peaks,_ = rfsoc.peakSearch(waveforms=waveform, startIndex=start_index, threshold=self.noise_threshold.value())
+        return peaks
 
     # Overload the `>>` python operator for a connection for this custom master stream module
     def __rshift__(self,other):
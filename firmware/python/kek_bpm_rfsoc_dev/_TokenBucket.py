@@ -0,0 +1,40 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import time
+
+# Token bucket rate limiter
+#   rate  = tokens per second (0 = unlimited)
+#   burst = bucket capacity: number of actions allowed back to back after an idle period
+# The bucket starts full.
+class TokenBucket(object):
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self._clock  = clock
+        self._tokens = float(burst)
+        self._last   = clock()
+        self.rate    = rate
+        self.burst   = burst
+
+    # Method which adds the tokens accumulated since the last call
+    def _refill(self, now):
+        if self.rate > 0:
+            self._tokens = min(float(self.burst), self._tokens + (now-self._last)*self.rate)
+        self._last = now
+
+    # Method which takes a token if one is available
+    # Returns the time (seconds) until a token is available, 0.0 if one was taken
+    def take(self):
+        if self.rate <= 0:
+            return 0.0
+        self._refill(self._clock())
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return 0.0
+        return (1.0-self._tokens)/self.rate
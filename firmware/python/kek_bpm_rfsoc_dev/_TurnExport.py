@@ -0,0 +1,112 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+import os
+import json
+import struct
+import numpy as np
+
+# Binary export of the turn-by-turn matrices (.tbt)
+#
+# File layout:
+#   magic (8 bytes)           = b'KEKTBT\x00\x00'
+#   version, length (<HI)     = format version, length of the JSON header
+#   JSON header               = dtype (numpy little-endian string), shape, axes
+#                               (('turn', 'bucket') by default), timestamp, plane
+#                               and any extra metadata, space padded so that the
+#                               data starts on a TurnExportAlign boundary
+#   data                      = C-order samples
+# The data is written with the header in a single buffered write, and the loader
+# memory maps it at the fixed offset.
+#
+# text=True also writes the np.savetxt() text file (same numbers, same '%.18e'
+# format) for the consumers that still read it, formatted in one pass over the
+# same buffer instead of np.savetxt()'s per-row formatting.
+
+TurnExportMagic   = b'KEKTBT\x00\x00'
+TurnExportVersion = 1
+TurnExportAlign   = 64
+
+_prefix = struct.Struct('<HI')
+
+# Returns the np.savetxt(path, data) text of a 1D or 2D array
+def formatTurnText(data, fmt='%.18e', delimiter=' '):
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[:,np.newaxis]
+    if data.ndim != 2:
+        raise ValueError( f'Expected a 1D or 2D array, got shape {data.shape}' )
+    if data.size == 0:
+        return ''
+    line = delimiter.join([fmt]*data.shape[1]) + '\n'
+    return (line*data.shape[0]) % tuple(data.ravel().tolist())
+
+# Writes a matrix to a .tbt file
+#   data      = (turn, bucket) matrix (any numeric dtype, stored as is)
+#   plane     = plane name (LERDV, LERUV, ...)
+#   timestamp = record time (time.time() float)
+#   axes      = name of every axis
+#   text      = also write the np.savetxt() text file to textPath (default: path with a .txt extension)
+#   **meta    = extra header entries (JSON serializable)
+# Returns the header
+def saveTurnMatrix(path, data, plane=None, timestamp=None, axes=('turn', 'bucket'), text=False, textPath=None, **meta):
+    data = np.ascontiguousarray(data)
+    data = data.astype(data.dtype.newbyteorder('<'), copy=False)
+    if len(axes) != data.ndim:
+        raise ValueError( f'{len(axes)} axis names for a {data.ndim}D matrix' )
+
+    header = dict(meta,
+                  dtype     = data.dtype.str,
+                  shape     = list(data.shape),
+                  axes      = list(axes),
+                  plane     = plane,
+                  timestamp = None if timestamp is None else float(timestamp))
+
+    raw   = json.dumps(header).encode()
+    start = len(TurnExportMagic) + _prefix.size
+    raw  += b' ' * (-(start+len(raw)) % TurnExportAlign)
+
+    with open(path, 'wb') as f:
+        f.writelines([TurnExportMagic, _prefix.pack(TurnExportVersion, len(raw)), raw, memoryview(data).cast('B')])
+
+    if text:
+        if textPath is None:
+            textPath = os.path.splitext(path)[0] + '.txt'
+        with open(textPath, 'w') as f:
+            f.write(formatTurnText(data))
+
+    return header
+
+# Returns the header and the data offset of a .tbt file
+def readTurnHeader(path):
+    with open(path, 'rb') as f:
+        magic = f.read(len(TurnExportMagic))
+        if magic != TurnExportMagic:
+            raise ValueError( f'Not a turn matrix file: {path}' )
+        version, length = _prefix.unpack(f.read(_prefix.size))
+        if version != TurnExportVersion:
+            raise ValueError( f'Unsupported turn matrix version {version}: {path}' )
+        header = json.loads(f.read(length))
+    return header, len(TurnExportMagic) + _prefix.size + length
+
+# Returns the (matrix, header) of a .tbt file
+#   mmap = memory map the data (read-only) instead of reading it
+def loadTurnMatrix(path, mmap=True):
+    header, offset = readTurnHeader(path)
+    dtype = np.dtype(header['dtype'])
+    shape = tuple(header['shape'])
+
+    if mmap and (np.prod(shape) > 0):
+        data = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+    else:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return data, header
@@ -1,6 +1,21 @@
+from kek_bpm_rfsoc_dev._PeakSearch       import *
+from kek_bpm_rfsoc_dev._PositionMap      import *
+from kek_bpm_rfsoc_dev._RunningStats     import *
+from kek_bpm_rfsoc_dev._HistoryRing      import *
+from kek_bpm_rfsoc_dev._TokenBucket      import *
+from kek_bpm_rfsoc_dev._FaultAnalysis    import *
+from kek_bpm_rfsoc_dev._DatFile          import *
+from kek_bpm_rfsoc_dev._FaultArchive     import *
+from kek_bpm_rfsoc_dev._FaultBatch       import *
+from kek_bpm_rfsoc_dev._FaultCatalog     import *
+from kek_bpm_rfsoc_dev._FaultWatcher     import *
+from kek_bpm_rfsoc_dev._FaultPlot        import *
+from kek_bpm_rfsoc_dev._TurnExport       import *
 from kek_bpm_rfsoc_dev._PrependLocalTime import *
 from kek_bpm_rfsoc_dev._RingBufferProcessor import *
+from kek_bpm_rfsoc_dev._EventBuilder    import *
 from kek_bpm_rfsoc_dev._FaultRingBufferProcessor import *
+from kek_bpm_rfsoc_dev._FaultBunchProcessor import *
 from kek_bpm_rfsoc_dev._PosCalcProcessor import *
 from kek_bpm_rfsoc_dev._StreamProcessor import *
 from kek_bpm_rfsoc_dev._ReadoutCtrl     import *
@@ -0,0 +1,83 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+# Test of the single event reads of the .dat files (readFaultEvent, FaultCatalog.load)
+# against the indexed DatFile reader. Run with:
+#   python -m pytest firmware/python/tests
+
+import os
+import sys
+import struct
+import numpy as np
+import pytest
+
+# The package needs pyrogue (PrependLocalTime defines the time header): skipped without it
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+rfsoc = pytest.importorskip('kek_bpm_rfsoc_dev')
+
+# Returns a StreamWriter record
+def makeRecord(channel, payload, flags=0, error=0):
+    return struct.pack('<IHBB', len(payload)+4, flags, error, channel) + payload
+
+# Returns the version 1 (32-byte) or version 0 (8-byte) local time header of a payload
+def makeHeader(version, payload, seq):
+    if version == 1:
+        return rfsoc.LocalTimeHeader.pack(rfsoc.LocalTimeMagic, 1, rfsoc.LocalTimeHeader.size, len(payload), 1700000000*10**9 + seq, seq)
+    return rfsoc.LocalTimeHeaderV0.pack(1.7e9 + seq)
+
+# Writes a .dat file of fault events with a non-fault record and a bad record between them
+# Returns the (4, N) int16 waveforms of every event
+def makeDatFile(path, layout, version, numEvents=3, numSamples=64, seed=0):
+    rng    = np.random.default_rng(seed)
+    events = [rng.integers(-2000, 2000, size=(4,numSamples)).astype(np.int16) for _ in range(numEvents)]
+    with open(path, 'wb') as f:
+        for k,w in enumerate(events):
+            f.write(makeRecord(0, b'\x00'*16))
+            if layout == 'interleaved':
+                payload = np.ascontiguousarray(w.T).tobytes()
+                f.write(makeRecord(15, makeHeader(version, payload, k) + payload))
+            else:
+                for ch in range(4):
+                    payload = w[ch].tobytes()
+                    f.write(makeRecord(12+ch, makeHeader(version, payload, k) + payload))
+                    if ch == 1:
+                        f.write(makeRecord(14, b'\x00'*8, error=1))
+    return events
+
+@pytest.mark.parametrize('layout,version', [('interleaved',1), ('interleaved',0), ('perChannel',1), ('perChannel',0)])
+def test_loadWithoutIndex(tmp_path, monkeypatch, layout, version):
+    path   = str(tmp_path / 'data_20240101_000000.dat')
+    events = makeDatFile(path, layout, version)
+
+    with rfsoc.DatFile(path, cache=False) as dat:
+        assert dat.layout == layout
+        rows = [{'path': path, 'offset': dat.eventOffset(n), 'channels': ','.join(str(ch) for ch in dat.eventChannels(n))}
+                for n in range(dat.numEvents)]
+        indexed = [dat.event(n) for n in range(dat.numEvents)]
+
+    # load() must not scan or index the file
+    def noIndex(*args, **kwargs):
+        raise AssertionError('the file was indexed')
+    monkeypatch.setattr(rfsoc, 'scanDatFile', noIndex)
+    monkeypatch.setattr(rfsoc, 'loadDatIndex', noIndex)
+
+    for n,row in enumerate(rows):
+        np.testing.assert_array_equal(rfsoc.FaultCatalog.load(row), events[n])
+        np.testing.assert_array_equal(rfsoc.FaultCatalog.load(row), indexed[n])
+        np.testing.assert_array_equal(rfsoc.readFaultEvent(path, row['offset']), events[n])
+    assert not os.path.exists(rfsoc.datIndexPath(path))
+
+def test_loadBadOffset(tmp_path):
+    path = str(tmp_path / 'data_20240101_000000.dat')
+    makeDatFile(path, 'interleaved', 1)
+
+    # Offset 0 is the non-fault record
+    with pytest.raises(IndexError):
+        rfsoc.readFaultEvent(path, 0)
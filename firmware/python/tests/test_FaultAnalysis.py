@@ -0,0 +1,170 @@
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+
+# Regression test of the vectorized makeplot steps (_FaultAnalysis) against the
+# per-bunch, per-turn loops the makeplot scripts used before. Run with:
+#   python -m pytest firmware/python/tests
+
+import os
+import importlib.util
+import numpy as np
+
+# _FaultAnalysis only needs numpy: load it without the package __init__ (pyrogue)
+_path = os.path.join(os.path.dirname(__file__), '..', 'kek_bpm_rfsoc_dev', '_FaultAnalysis.py')
+_spec = importlib.util.spec_from_file_location('_FaultAnalysis', _path)
+fa    = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(fa)
+
+HARMONIC = 5120
+
+# Returns a (4, N) down-sampled fault capture: an abort gap, then filled buckets above 500 on every channel
+def makeDownSampled(numTurns=103, gapStart=300, gapWidth=80, seed=0):
+    rng  = np.random.default_rng(seed)
+    size = HARMONIC*numTurns + 2*HARMONIC
+    fill = rng.random(HARMONIC) < 0.3
+    fill[[gapStart+gapWidth+i for i in range(3)]] = True
+    fill[gapStart:gapStart+gapWidth] = False
+
+    waveforms = rng.integers(0, 400, size=(4,size)).astype(np.int16)
+    turn = np.arange(size) % HARMONIC
+    filled = fill[turn]
+    waveforms[:,filled] = rng.integers(600, 3000, size=(4,int(filled.sum()))).astype(np.int16)
+    waveforms[:,:gapStart] = rng.integers(600, 3000, size=(4,gapStart)).astype(np.int16)
+    return waveforms
+
+# Returns a (4, N) raw capture (8 samples per bucket): filled buckets are local maxima
+# above 800 on the sum channels (2, 3), the delta channels (0, 1) follow one sample later
+def makeRaw(numTurns=13, seed=1):
+    rng  = np.random.default_rng(seed)
+    size = 8*HARMONIC*numTurns + 23500 + 8*2000
+    fill = rng.random(HARMONIC) < 0.3
+    fill[0] = True
+
+    waveforms = rng.integers(0, 200, size=(4,size)).astype(np.int16)
+    first = 23500 + 8*37 + 3
+    index = first + 8*np.arange((size-first-2)//8)
+    index = index[fill[np.arange(len(index)) % HARMONIC]]
+    waveforms[2:4,index]   = rng.integers(900, 3000, size=(2,len(index))).astype(np.int16)
+    waveforms[0:2,index+1] = rng.integers(-800, 800, size=(2,len(index))).astype(np.int16)
+    return waveforms
+
+# Loop version of makeplot_newFW.py (before the move onto _FaultAnalysis)
+def loopDownSampled(ampFault, numTurns=102):
+    start = None
+    for i in range(2560):
+        if max(ampFault[0][i:i+50]) < 500:
+            start = i+50
+            break
+    bunch_index = []
+    for i in range(5120):
+        if ampFault[0][start+i] > 500:
+            bunch_index.append(start+i)
+
+    UV, DV, charge_U, charge_D = [], [], [], []
+    for j in bunch_index:
+        uv, dv, cu, cd = [], [], [], []
+        for i in range(numTurns):
+            tbt_0 = ampFault[0][j+5120*i]
+            tbt_1 = ampFault[1][j+5120*i]
+            tbt_2 = ampFault[2][j+5120*i]
+            tbt_3 = ampFault[3][j+5120*i]
+            uv.append(tbt_3/tbt_2*(-16.58)/5)
+            dv.append(tbt_1/tbt_0*(-16.58)/5)
+            cu.append(tbt_2)
+            cd.append(tbt_0)
+        UV.append(np.array(uv))
+        DV.append(np.array(dv))
+        charge_U.append(np.array(cu))
+        charge_D.append(np.array(cd))
+    UV, DV = np.array(UV), np.array(DV)
+    charge_U, charge_D = np.array(charge_U), np.array(charge_D)
+
+    UV = UV - np.mean(UV[:,0:10],axis=1)[:,np.newaxis]
+    DV = DV - np.mean(DV[:,0:10],axis=1)[:,np.newaxis]
+    charge_U = charge_U/np.mean(charge_U[:,0:10],axis=1)[:,np.newaxis]
+    charge_D = charge_D/np.mean(charge_D[:,0:10],axis=1)[:,np.newaxis]
+    return start, np.array(bunch_index), UV, DV, charge_U, charge_D
+
+# Loop version of makeplot.py (before the move onto _FaultAnalysis)
+def loopRaw(ampFault, numTurns=12):
+    start = 23500
+    firstbunch = 0
+    for i in range(1,8*2000):
+        if ampFault[2][start+i-1] < ampFault[2][start+i] and ampFault[2][start+i] > ampFault[2][start+i+1]:
+            if ampFault[2][start+i] > 800:
+                firstbunch = start+i
+                break
+    bunch_index = np.where(ampFault[2][firstbunch:firstbunch+5120*8:8] > 800)[0]
+
+    y_pos, x_pos, charge = [], [], []
+    for j in bunch_index:
+        y, x, c = [], [], []
+        for i in range(numTurns):
+            sum_1 = ampFault[2][firstbunch+j*8+5120*8*i]
+            sum_2 = ampFault[3][firstbunch+j*8+5120*8*i]
+            delta_U = ampFault[0][firstbunch+j*8+5120*8*i+1]
+            delta_V = ampFault[1][firstbunch+j*8+5120*8*i+1]
+            Uposition = delta_U/sum_1
+            Vposition = delta_V/sum_2
+            y.append(Uposition+Vposition)
+            x.append(Uposition-Vposition)
+            # In float: the old int16 sum_1+sum_2 could wrap (fixed by the move onto _FaultAnalysis)
+            c.append(float(sum_1)+float(sum_2))
+        y_pos.append(np.array(y))
+        x_pos.append(np.array(x))
+        charge.append(np.array(c))
+    y_pos, x_pos, charge = np.array(y_pos), np.array(x_pos), np.array(charge)
+
+    y_pos = y_pos - np.mean(y_pos[:,0:2],axis=1)[:,np.newaxis]
+    x_pos = x_pos - np.mean(x_pos[:,0:2],axis=1)[:,np.newaxis]
+    charge = charge/np.mean(charge[:,0:2],axis=1)[:,np.newaxis]
+    return firstbunch, bunch_index, x_pos, y_pos, charge
+
+def test_downSampledMatchesLoops():
+    ampFault = makeDownSampled()
+    start, bunchIndex, UV, DV, chargeU, chargeD = loopDownSampled(ampFault)
+
+    newStart, newIndex = fa.gapBunchIndex(ampFault[0], threshold=500, gapThreshold=500, gapWidth=50)
+    assert newStart == start
+    np.testing.assert_array_equal(newStart+newIndex, bunchIndex)
+
+    # Library matrices are (turn, bunch), the loops built (bunch, turn)
+    tbt = fa.gatherTurns(ampFault, newStart, newIndex, 102)
+    np.testing.assert_allclose(fa.subtractBaseline(fa.deltaOverSum(tbt[3], tbt[2]), 10).T, UV, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(fa.subtractBaseline(fa.deltaOverSum(tbt[1], tbt[0]), 10).T, DV, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(fa.normalizeBaseline(tbt[2], 10).T, chargeU, rtol=1e-12)
+    np.testing.assert_allclose(fa.normalizeBaseline(tbt[0], 10).T, chargeD, rtol=1e-12)
+
+    # Same results through extractBunches()
+    res = fa.extractBunches(ampFault, numTurns=102)
+    np.testing.assert_allclose(res['uv'].T, UV, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(res['chargeD'].T, chargeD, rtol=1e-12)
+
+def test_rawMatchesLoops():
+    ampFault = makeRaw()
+    firstbunch, bunchIndex, x_pos, y_pos, charge = loopRaw(ampFault)
+
+    newFirst, newIndex = fa.rawBunchIndex(ampFault[2], 800, searchStart=23500, searchSize=8*2000)
+    assert newFirst == firstbunch
+    np.testing.assert_array_equal(newIndex, bunchIndex)
+
+    tbt = fa.gatherTurns(ampFault, newFirst, newIndex, 12, step=8)
+    dlt = fa.gatherTurns(ampFault[0:2], newFirst+1, newIndex, 12, step=8)
+    u = fa.deltaOverSum(dlt[0], tbt[2], scale=1.0)
+    v = fa.deltaOverSum(dlt[1], tbt[3], scale=1.0)
+    np.testing.assert_allclose(fa.subtractBaseline(u-v, 2).T, x_pos, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(fa.subtractBaseline(u+v, 2).T, y_pos, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(fa.normalizeBaseline(tbt[2].astype(np.float64)+tbt[3], 2).T, charge, rtol=1e-12)
+
+def test_turnDifferenceMatchesLoop():
+    x = np.random.default_rng(2).normal(size=(12, 300))
+    loop = np.array([[x[i+1,j]-x[i,j] for j in range(x.shape[1])] for i in range(x.shape[0]-1)])
+    np.testing.assert_array_equal(fa.turnDifference(x), loop)
+    np.testing.assert_array_equal(fa.turnDifference(x.T, axis=1), loop.T)
@@ -1,33 +1,40 @@
 #!/usr/bin/env python3
 
+import os
 import time
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-import subprocess
-
-class MyHandler(FileSystemEventHandler):
-    def on_created(self, event):
-        if event.is_directory:
-            return
-        elif event.src_path.endswith('.dat'):
-            time.sleep(5)
-            print(f"{event.src_path} has been created. Running script...")
-            subprocess.run(["python3", "makeplot_newFW.py"])  # スクリプトを実行
+
+import setupLibPaths
+import kek_bpm_rfsoc_dev as rfsoc
+import makeplot_newFW
+
+catalog_db = '/mnt/SBOR/ZCU111/faultCatalog.sqlite'
+
+# Runs in a worker process: the plotting modules stay imported between files
+# The plots are rendered in the worker itself (no nested process pool), and the
+# catalog rows are returned to the watcher process instead of written from here.
+def plot(path):
+    makeplot_newFW.parse_and_plot(path,0,10,plotWorkers=0)
+    st = os.stat(path)
+    return rfsoc.summarizeFaultFile(path), st.st_size, st.st_mtime_ns
+
+# Runs in the watcher process, one file at a time: single writer of the catalog
+def catalog(path, result):
+    rows, size, mtime = result
+    with rfsoc.FaultCatalog(catalog_db) as db:
+        db.addRows(path, rows, size=size, mtime=mtime)
 
 def main():
     path = '/mnt/SBOR/ZCU111/'  # 監視するディレクトリのパスを指定
-    event_handler = MyHandler()
-    observer = Observer()
-    observer.schedule(event_handler, path, recursive=False)
-    observer.start()
+    watcher = rfsoc.FaultFileWatcher(path,plot,callback=catalog,workers=2)
+    watcher.start()
 
     try:
         while True:
             time.sleep(10)
-            
+
     except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
+        pass
+    watcher.stop()
 
 if __name__ == "__main__":
     main()
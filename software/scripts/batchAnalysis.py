@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+import setupLibPaths
+import kek_bpm_rfsoc_dev as rfsoc
+
+import argparse
+
+if __name__ == "__main__":
+
+#################################################################
+
+    # Set the argument parser
+    parser = argparse.ArgumentParser(description='Analyzes every fault event of a set of .dat files with a process pool')
+
+    # Add arguments
+    parser.add_argument(
+        "inputs",
+        type     = str,
+        nargs    = '+',
+        help     = "Directories (all data_*.dat files), .dat files or glob patterns",
+    )
+
+    parser.add_argument(
+        "--output",
+        type     = str,
+        required = False,
+        default  = 'faultSummary.npy',
+        help     = "Summary table (.npy structured array, load with numpy.load())",
+    )
+
+    parser.add_argument(
+        "--cacheDir",
+        type     = str,
+        required = False,
+        default  = None,
+        help     = "Per-file result cache (default: <output>.cache)",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type     = int,
+        required = False,
+        default  = 0,
+        help     = "Number of worker processes (0 = number of CPUs)",
+    )
+
+    parser.add_argument(
+        "--force",
+        action   = 'store_true',
+        help     = "Re-analyze the files that already have cached results",
+    )
+
+    parser.add_argument(
+        "--threshold",
+        type     = int,
+        required = False,
+        default  = 500,
+        help     = "Channel 0 amplitude above which a bucket is considered filled",
+    )
+
+    parser.add_argument(
+        "--gapThreshold",
+        type     = int,
+        required = False,
+        default  = 500,
+        help     = "Channel 0 amplitude below which a sample is considered in the abort gap",
+    )
+
+    parser.add_argument(
+        "--minBunches",
+        type     = int,
+        required = False,
+        default  = 300,
+        help     = "Minimum number of filled buckets for a valid event",
+    )
+
+    parser.add_argument(
+        "--numTurns",
+        type     = int,
+        required = False,
+        default  = 0,
+        help     = "Number of turns to extract (0 = all available turns)",
+    )
+
+    parser.add_argument(
+        "--lossLevel",
+        type     = float,
+        required = False,
+        default  = 0.9,
+        help     = "Normalized charge below which the beam is considered lost",
+    )
+
+    # Get the arguments
+    args = parser.parse_args()
+
+    #################################################################
+
+    files = rfsoc.expandDatFiles(args.inputs)
+    print(f'{len(files)} files')
+
+    rows = rfsoc.analyzeFaultFiles(
+        files,
+        workers      = args.workers,
+        cacheDir     = args.cacheDir if args.cacheDir is not None else f'{args.output}.cache',
+        force        = args.force,
+        progress     = rfsoc.printProgress(),
+        threshold    = args.threshold,
+        gapThreshold = args.gapThreshold,
+        minBunches   = args.minBunches,
+        numTurns     = args.numTurns,
+        lossLevel    = args.lossLevel,
+    )
+
+    rfsoc.saveFaultSummary(args.output, rows)
+    print(f'{len(rows)} events ({rows["valid"].sum()} valid) saved to {args.output}')
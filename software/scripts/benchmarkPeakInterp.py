@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+import setupLibPaths
+import kek_bpm_rfsoc_dev as rfsoc
+
+import time
+import argparse
+import numpy as np
+
+# Returns a (4, numSamples) block with one Gaussian pulse per bunch window at a random
+# sub-sample phase, and the true (amplitude, position) of every pulse, shape (4, nBunch)
+def makePulses(numSamples, sigma, noise, pointsPerBunch=12, seed=0):
+    rng    = np.random.default_rng(seed)
+    nBunch = numSamples // pointsPerBunch
+    amp    = rng.uniform(1000, 8000, size=(4,nBunch))
+    pos    = pointsPerBunch*np.arange(nBunch) + pointsPerBunch/2 + rng.uniform(-0.5, 0.5, size=(4,nBunch))
+
+    t = np.arange(numSamples)
+    block = np.zeros(shape=(4,numSamples))
+    for k in range(-pointsPerBunch//2, pointsPerBunch//2):
+        i = np.floor(pos).astype(np.int64) + k
+        ok = (i >= 0) & (i < numSamples)
+        rows = np.broadcast_to(np.arange(4)[:,np.newaxis], i.shape)
+        block[rows[ok], i[ok]] += amp[ok]*np.exp(-0.5*((t[i[ok]]-pos[ok])/sigma)**2)
+    block += rng.normal(0, noise, size=block.shape)
+    return np.round(block).astype(np.int16), amp, pos
+
+if __name__ == "__main__":
+
+#################################################################
+
+    # Set the argument parser
+    parser = argparse.ArgumentParser(description='Compares the time and accuracy of the sub-sample peak interpolation modes')
+
+    parser.add_argument(
+        "--samples",
+        type     = int,
+        required = False,
+        default  = 8192,
+        help     = "Number of samples per channel",
+    )
+
+    parser.add_argument(
+        "--sigma",
+        type     = float,
+        required = False,
+        default  = 1.2,
+        help     = "Pulse width (samples)",
+    )
+
+    parser.add_argument(
+        "--noise",
+        type     = float,
+        required = False,
+        default  = 0.0,
+        help     = "Gaussian noise added to every sample (ADC counts rms)",
+    )
+
+    parser.add_argument(
+        "--runs",
+        type     = int,
+        required = False,
+        default  = 200,
+        help     = "Number of timed runs per mode",
+    )
+
+    parser.add_argument(
+        "--halfWidth",
+        type     = int,
+        required = False,
+        default  = 1,
+        help     = "Half width of the centroid window",
+    )
+
+    # Get the arguments
+    args = parser.parse_args()
+
+    #################################################################
+
+    block, amp, pos = makePulses(args.samples, args.sigma, args.noise)
+    nBunch = amp.shape[1]
+
+    print(f'4 x {args.samples} samples, {nBunch} pulses per channel, sigma {args.sigma} samples, noise {args.noise}, {args.runs} runs')
+    print(f'{"mode":10s} {"time":>10s} {"amplitude error":>16s} {"position error":>15s}')
+    for mode in ['none', 'parabolic', 'gaussian', 'centroid']:
+        t0 = time.perf_counter()
+        for _ in range(args.runs):
+            if mode == 'none':
+                peaks,_ = rfsoc.peakSearch(block, 0, 0)
+            else:
+                peaks,position,_ = rfsoc.peakInterp(block, 0, 0, mode=mode, halfWidth=args.halfWidth)
+        dt = (time.perf_counter()-t0)/args.runs
+
+        if mode == 'none':
+            position = rfsoc.peakIndex(block, 0)
+        ampErr = np.sqrt(np.mean((peaks[:,:nBunch]/amp-1.0)**2))
+        posErr = np.sqrt(np.mean((position[:,:nBunch]-pos)**2))
+        print(f'{mode:10s} {1e3*dt:7.2f} ms {100*ampErr:14.2f} % {posErr:9.3f} sample')
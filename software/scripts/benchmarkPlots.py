@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+import setupLibPaths
+import kek_bpm_rfsoc_dev as rfsoc
+
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+# Reference: the per-event plotting of makeplot_newFW.py before AbortPlotRenderer
+def referencePlot(path, plane, title, x, position, charge, xlim=(0,10)):
+    cfg = rfsoc.AbortPlotPlanes[plane]
+    fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True,figsize=cfg['figsize'])
+    ax1.set_title(title)
+    ax1.scatter(x,position,color=cfg['posColor'],s=6)
+    ax1.set_ylabel("Y position (mm)")
+    ax1.set_ylim(-0.4,0.4)
+    ax1.grid()
+    ax1.text(0.02,0.05,cfg['posText'],transform=ax1.transAxes,ha='left',va='bottom',fontsize=14)
+
+    ax2.scatter(x,charge,color=cfg['chargeColor'],s=6)
+    ax2.set_xlabel("Turn")
+    ax2.set_ylabel(cfg['chargeLabel'])
+    ax2.set_ylim(0,1.2)
+    ax2.grid()
+    ax2.set_xticks([0,1,2,3,4,5,6,7,8,9,10],['-10','-9','-8','-7','-6','-5','-4','-3','-2','-1','0'])
+    ax2.set_yticks([0,0.2,0.4,0.6,0.8,1])
+    ax2.set_xlim(*xlim)
+    ax2.text(0.02,0.05,cfg['chargeText'],transform=ax2.transAxes,ha='left',va='bottom',fontsize=14)
+    plt.subplots_adjust(hspace=.1)
+    plt.savefig(path,dpi=200,bbox_inches="tight",pad_inches=0.5)
+    plt.close()
+
+# Returns the UV and DV plot jobs of an event: from a .dat file, or synthetic
+def makeJobs(outDir, k, dat=None, nBunch=2500):
+    if dat is not None:
+        res = rfsoc.extractBunches(dat.waveforms[k % dat.numEvents], numTurns=102)
+        bunchIndex = res['bunchIndex']
+        planes = {'UV': (res['uv'][-10:], res['chargeU'][-10:]), 'DV': (res['dv'][-10:], res['chargeD'][-10:])}
+    else:
+        rng = np.random.default_rng(k)
+        bunchIndex = np.sort(rng.choice(5120, size=nBunch, replace=False))
+        loss = np.linspace(1.0, 0.2, 10)[:,np.newaxis]
+        planes = {p: (rng.normal(0, 0.05, (10,nBunch)), loss*rng.normal(1, 0.02, (10,nBunch))) for p in ['UV','DV']}
+
+    x = (bunchIndex[np.newaxis,:]-bunchIndex[0]+5120*np.arange(10)[:,np.newaxis]).ravel()/5120
+    return [{
+        'path'     : os.path.join(outDir, f'LER{plane}_{k}_plot.png'),
+        'plane'    : plane,
+        'title'    : f'event {k}',
+        'x'        : x,
+        'position' : pos.ravel(),
+        'charge'   : charge.ravel(),
+    } for plane,(pos,charge) in planes.items()]
+
+# Returns the mean absolute difference (0 to 1) between two PNG files, None if the sizes differ
+def pngDifference(a, b):
+    a = plt.imread(a)[:,:,:3]
+    b = plt.imread(b)[:,:,:3]
+    return None if a.shape != b.shape else float(np.mean(np.abs(a-b)))
+
+if __name__ == "__main__":
+
+#################################################################
+
+    # Set the argument parser
+    parser = argparse.ArgumentParser(description='Compares the abort summary PNG generation time of the makeplot scripts and AbortPlotRenderer')
+
+    parser.add_argument(
+        "--file",
+        type     = str,
+        required = False,
+        default  = None,
+        help     = ".dat file to take the events from (default: synthetic events)",
+    )
+
+    parser.add_argument(
+        "--events",
+        type     = int,
+        required = False,
+        default  = 10,
+        help     = "Number of events to render",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type     = int,
+        required = False,
+        default  = 2,
+        help     = "Number of worker processes of the parallel renderer",
+    )
+
+    # Get the arguments
+    args = parser.parse_args()
+
+    #################################################################
+
+    dat = rfsoc.DatFile(args.file, mmap=True) if args.file is not None else None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dirs = {name: os.path.join(tmp, name) for name in ['reference', 'serial', 'parallel']}
+        for d in dirs.values():
+            os.makedirs(d)
+        jobs = {name: [makeJobs(d, k, dat) for k in range(args.events)] for name,d in dirs.items()}
+
+        t0 = time.perf_counter()
+        for event in jobs['reference']:
+            for job in event:
+                referencePlot(**job)
+        reference = time.perf_counter()-t0
+
+        with rfsoc.AbortPlotPool(workers=0) as pool:
+            t0 = time.perf_counter()
+            for event in jobs['serial']:
+                drawn = pool.render(event)
+            serial = time.perf_counter()-t0
+
+        with rfsoc.AbortPlotPool(workers=args.workers) as pool:
+            t0 = time.perf_counter()
+            for event in jobs['parallel']:
+                pool.render(event)
+            parallel = time.perf_counter()-t0
+
+        diff = [pngDifference(a['path'], b['path']) for a,b in zip(jobs['reference'][-1], jobs['serial'][-1])]
+
+    points = len(jobs['reference'][-1][0]['x'])
+    print(f'{args.events} events x 2 planes, {points} points per layer ({drawn[-1]} drawn after decimation)')
+    print(f'reference (makeplot)          : {1e3*reference/args.events:7.1f} ms/event')
+    print(f'AbortPlotRenderer             : {1e3*serial/args.events:7.1f} ms/event ({reference/serial:.1f}x)')
+    print(f'AbortPlotPool ({args.workers} workers)     : {1e3*parallel/args.events:7.1f} ms/event ({reference/parallel:.1f}x)')
+    print(f'mean absolute pixel difference: {diff}')
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+import setupLibPaths
+import kek_bpm_rfsoc_dev as rfsoc
+
+import os
+import argparse
+
+if __name__ == "__main__":
+
+#################################################################
+
+    # Set the argument parser
+    parser = argparse.ArgumentParser(description='Converts .dat fault files into chunked, compressed .fca archives')
+
+    # Add arguments
+    parser.add_argument(
+        "inputs",
+        type     = str,
+        nargs    = '+',
+        help     = "Directories (all data_*.dat files), .dat files or glob patterns",
+    )
+
+    parser.add_argument(
+        "--outputDir",
+        type     = str,
+        required = False,
+        default  = None,
+        help     = "Output directory (default: next to each .dat file)",
+    )
+
+    parser.add_argument(
+        "--chunkTurns",
+        type     = int,
+        required = False,
+        default  = 8,
+        help     = "Number of turns per chunk",
+    )
+
+    parser.add_argument(
+        "--samplesPerTurn",
+        type     = int,
+        required = False,
+        default  = 5120,
+        help     = "Samples per turn (5120 for the fault buffer, 40960 for raw ADC captures)",
+    )
+
+    parser.add_argument(
+        "--filters",
+        type     = str,
+        required = False,
+        default  = 'shuffle',
+        help     = "Comma separated filters (delta, shuffle, or empty)",
+    )
+
+    parser.add_argument(
+        "--level",
+        type     = int,
+        required = False,
+        default  = 1,
+        help     = "Deflate compression level (1 = fastest, 9 = smallest)",
+    )
+
+    parser.add_argument(
+        "--meta",
+        type     = str,
+        action   = 'append',
+        default  = [],
+        help     = "Archive metadata as key=value (e.g. --meta MuxSelect=1 --meta firmware=KekBpmRfsocDevZcu111-0x01000000)",
+    )
+
+    # Get the arguments
+    args = parser.parse_args()
+
+    #################################################################
+
+    metadata = dict(m.split('=',1) for m in args.meta)
+    filters  = tuple(f for f in args.filters.split(',') if f)
+
+    for path in rfsoc.expandDatFiles(args.inputs):
+        archivePath = os.path.splitext(path)[0] + '.fca'
+        if args.outputDir is not None:
+            archivePath = os.path.join(args.outputDir, os.path.basename(archivePath))
+
+        rfsoc.convertDatFile(
+            path,
+            archivePath,
+            metadata       = metadata,
+            chunkTurns     = args.chunkTurns,
+            samplesPerTurn = args.samplesPerTurn,
+            filters        = filters,
+            level          = args.level,
+        )
+        print(f'{path} ({os.path.getsize(path)} bytes) -> {archivePath} ({os.path.getsize(archivePath)} bytes)')
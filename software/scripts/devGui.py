@@ -68,6 +68,14 @@ if __name__ == "__main__":
         help     = "Sets board type (zcu111 or zcu208 or rfsoc4x2)",
     )
 
+    parser.add_argument(
+        "--streamProcEn",
+        type     = argBool,
+        required = False,
+        default  = False,
+        help     = "Include the BPM stream processor (peak search and position calculation of the AMP live display)",
+    )
+
     # Get the arguments
     args = parser.parse_args()
 
@@ -81,6 +89,7 @@ if __name__ == "__main__":
         bpmFreqMHz = args.bpmFreqMHz,
         chMask     = args.chMask,
         boardType  = args.boardType,
+        streamProcEn = args.streamProcEn,
     ) as root:
 
         ######################
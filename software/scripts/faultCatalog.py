@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#-----------------------------------------------------------------------------
+# This file is part of the 'kek_bpm_rfsoc_dev'. It is subject to
+# the license terms in the LICENSE.txt file found in the top-level directory
+# of this distribution and at:
+#    https://confluence.slac.stanford.edu/display/ppareg/LICENSE.html.
+# No part of the 'kek_bpm_rfsoc_dev', including this file, may be
+# copied, modified, propagated, or distributed except according to the terms
+# contained in the LICENSE.txt file.
+#-----------------------------------------------------------------------------
+import setupLibPaths
+import kek_bpm_rfsoc_dev as rfsoc
+
+import time
+import datetime
+import argparse
+
+if __name__ == "__main__":
+
+#################################################################
+
+    # Set the argument parser
+    parser = argparse.ArgumentParser(description='Fault event catalog (SQLite)')
+
+    # Convert 'YYYY-mm-dd HH:MM:SS' to datetime
+    argTime = lambda s: datetime.datetime.fromisoformat(s)
+
+    parser.add_argument(
+        "--db",
+        type     = str,
+        required = False,
+        default  = '/mnt/SBOR/ZCU111/faultCatalog.sqlite',
+        help     = "Catalog database",
+    )
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    backfill = subparsers.add_parser('backfill', help='Catalogs the new or modified .dat files')
+    backfill.add_argument("inputs", type=str, nargs='+', help="Directories (all data_*.dat files), .dat files or glob patterns")
+    backfill.add_argument("--workers", type=int, default=0, help="Number of worker processes (0 = number of CPUs)")
+    backfill.add_argument("--force", action='store_true', help="Re-analyze the files already cataloged")
+    backfill.add_argument("--prune", action='store_true', help="Remove the files that no longer exist")
+
+    query = subparsers.add_parser('query', help='Lists the cataloged events')
+    query.add_argument("--start", type=argTime, default=None, help="Time range start (YYYY-mm-dd HH:MM:SS)")
+    query.add_argument("--stop", type=argTime, default=None, help="Time range stop (YYYY-mm-dd HH:MM:SS)")
+    query.add_argument("--minBunches", type=int, default=None, help="Minimum number of filled buckets")
+    query.add_argument("--minExcursion", type=float, default=None, help="Minimum max(|DV|, |UV|) (mm)")
+    query.add_argument("--maxLossTurn", type=int, default=None, help="Charge loss at or before this turn")
+    query.add_argument("--all", action='store_true', help="Include the events without abort gap or with too few bunches")
+
+    # Get the arguments
+    args = parser.parse_args()
+
+    #################################################################
+
+    with rfsoc.FaultCatalog(args.db) as catalog:
+
+        if args.command == 'backfill':
+            if args.prune:
+                print(f'Pruned {catalog.prune()} files')
+            files = rfsoc.expandDatFiles(args.inputs)
+            count = catalog.backfill(files, workers=args.workers, force=args.force, progress=rfsoc.printProgress())
+            print(f'Cataloged {count} of {len(files)} files')
+
+        else:
+            rows = catalog.query(
+                start        = args.start,
+                stop         = args.stop,
+                minBunches   = args.minBunches,
+                minExcursion = args.minExcursion,
+                maxLossTurn  = args.maxLossTurn,
+                valid        = not args.all,
+            )
+            for row in rows:
+                recordtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['timestamp'])) if row['timestamp'] is not None else '-'
+                print(f"{recordtime}  {row['path']}@{row['offset']}  Nbunch={row['numBunches']}  firstBunch={row['firstBunch']}  "
+                      f"lossTurnD={row['lossTurnD']}  maxExcursion={row['maxExcursion']:.3f} mm")
+            print(f'{len(rows)} events')
@@ -1,103 +1,31 @@
 #!/usr/bin/env python3
 
 import os
-import glob
-import datetime
 import matplotlib.pyplot as plt
-import pyrogue.utilities.fileio as fileio
 import numpy as np
-import os
 import time
-import struct
-
-def find_latest_dat_files(directory):
-    dat_files = glob.glob(os.path.join(directory, 'data_*.dat'))
 
-    if not dat_files:
-        return None, None
-    
-    # 日時を取得し、最新のものを見つける
-    latest_file = max(dat_files, key=os.path.getctime)
-    latest_datetime = datetime.datetime.strptime(os.path.basename(latest_file)[5:20], '%Y%m%d_%H%M%S')
-    
-    # 最新のファイルと一個前のファイルを見つける
-    previous_files = [file for file in dat_files if file != latest_file]
-    previous_files = [file for file in previous_files if datetime.datetime.strptime(os.path.basename(file)[5:20], '%Y%m%d_%H%M%S') < latest_datetime]
-    previous_file = max(previous_files, key=lambda x: datetime.datetime.strptime(os.path.basename(x)[5:20], '%Y%m%d_%H%M%S')) if previous_files else None
-    
-    return latest_file, previous_file
-
-def datfile(filename):
-    # Waveforms variables to be filled 
-    ampFault = { i : []  for i in range(4) }  
-    xPosFault = []
-    yPosFault = []
-    qBunchFault = []
-    recordtime = []
-    
-    # Open the .dat file
-    with fileio.FileReader(files=filename) as fd:
-        
-        # Loop through the file data
-        for header,data in fd.records():
-    
-            # Check if there is a 8-byte header in the frame
-            if (header.flags==0):
-                hdrOffset = 8
-                hdr = struct.unpack("<d", data[:8])[0]
-                timestamp = time.localtime(hdr)
-                # Define the desired format string (replace with your preferred format)
-                # Some common format specifiers:
-                # %Y - Year with century
-                # %m - Month as a decimal number (01-12)
-                # %d - Day of the month as a decimal number (01-31)
-                # %H - Hour in 24-hour format (00-23)
-                # %M - Minute (00-59)
-                # %S - Second (00-59)
-                
-                formatted_time = time.strftime('%Y-%m-%d_%H-%M-%S', timestamp)
-                #print( f'CH={header.channel}: Event Timestamp in human-readable format: {formatted_time}' )
-                if header.channel==24:
-                    recordtime.append(formatted_time)
-            
-            else:
-                hdrOffset = 0
-                print( 'No timestamp header detected' )
-                return 0,0
-            
-            # Check for error in frame
-            if (header.error>0):
-                # Look at record header data
-                print(f"Processing record. Total={fd.totCount}, Current={fd.currCount}")
-                print(f"Record size    = {header.size}")
-                print(f"Record channel = {header.channel}")
-                print(f"Record flags   = {header.flags:#x}")
-                print(f"Record error   = {header.error:#x}")
-    
-            # Check if AMP Fault waveform
-            elif (header.channel < 16) and (header.channel >= 12):
-                ampFault[header.channel-12].append(data[hdrOffset:].view(np.int16))
-    
-            # Check if AMP Live waveform
-            elif header.channel == 24:
-                fpData = data[hdrOffset:].view(np.float32)
-                fpDataLen = len(fpData)
-                xPosFault.append(   fpData[0:(fpDataLen*3)+0:3] ) 
-                yPosFault.append(   fpData[1:(fpDataLen*3)+1:3] )
-                qBunchFault.append( fpData[2:(fpDataLen*3)+2:3] )
-            
-            # Else undefined stream index
-            else:
-                print( f'UNDEFINED DATA STREAM[{header.channel}]!!!')
-    return ampFault, recordtime
+import setupLibPaths
+import kek_bpm_rfsoc_dev as rfsoc
 
 def parse_and_plot(dat_file):
-    ampFault, recordtime=datfile(dat_file)
-    if recordtime==0:
+    # Open the .dat file (indexed and memory mapped), the record time is taken from the AMP Live stream
+    with rfsoc.DatFile(dat_file,mmap=True,timestampChannels=rfsoc.DatFaultChannels+(24,)) as dat:
+        if (dat.numEvents==0) or (len(dat.index)==0):
+            print('No fault event found')
+            return
+        if (dat.index['flags']!=0).any():
+            print('No timestamp header detected')
+            return
+        recordtime=[time.strftime('%Y-%m-%d_%H-%M-%S',time.localtime(t)) for t in dat.channelTimestamps(24)]
+        ampFault=np.ascontiguousarray(dat.waveforms[0])
+    if len(recordtime)==0:
         return
     
     print(f'Selected time : {recordtime[0]}')
     
+    # Old firmware DV/UV analysis, disabled: its turn x bunch heatmaps are not saved,
+    # and are not rendered through AbortPlotRenderer
     """
     def bunchindex(threshold,waveform):
         start=12800
@@ -397,25 +325,9 @@ def parse_and_plot(dat_file):
     plt.close()
     """
 
-    def bunchindex(threshold,waveform):
-        start=23500
-        firstbunch=0
-        for i in range(1,8*2000):
-            if waveform[start+i-1]<waveform[start+i] and waveform[start+i]>waveform[start+i+1]:
-                if waveform[start+i]>threshold:
-                    firstbunch=start+i
-                    break
-        if firstbunch==0:
-            print("data is not invalid")
-            return firstbunch, 0
-    
-        bunch_candidate=waveform[firstbunch:firstbunch+5120*8:8]
-        bunch_index=np.where(bunch_candidate>threshold)[0]
-    
-        return firstbunch, bunch_index
-
-    firstbunch, bunch_index=bunchindex(800,ampFault[2][0])
-    if firstbunch==0:
+    firstbunch, bunch_index=rfsoc.rawBunchIndex(ampFault[2],800,searchStart=23500,searchSize=8*2000)
+    if firstbunch is None:
+        print("data is not invalid")
         print("end process")
         return
     os.makedirs(f'/mnt/SBOR/RFSoC/{recordtime[0]}', exist_ok=True)
@@ -423,67 +335,36 @@ def parse_and_plot(dat_file):
     print(f'Num of bunch : {len(bunch_index)}')
     print(f'First bunch index : {firstbunch}')
     print(bunch_index)
-    eventnum=0
-    y_pos=[]
-    x_pos=[]
-    charge=[]
-    for j in bunch_index:
-        certain_bunch=[]
-        certain_bunch_x=[]
-        certain_bunch_charge=[]
-        for i in range(12):
-            sum_1=ampFault[2][eventnum][firstbunch+j*8+5120*8*i]
-            sum_2=ampFault[3][eventnum][firstbunch+j*8+5120*8*i]
-            sum=sum_1+sum_2
-            delta_U=ampFault[0][eventnum][firstbunch+j*8+5120*8*i+1]
-            delta_V=ampFault[1][eventnum][firstbunch+j*8+5120*8*i+1]
-            Uposition=delta_U/sum_1
-            Vposition=delta_V/sum_2
-            xposition=Uposition-Vposition
-            yposition=Uposition+Vposition
-            certain_bunch.append(yposition)
-            certain_bunch_x.append(xposition)
-            certain_bunch_charge.append(sum)
-        y_pos.append(np.array(certain_bunch))
-        x_pos.append(np.array(certain_bunch_x))
-        charge.append(np.array(certain_bunch_charge))
-    y_pos=np.array(y_pos)
-    x_pos=np.array(x_pos)
-    charge=np.array(charge)
 
-    mean=np.mean(y_pos[:,0:2],axis=1)
-    y_pos=y_pos-mean[:,np.newaxis]
-    mean=np.mean(x_pos[:,0:2],axis=1)
-    x_pos=x_pos-mean[:,np.newaxis]
-    charge_mean=np.mean(charge[:,0:2],axis=1)
-    charge=charge/charge_mean[:,np.newaxis]
+    # (turn, bunch) matrices of the filled buckets, the U/V delta samples are one sample later
+    tbt=rfsoc.gatherTurns(ampFault,firstbunch,bunch_index,12,step=8)
+    dlt=rfsoc.gatherTurns(ampFault[0:2],firstbunch+1,bunch_index,12,step=8)
+    Uposition=rfsoc.deltaOverSum(dlt[0],tbt[2],scale=1.0)
+    Vposition=rfsoc.deltaOverSum(dlt[1],tbt[3],scale=1.0)
+
+    x_pos=rfsoc.subtractBaseline(Uposition-Vposition,2)
+    y_pos=rfsoc.subtractBaseline(Uposition+Vposition,2)
+    charge=rfsoc.normalizeBaseline(tbt[2].astype(np.float64)+tbt[3],2)
             
     #make x axis
-    bunch_index_12=[]
-    for i in range(12):
-        bunch_index_12.append(bunch_index+5120*i)
-
-    x_axis=np.concatenate(bunch_index_12)/5120+1
+    x_axis=(bunch_index[np.newaxis,:]+5120*np.arange(12)[:,np.newaxis]).ravel()/5120+1
     
     fig, (ax1, ax2, ax3) = plt.subplots(3, 1, sharex=True,figsize=(30,12))
-    split=np.hsplit(x_pos,x_pos.shape[1])
     ax1.set_title(f'{recordtime[0]}')
-    ax1.scatter(x_axis,np.concatenate(split),color='red',s=6)
+    ax1.scatter(x_axis,x_pos.ravel(),color='red',s=6)
     ax1.set_ylabel("X position (a.u.)")
     ax1.set_ylim(-0.6,0.6)
     ax1.grid()
     ax1.text(0.02,0.05,'D6 Horizontal',transform=ax1.transAxes,ha='left',va='bottom',fontsize=20)
     
-    split=np.hsplit(y_pos,y_pos.shape[1])
-    ax2.scatter(x_axis,np.concatenate(split),color='red',s=6)
+    ax2.scatter(x_axis,y_pos.ravel(),color='red',s=6)
     ax2.set_ylabel("Y position (a.u.)")
     ax2.set_ylim(-0.6,0.6)
     ax2.grid()
     ax2.text(0.02,0.05,'D6 Vertical',transform=ax2.transAxes,ha='left',va='bottom',fontsize=20)
 
 
-    split=np.hsplit(charge,charge.shape[1])
-    ax3.scatter(x_axis,np.concatenate(split).reshape(len(x_axis)),color='blue',s=6)
+    ax3.scatter(x_axis,charge.ravel(),color='blue',s=6)
     ax3.set_xlabel("Turn")
     ax3.set_ylabel("Charge")
     ax3.set_ylim(0,1.2)
@@ -503,7 +384,7 @@ def parse_and_plot(dat_file):
     
 def main():
     directory = '/home/nomaru/projects/kek-bpm-rfsoc-dev/software/datfile/'  # ディレクトリのパスを指定する
-    latest_file, previous_file = find_latest_dat_files(directory)
+    latest_file, previous_file = rfsoc.findLatestDatFiles(directory)
     
     if latest_file:
         parse_and_plot(previous_file)